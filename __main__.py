@@ -8,8 +8,10 @@ import app
 import argparse
 import glob
 import bson.json_util
+import db
+import db.migrations
+import db.models
 import nose
-import pymongo
 import settings
 import settings_test
 import sys
@@ -31,6 +33,18 @@ def get_args():
     parser.add_argument('--reset-db', dest='reset_db',
         action='store_const', const = True, default = False,
         help='wipe out the database and restore from fixtures')
+    parser.add_argument('--ensure-indexes', dest='ensure_indexes',
+        action='store_const', const = True, default = False,
+        help='build the indexes declared by the models (safe to repeat)')
+    parser.add_argument('--migrate', dest='migrate',
+        action='store_const', const = True, default = False,
+        help='run the pending db.migrations (safe to stop and repeat)')
+    parser.add_argument('--migrations', dest='list_migrations',
+        action='store_const', const = True, default = False,
+        help='list the db.migrations and how far each has got')
+    parser.add_argument('--dry-run', dest='dry_run',
+        action='store_const', const = True, default = False,
+        help='with --migrate, only count the documents to migrate')
     parser.add_argument('--use-reloader', dest='use_reloader',
         action='store_const', const = True, default = False,
         help='reload server on file change (do not use with --reset-db)')
@@ -57,8 +71,8 @@ def main(args):
                 # Using keys() instead of values() because we want to
                 # load the same fixtures whether or not we're testing.
                 for db_key, db_name in settings.DATABASES.items():
-                    pymongo.MongoClient().drop_database(db_name)
-                    db = pymongo.MongoClient()[db_name]
+                    db.get_client().drop_database(db_name)
+                    database = db.get_connection(db_name)
                 
                     # Go through every JSON file in the fixtures directory and
                     # insert the objects in the JSON files into collections named
@@ -68,14 +82,48 @@ def main(args):
                         print "Loading " + f
                     
                         with open(f, 'r') as fixture:
-                            for rows in bson.json_util.loads(fixture.read()):
-                                db[f.split('/')[-1].split('.')[0]].insert(rows)
+                            db.models.bulk_write(
+                                database[f.split('/')[-1].split('.')[0]],
+                                bson.json_util.loads(fixture.read()),
+                                lambda bulk, row: bulk.insert(row))
                 
                 print "Fixtures successfully loaded!\n"
                 
+                # The fixtures are already in the current form. Running the
+                # migrations over them records them as done, so that reads
+                # stop falling back on the forms they migrate away from.
+                app.app.config['DATABASES'] = settings.DATABASES
+                print "%s migrations run.\n" % db.migrations.migrate()
+                
             else:
                 print "Ignoring --reset-database this time, then."
+                
+    if args.ensure_indexes:
+        # The models look up their database names in the app config, which
+        # has not been set up yet if we are not running the server.
+        app.app.config['DATABASES'] = settings.DATABASES
+        
+        import oauth_provider.models
+        import async_tasks.models
+        import correlations.models
+        
+        for collection, indexes in sorted(db.models.ensure_indexes().items()):
+            print "Ensured indexes on %s: %s" % (collection,
+                ', '.join(indexes))
            
+    if args.migrate or args.list_migrations:
+        app.app.config['DATABASES'] = settings.DATABASES
+        
+        if args.migrate:
+            for migration in db.migrations.pending():
+                print "Running %r..." % migration
+                print "%s documents %s." % (db.migrations.run(migration,
+                    dry_run = args.dry_run),
+                    'to migrate' if args.dry_run else 'migrated')
+                
+        for line in db.migrations.describe():
+            print line
+            
     if args.run_unittests:
         nose.run(argv = sys.argv[:1])
         
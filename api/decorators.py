@@ -1,14 +1,20 @@
 from flask import abort, request
 from oauth_provider.models import User, AccessToken
 
-def provide_oauth_token(_f):
+# The only token and user fields most API views look at. Fetching just these
+# keeps us from loading and decoding every one of a user's external tokens on
+# each request. Views that need more can ask for it.
+TOKEN_FIELDS = ['user_id', 'client_id', 'realm']
+USER_FIELDS = ['_id']
+
+def provide_oauth_token(_f, fields = TOKEN_FIELDS):
     def wrapped(*args, **kwargs):
         if request.method ==  "GET":
             token_key = request.args.get('oauth_token')
         elif request.method == "POST":
             token_key = request.form.get('oauth_token')
             
-        token = AccessToken.find_one({'token': token_key})
+        token = AccessToken.find_one({'token': token_key}, fields = fields)
         
         if token:
             token = AccessToken(**token)
@@ -21,11 +27,11 @@ def provide_oauth_token(_f):
             
     return wrapped
 
-def provide_oauth_user(_f):
+def provide_oauth_user(_f, fields = USER_FIELDS):
     def wrapped(*args, **kwargs):
         
         def _provide_user(token, *args, **kwargs):
-            user = User.find_one({'_id': token['user_id']})
+            user = User.find_one({'_id': token['user_id']}, fields = fields)
             return _f(user, *args, **kwargs)
             
         return provide_oauth_token(_provide_user)(*args, **kwargs)
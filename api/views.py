@@ -17,7 +17,7 @@ from auth import APIS
 from oauth_provider.models import User, AccessToken
 from oauth_provider.views import PROVIDER
 from async_tasks.models import (Correlation, CustomTimeSeriesPath, 
-    TimeSeriesData)
+    TimeSeriesData, DataVersion)
 from correlations.constants import MINIMUM_DATAPOINTS_FOR_CORRELATION
 from views_funcs import (get_service_data_func, get_directory,
     get_top_level_directory, get_correlations, passthrough)
@@ -206,6 +206,9 @@ def root_json_post(token):
     # Run the CSV datastream task on this to get its data pulled in.
     async_tasks.datastreams.tasks.CSVDatastreamTasks().run(custom_path)
     
+    # The user's directory has changed even if no data came in.
+    DataVersion.bump([(token['user_id'], parent_path + name + '/')])
+    
     return json.dumps({'_links':
         {'self': request.url_root + 'v1/' + path + '.json'},
          'title': custom_path.title,
@@ -220,8 +223,12 @@ def register_apis(apis):
     
     @app.route('/passthrough/<service>/<path:endpoint>')
     def secondary_api(service, endpoint):
+        # The API objects sign requests with the user's token for the service,
+        # and renew expired ones with its refresh token.
         return decorators.provide_oauth_user(
-                PROVIDER.require_oauth(realm = service)(passthrough)
+                PROVIDER.require_oauth(realm = service)(passthrough),
+                fields = ['external_tokens.' + service,
+                    'refresh_tokens.' + service]
             )(apis, service, endpoint)
         
 auth.signals.services_registered.connect(register_apis)
@@ -16,8 +16,8 @@ from flask import abort, request
 from oauth_provider.models import User, AccessToken, UID
 from oauthlib.common import add_params_to_uri
 from auth import APIS
-from async_tasks.models import (TimeSeriesPath, TimeSeriesData,
-    LastCustomDataPull)
+from async_tasks.models import (TimeSeriesPath, TimeSeriesPathTree,
+    TimeSeriesData, LastCustomDataPull)
 from async_tasks.helper_classes import (
     UserTimeSeriesQuery, PathNotFoundException)
 
@@ -56,7 +56,8 @@ def increment_time(datetime_obj, interval_name):
     
 
 def get_top_level_directory(token, url_prefix):
-    user = User.find_one({'_id': token['user_id']})
+    user = User.find_one({'_id': token['user_id']},
+        fields = ['external_tokens'])
     links = {
         'self': {'href': request.base_url, 'title': 'API root'},
         'dimensions.json': {
@@ -71,12 +72,8 @@ def get_top_level_directory(token, url_prefix):
         
     links.update({datastream['name']: {
             'href': '%s/%s.json' % (url_prefix, datastream['name'])
-        } for datastream in TimeSeriesPath.get_collection().find(
-            {'parent_path': None,
-             'user_id': token['user_id'],
-             'client_id': token['client_id']
-             }
-        )
+        } for datastream in TimeSeriesPathTree.get_children(token['user_id'])
+        if datastream['client_id'] == token['client_id']
     })
     return json.dumps({'_links': links})
 
@@ -89,21 +86,17 @@ def get_directory(user, parent_path):
     # Check to make sure the requested path exists.
     parent_path = parent_path.strip('/')
     parent_path = parent_path + "/"
-    requested_path = TimeSeriesPath.find({'user_id': user['_id'],
-        'parent_path': parent_path })
+    children = TimeSeriesPathTree.get_children(user['_id'], parent_path)
     
-    if requested_path and requested_path.count() > 0:
-        # Get all the timeseries paths that have the specified parent path.
-        for path in TimeSeriesPath.get_collection().aggregate(
-        [{'$match': {"user_id": user['_id'], "parent_path": parent_path}},
-        {'$group': {'_id': {'name':'$name', 'title':'$title'}}}]
-        )['result']:
-            links[path['_id']['name']] = { 'href': '%s/%s.json' % (url_prefix,
-                (parent_path if parent_path else '') + path['_id']['name'])}
+    if children:
+        # Link to all the timeseries paths that have the specified parent path.
+        for path in children:
+            links[path['name']] = { 'href': '%s/%s.json' % (url_prefix,
+                (parent_path if parent_path else '') + path['name'])}
             
             # Include the title in the returned data if the path has one set.
-            if 'title' in path['_id']:
-                links[path['_id']['name']]['title'] = path['_id']['title']
+            if path['title'] is not None:
+                links[path['name']]['title'] = path['title']
             
         return json.dumps({'_links': links})
         
@@ -116,9 +109,9 @@ query_class = UserTimeSeriesQuery):
     # Get the parent's title.
     if '/' in parent_path.strip('/'):
         grandparent_path, parent_name = tuple(parent_path[0:-1].rsplit('/', 1))
-        parent_title = TimeSeriesPath.get_collection().find(
-            {'parent_path': grandparent_path+'/', 'name': parent_name}
-        ).distinct('title')
+        parent_title = [path['title'] for path in TimeSeriesPath.find_paths(
+            {'parent_path': grandparent_path+'/', 'name': parent_name},
+            fields = ['title']) if path.get('title')]
         parent_title = parent_title[0] if len(parent_title) > 0 else None
     else:
         parent_title = None
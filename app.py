@@ -3,16 +3,42 @@ import settings
 
 app = flask.Flask(__name__)
 
+def get_setting(key, default = None):
+    '''
+    Returns a setting from the app's config, or else from the settings
+    module, which is all the task runners have since they do not set the app
+    up.
+    '''
+    return app.config.get(key, getattr(settings, key, default))
+
 def setup_app(settings, app = app):
     app.secret_key = settings.APP_SECRET_KEY
     app.config['TRAP_BAD_REQUEST_ERRORS'] = settings.DEBUG
     app.config['DATABASES'] = settings.DATABASES
     app.config['DATABASE_PORT'] = settings.DATABASE_PORT
     
+    for setting in ['DATABASE_BACKEND', 'DATABASE_HOST', 'DATABASE_POOL_SIZE',
+    'DATABASE_CONNECT_TIMEOUT_MS', 'DATABASE_SOCKET_TIMEOUT_MS',
+    'DATABASE_SLOW_QUERY_MS', 'DATABASE_MEASURE_BYTES',
+    'DATABASE_BULK_BATCH_SIZE', 'DATABASE_ASYNC_WORKERS',
+    'DATABASE_MIGRATION_BATCH_SIZE', 'DATABASE_MIGRATION_MAX_PER_SECOND',
+    'TIMESERIES_STORAGE', 'TIMESERIES_ROLLUPS', 'TIMESERIES_SNAPSHOT_DIR',
+    'TIMESERIES_SNAPSHOT_MAX_AGE', 'TIMESERIES_COMPACTION_DAYS',
+    'TIMESERIES_PATH_CACHE_SECONDS', 'TIMESERIES_LEGACY_PATHS',
+    'TIMESERIES_COMPACT_KEYS', 'TIMESERIES_QUERY_CACHE_SIZE',
+    'TIMESERIES_QUERY_CACHE_SHARED', 'TIMESERIES_QUERY_ENGINE',
+    'TIMESERIES_LOCAL_ENGINE_MAX_ROWS']:
+        if hasattr(settings, setting):
+            app.config[setting] = getattr(settings, setting)
+    
     import auth
+    import db.scope
     import oauth_provider.signals
     import flask.ext.login
     
+    # Open a db scope for each request before any other request hooks run.
+    db.scope.init_app(app)
+    
     with app.app_context():
         import oauth_provider.views
         import api.views
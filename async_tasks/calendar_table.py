@@ -0,0 +1,217 @@
+'''
+The calendar fields time series documents carry (year, month, week, day,
+isoyear, isoweek, isoweekday and hour), looked up in a table instead of being
+worked out with strftime and isocalendar for every timestamp.
+
+An hour's row in the table is its offset in hours from EPOCH. The fields that
+only change from day to day are kept per day, both as a dictionary for each
+day and as one numpy array per field indexed by the offset in days, so that
+batches of hours can be looked up as arrays with lookup(). The table starts
+out empty and is extended, a year or more at a time, as later hours are asked
+for. Hours before EPOCH or more than MAX_DAYS after it are worked out
+directly.
+
+Timestamps are read as they are written: an aware timestamp's fields are
+those of its own time zone, not of UTC.
+'''
+import datetime
+import numpy
+import threading
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MAX_DAYS = 200 * 366
+GROWTH_DAYS = 366
+FIELDS = ['year', 'month', 'week', 'day', 'isoyear', 'isoweek', 'isoweekday',
+    'hour']
+DAY_FIELDS = FIELDS[:-1]
+DAY_MILLISECONDS = 24 * 60 * 60 * 1000
+
+def compute(timestamp):
+    """Works out the calendar fields of a timestamp without the table."""
+    isocalendar = timestamp.isocalendar()
+    return {
+        'year': timestamp.year,
+        'month': timestamp.month,
+        'week': int(timestamp.strftime("%W")),
+        'day': timestamp.day,
+        'isoyear': isocalendar[0],
+        'isoweek': isocalendar[1],
+        'isoweekday': isocalendar[2],
+        'hour': timestamp.hour
+    }
+
+def get_expressions(date):
+    '''
+    Returns the aggregation expressions working out each calendar field from
+    a date expression, such as '$timestamp', in the database. MongoDB only
+    has the ISO fields from 3.4 on and its $week counts weeks from Sundays,
+    so week, isoyear and isoweek are pieced together from the rest.
+    '''
+    # $dayOfWeek goes from 1 for Sunday to 7 for Saturday.
+    day_of_week = {'$dayOfWeek': date}
+    isoweekday = {'$add': [{'$mod': [{'$add': [day_of_week, 5]}, 7]}, 1]}
+    # Weeks start on the year's first Monday, which is the day after its
+    # first Sunday unless the year starts on a Monday.
+    starts_on_monday = {'$eq': [{'$mod': [{'$subtract': [
+        {'$add': [{'$dayOfYear': date}, 8]}, day_of_week]}, 7]}, 0]}
+    week = {'$add': [{'$week': date}, {'$cond': [starts_on_monday, 1, 0]},
+        {'$cond': [{'$eq': [day_of_week, 1]}, -1, 0]}]}
+    # An ISO week belongs to the year of its Thursday, and is the number of
+    # Thursdays up to that one, which is one more than the number of Sundays
+    # unless the year's first Sunday comes before its first Thursday.
+    thursday = {'$add': [date, {'$multiply': [{'$subtract': [4, isoweekday]},
+        DAY_MILLISECONDS]}]}
+    isoweek = {'$add': [{'$week': thursday}, {'$cond': [{'$gte': [{'$mod': [
+        {'$subtract': [{'$dayOfYear': thursday}, 1]}, 7]}, 4]}, 0, 1]}]}
+    return {
+        'year': {'$year': date},
+        'month': {'$month': date},
+        'week': week,
+        'day': {'$dayOfMonth': date},
+        'isoyear': {'$year': thursday},
+        'isoweek': isoweek,
+        'isoweekday': isoweekday,
+        'hour': {'$hour': date}
+    }
+
+class CalendarTable(object):
+    def __init__(self, epoch = EPOCH):
+        self.epoch = epoch
+        self.first_day = epoch.toordinal()
+        self.days = []
+        self.columns = {field: numpy.zeros(0, dtype = numpy.int32)
+            for field in DAY_FIELDS}
+        self._lock = threading.Lock()
+
+    def get_offset(self, timestamp):
+        """Returns the number of whole hours from the epoch to a timestamp."""
+        return (timestamp.toordinal() - self.first_day) * 24 + timestamp.hour
+
+    def get_timestamp(self, offset):
+        return self.epoch + datetime.timedelta(hours = offset)
+
+    def extend(self, days):
+        """Makes the table cover at least the given number of days."""
+        if len(self.days) >= days:
+            return
+
+        with self._lock:
+            covered = len(self.days)
+
+            if covered < days:
+                days = min(max(days, covered + GROWTH_DAYS), MAX_DAYS)
+                added = []
+
+                for day in range(covered, days):
+                    dimensions = compute(
+                        self.epoch + datetime.timedelta(days = day))
+                    del dimensions['hour']
+                    added.append(dimensions)
+
+                self.columns = {field: numpy.concatenate([self.columns[field],
+                    numpy.array([row[field] for row in added],
+                    dtype = numpy.int32)]) for field in DAY_FIELDS}
+                # Readers check the length of days first, so it is only
+                # extended once everything else covers the new days.
+                self.days = self.days + added
+
+    def get_days(self, timestamps):
+        """
+        Returns the day offsets of timestamps, or None if the table does not
+        cover them all.
+        """
+        days = [timestamp.toordinal() - self.first_day
+            for timestamp in timestamps]
+
+        if days and not (0 <= min(days) and max(days) < MAX_DAYS):
+            return None
+
+        self.extend(max(days) + 1 if days else 0)
+        return days
+
+    def lookup(self, offsets):
+        '''
+        Takes an array of hour offsets and returns a dictionary mapping each
+        field to an array of its values.
+        '''
+        offsets = numpy.asarray(offsets, dtype = numpy.int64)
+        days = offsets // 24
+        outside = (days < 0) | (days >= MAX_DAYS)
+
+        if outside.any():
+            days = numpy.where(outside, 0, days)
+
+        if len(days):
+            self.extend(int(days.max()) + 1)
+
+        columns = self.columns
+        looked_up = {field: columns[field][days] for field in DAY_FIELDS}
+        looked_up['hour'] = offsets % 24
+
+        for index in numpy.nonzero(outside)[0]:
+            dimensions = compute(self.get_timestamp(int(offsets[index])))
+
+            for field in DAY_FIELDS:
+                looked_up[field][index] = dimensions[field]
+
+        return looked_up
+
+    def get_dimensions(self, timestamp):
+        """Returns the calendar fields of one timestamp."""
+        day = timestamp.toordinal() - self.first_day
+
+        if not 0 <= day < MAX_DAYS:
+            return compute(timestamp)
+
+        self.extend(day + 1)
+        row = self.days[day].copy()
+        row['hour'] = timestamp.hour
+        return row
+
+    def get_many(self, timestamps):
+        """Returns the calendar fields of each of a list of timestamps."""
+        days = self.get_days(timestamps)
+
+        if days is None:
+            return [compute(timestamp) for timestamp in timestamps]
+
+        rows = self.days
+        dimensions = []
+
+        for day, timestamp in zip(days, timestamps):
+            row = rows[day].copy()
+            row['hour'] = timestamp.hour
+            dimensions.append(row)
+
+        return dimensions
+
+    def get_range(self, start, hours):
+        """Returns the calendar fields of the hours counted from start."""
+        first = self.get_offset(start)
+
+        if not (0 <= first and first + hours <= MAX_DAYS * 24):
+            return [compute(start + datetime.timedelta(hours = hour))
+                for hour in range(hours)]
+
+        self.extend((first + hours) // 24 + 1)
+        rows = self.days
+        dimensions = []
+
+        for offset in xrange(first, first + hours):
+            row = rows[offset // 24].copy()
+            row['hour'] = offset % 24
+            dimensions.append(row)
+
+        return dimensions
+
+
+TABLE = CalendarTable()
+
+def get_dimensions(timestamp):
+    return TABLE.get_dimensions(timestamp)
+
+def get_many(timestamps):
+    return TABLE.get_many(timestamps)
+
+def get_range(start, hours):
+    return TABLE.get_range(start, hours)
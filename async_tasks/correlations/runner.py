@@ -9,16 +9,17 @@ from celery import Celery
 def run_tasks():
     celery = Celery('bittrails_tasks', broker='amqp://guest@localhost//')
     
-    users = User.get_collection().find()
+    users = User.find(fields = ['_id'])
     
     for user in users:
-        uids = UID.get_collection().find({'user_id': ObjectId(user['_id'])})
+        uids = UID.find({'user_id': ObjectId(user['_id'])},
+            fields = ['uid', 'datastream'])
         
         if uids.count() > 0:
-            posts = LastPostRetrieved.get_collection().find({
+            posts = LastPostRetrieved.find({
                 '$or': [{'datastream': row['datastream'],
                          'uid': row['uid']} for row in uids]
-            })
+            }, fields = ['datastream'])
             available_datastreams = [post['datastream'] for post in posts]
             # Cycle through every class that inherits from CorrelationTask
             # in tasks.py, instantiate it, and run it.
@@ -1,6 +1,7 @@
 # TODO: Rewrite all of this to use paths instead of aspects.
 # Also have it discover streams automatically, to take advantage of custom
 # data streams.
+import db.scope
 import logging
 import numpy
 from correlations.correlationfinder import CorrelationFinder
@@ -35,10 +36,11 @@ class CorrelationTask(object):
         if set(self.required_aspects).issubset(self.available_datastreams):
             
             # Okay, now let's look for some correlations!
-            finder = CorrelationFinder(self.user, self.paths,
-                window_size = self.window_size, thresholds = self.thresholds,
-                use_cache = self.use_cache)
-            self.correlations = finder.get_correlations()
+            with db.scope.scope(self.__class__.__name__):
+                finder = CorrelationFinder(self.user, self.paths,
+                    window_size = self.window_size,
+                    thresholds = self.thresholds, use_cache = self.use_cache)
+                self.correlations = finder.get_correlations()
         
 class LastFmEnergyAndGoogleTasks(CorrelationTask):
 
@@ -0,0 +1,126 @@
+'''
+Moves the hourly TimeSeriesData documents written by ingestion into
+TimeSeriesDayBucket documents, for switching TIMESERIES_STORAGE to 'daily':
+
+    python -m async_tasks.datastreams.bucketize [--batch-size N] [--dry-run]
+
+Switch the setting first, so that nothing new is written hourly while the
+script runs. Documents are converted a batch at a time, in _id order, so the
+script can be stopped and started again. Each batch is first marked with a
+token of its own, then added to the buckets, which record the token so that
+it is only added once, and then deleted. A run interrupted along the way
+picks the marked documents up first and finishes moving them under their
+token. The tokens are cleared from the buckets once every batch is in.
+
+Custom datastream data and the filler rows the retired fill_zeroes job left
+behind stay hourly; TimeSeriesQuery reads both layouts.
+'''
+import argparse
+import logging
+import pymongo
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from db.models import bulk_write
+from ..models import TimeSeriesData, TimeSeriesDayBucket
+
+DEFAULT_BATCH_SIZE = 10000
+LOGGER = logging.getLogger(__name__)
+
+# Counts written by the ingestion handlers, as opposed to custom datastream
+# data (which has a client_id) and the old filler rows (which have no user).
+HOURLY_COUNTS = {'timestamp': {'$exists': True}, 'user_id': {'$ne': None},
+    'client_id': {'$exists': False}}
+# The field holding the token of the batch an hourly document is moved in.
+TOKEN = 'bucketize'
+FIELDS = ['user_id', 'parent_path', 'name', 'timestamp', 'value', TOKEN]
+
+def get_batch(last_id = None, batch_size = DEFAULT_BATCH_SIZE):
+    spec = dict(HOURLY_COUNTS)
+    
+    if last_id:
+        spec['_id'] = {'$gt': last_id}
+        
+    return list(TimeSeriesData.find(spec, fields = FIELDS,
+        sort = [('_id', pymongo.ASCENDING)], limit = batch_size))
+
+def get_interrupted():
+    '''
+    Returns the documents an interrupted run marked but did not get to
+    delete, by token.
+    '''
+    spec = dict(HOURLY_COUNTS)
+    spec[TOKEN] = {'$exists': True}
+    interrupted = OrderedDict()
+    
+    for document in TimeSeriesData.find(spec, fields = FIELDS,
+    sort = [('_id', pymongo.ASCENDING)]):
+        interrupted.setdefault(document[TOKEN], []).append(document)
+        
+    return interrupted
+
+def mark(batch, token):
+    collection = TimeSeriesData.get_collection()
+    bulk_write(collection, [document['_id'] for document in batch],
+        lambda bulk, _id: bulk.find({'_id': _id, TOKEN: {'$exists': False}}
+            ).update_one({'$set': {TOKEN: token}}))
+    
+def move(batch, token):
+    '''
+    Adds a batch marked with token to the buckets, unless they have it
+    already, and deletes it.
+    '''
+    counts = OrderedDict()
+    
+    for document in batch:
+        key = (document['user_id'], document.get('parent_path'),
+            document['name'], document['timestamp'])
+        counts[key] = counts.get(key, 0) + (document.get('value') or 0)
+        
+    TimeSeriesDayBucket.increment_many(counts, token = token)
+    bulk_write(TimeSeriesData.get_collection(),
+        [document['_id'] for document in batch],
+        lambda bulk, _id: bulk.find({'_id': _id}).remove_one())
+
+def bucketize(batch_size = DEFAULT_BATCH_SIZE, dry_run = False):
+    """Converts every hourly count. Returns the number of documents moved."""
+    converted = 0
+    
+    if not dry_run:
+        for token, batch in get_interrupted().items():
+            move(batch, token)
+            converted += len(batch)
+            LOGGER.info("%s interrupted hourly documents moved." % len(batch))
+            
+    batch = get_batch(batch_size = batch_size)
+    
+    while batch:
+        if not dry_run:
+            token = ObjectId()
+            mark(batch, token)
+            move(batch, token)
+            
+        converted += len(batch)
+        LOGGER.info("%s hourly documents %s so far." % (
+            converted, 'found' if dry_run else 'moved'))
+        batch = get_batch(batch[-1]['_id'], batch_size)
+        
+    if not dry_run:
+        TimeSeriesDayBucket.clear_tokens()
+        
+    return converted
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description = 'Move hourly time series counts into day buckets.')
+    parser.add_argument('--batch-size', dest = 'batch_size', type = int,
+        default = DEFAULT_BATCH_SIZE, help = 'documents to convert at a time')
+    parser.add_argument('--dry-run', dest = 'dry_run', action = 'store_const',
+        const = True, default = False,
+        help = 'only count the documents that would be moved')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    args = get_args()
+    print "%s hourly documents %s." % (bucketize(args.batch_size,
+        args.dry_run), 'to move' if args.dry_run else 'moved into day buckets')
@@ -0,0 +1,188 @@
+'''
+Folds the hours of time series older than the retention policy into their
+day rollups and deletes them:
+
+    python -m async_tasks.datastreams.compact [--days N] [--batch-size N]
+        [--dry-run]
+
+Hours from before midnight (UTC) N days ago, N being the
+TIMESERIES_COMPACTION_DAYS setting unless --days is given, are compacted in
+three steps, each of which can be run again, so an interrupted run can simply
+be restarted:
+
+  1. The rollup of each day of each series is set to the sum of the day's
+     hourly documents and day bucket, and the coarser rollups are moved by
+     the same difference. Days already behind the previous horizon are left
+     alone: their rollups were exact when they were compacted and have been
+     counted into ever since.
+  2. The CompactionHorizon is moved up to the cutoff. From then on
+     TimeSeriesQuery reads the days before it from the day rollups.
+  3. The hourly documents and day buckets before the cutoff are deleted, a
+     batch at a time.
+
+Custom datastream data is summed into the rollups but kept, since its
+streams can rewrite any hour. Counts written for hours before the cutoff
+while a series is being summed up could be lost, so avoid running this
+during a backfill.
+'''
+import app as platform
+import argparse
+import datetime
+import logging
+from collections import OrderedDict
+from db.models import bulk_write
+from .rollup import USER_DATA, get_batches
+from ..models import (TimeSeriesData, TimeSeriesDayBucket, TimeSeriesRollup,
+    CompactionHorizon, get_number)
+
+DEFAULT_BATCH_SIZE = 10000
+LOGGER = logging.getLogger(__name__)
+
+def get_policy():
+    """Returns how many days of hours to keep, or None to keep them all."""
+    return platform.get_setting('TIMESERIES_COMPACTION_DAYS')
+
+def get_cutoff(days, now = None):
+    return TimeSeriesDayBucket.get_date(now or datetime.datetime.utcnow()
+        ) - datetime.timedelta(days = days)
+
+def get_series(cutoff):
+    """Returns the (user_id, parent_path, name) of each series to compact."""
+    series = set()
+    group = {'$group': {'_id': {'user_id': '$user_id',
+        'parent_path': '$parent_path', 'name': '$name'}}}
+
+    for model_class, spec in [
+    (TimeSeriesData, dict(USER_DATA, timestamp = {'$lt': cutoff})),
+    (TimeSeriesDayBucket, {'date': {'$lt': cutoff}})]:
+        series.update((row['_id'].get('user_id'),
+            row['_id'].get('parent_path'), row['_id'].get('name'))
+            for row in model_class.aggregate([{'$match': spec}, group]))
+
+    return sorted(series)
+
+def get_specs(key, cutoff):
+    user_id, parent_path, name = key
+    spec = {'user_id': user_id, 'parent_path': parent_path, 'name': name}
+    return (dict(spec, timestamp = {'$lt': cutoff}),
+        dict(spec, date = {'$lt': cutoff}))
+
+def sum_days(key, cutoff, horizon = None, batch_size = DEFAULT_BATCH_SIZE):
+    """Sums up a series' hours by day, from the horizon up to the cutoff."""
+    hourly, daily = get_specs(key, cutoff)
+    days = OrderedDict()
+
+    if horizon:
+        hourly['timestamp']['$gte'] = horizon
+        daily['date']['$gte'] = horizon
+
+    for batch in get_batches(TimeSeriesData, hourly, ['timestamp', 'value'],
+    batch_size):
+        for document in batch:
+            day = TimeSeriesDayBucket.get_date(document['timestamp'])
+            days[day] = days.get(day, 0) + get_number(document.get('value'))
+
+    for batch in get_batches(TimeSeriesDayBucket, daily, ['date', 'value'],
+    batch_size):
+        for bucket in batch:
+            days[bucket['date']] = days.get(bucket['date'], 0) + (
+                bucket.get('value') or 0)
+
+    return days
+
+def set_day_rollups(key, days, batch_size = DEFAULT_BATCH_SIZE):
+    '''
+    Sets the day rollups of a series to the given sums, and moves its
+    coarser rollups by the difference.
+    '''
+    user_id, parent_path, name = key
+    previous = {rollup['start']: rollup.get('value') or 0
+        for rollup in TimeSeriesRollup.find({'user_id': user_id,
+            'parent_path': parent_path, 'name': name, 'period': 'day',
+            'start': {'$in': days.keys()}}, fields = ['start', 'value'])}
+    changes = OrderedDict(((user_id, parent_path, name, day),
+        value - previous.get(day, 0)) for day, value in days.items()
+        if value != previous.get(day, 0))
+
+    def add_set(bulk, item):
+        day, value = item
+        bulk.find(TimeSeriesRollup.get_key(user_id, parent_path, name, 'day',
+            day)).upsert().update_one({'$set': {'value': value},
+            '$setOnInsert': TimeSeriesRollup.get_dimensions('day', day)})
+
+    bulk_write(TimeSeriesRollup.get_collection(), days.items(), add_set,
+        batch_size)
+    TimeSeriesRollup.increment_many(changes, batch_size,
+        periods = [period for period in TimeSeriesRollup.periods
+            if period != 'day'])
+
+def delete_hours(key, cutoff, batch_size = DEFAULT_BATCH_SIZE,
+dry_run = False):
+    """Deletes a series' hours before the cutoff, returning how many."""
+    hourly, daily = get_specs(key, cutoff)
+    hourly['client_id'] = {'$exists': False}
+    deleted = 0
+
+    for model_class, spec in [(TimeSeriesData, hourly),
+    (TimeSeriesDayBucket, daily)]:
+        for batch in get_batches(model_class, spec, ['_id'], batch_size):
+            if not dry_run:
+                bulk_write(model_class.get_collection(),
+                    [document['_id'] for document in batch],
+                    lambda bulk, _id: bulk.find({'_id': _id}).remove_one())
+
+            deleted += len(batch)
+
+    return deleted
+
+def compact(days = None, batch_size = DEFAULT_BATCH_SIZE, dry_run = False,
+now = None):
+    '''
+    Compacts the hours older than days days (the retention policy by
+    default). Returns the number of hourly documents and day buckets deleted.
+    '''
+    days = days if days is not None else get_policy()
+
+    if days is None:
+        raise ValueError("No retention policy: set TIMESERIES_COMPACTION_DAYS "
+            "or give the number of days to keep.")
+
+    horizon = CompactionHorizon.get_horizon()
+    # Hours that are already compacted cannot be brought back.
+    cutoff = max(get_cutoff(days, now), horizon or datetime.datetime.min)
+    series = get_series(cutoff)
+    LOGGER.info("Compacting %s series up to %s." % (len(series), cutoff))
+
+    if not dry_run:
+        for key in series:
+            set_day_rollups(key, sum_days(key, cutoff, horizon, batch_size),
+                batch_size)
+
+        CompactionHorizon.set_horizon(cutoff)
+
+    deleted = 0
+
+    for key in series:
+        deleted += delete_hours(key, cutoff, batch_size, dry_run)
+        LOGGER.info("%s documents %s so far." % (deleted,
+            'found' if dry_run else 'deleted'))
+
+    return deleted
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description = 'Fold old time series hours into day rollups.')
+    parser.add_argument('--days', dest = 'days', type = int, default = None,
+        help = 'days of hours to keep (TIMESERIES_COMPACTION_DAYS by default)')
+    parser.add_argument('--batch-size', dest = 'batch_size', type = int,
+        default = DEFAULT_BATCH_SIZE, help = 'documents to delete at a time')
+    parser.add_argument('--dry-run', dest = 'dry_run', action = 'store_const',
+        const = True, default = False,
+        help = 'only count the documents that would be deleted')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    args = get_args()
+    print "%s documents %s." % (compact(args.days, args.batch_size,
+        args.dry_run), 'to compact' if args.dry_run else 'compacted')
@@ -1,39 +1,93 @@
 import ast
 import datetime
+import db.asynchronous
 import iso8601
 import logging
+from collections import OrderedDict
 from pyechonest import song as pyechonest_song
 from pyechonest.util import EchoNestAPIError
 
 from settings import ECHO_NEST_ID_LIMIT
 from email.utils import parsedate_tz
-from ..models import TimeSeriesData, TimeSeriesPath, CustomTimeSeriesData
+from ..models import (TimeSeriesData, TimeSeriesPath, CustomTimeSeriesData,
+    TimeSeriesCounter, TimeSeriesRollup, DataVersion, get_number, utc_naive)
 from oauth_provider.models import User
 
 
 class CSVHandler(object):
     model_class = CustomTimeSeriesData
+    key_fields = ['user_id', 'client_id', 'parent_path', 'name', 'timestamp']
     
     def __init__(self, stream, logger = None):    
         self.stream = stream
         self.logger = logger if logger else logging.getLogger(__name__)
+        self.data = OrderedDict()
         
     def handle(self, row):
-            datum = self.model_class.find_or_create(
-                user_id = self.stream['user_id'],
-                client_id = self.stream['client_id'],
-                parent_path = (self.stream.get('parent_path', '')
-                    + self.stream['name'] + "/"),
-                timestamp = self.get_datetime(row)
-            )
-            datum.value = ast.literal_eval(row['value'])
-            datum.save()
+        datum = self.model_class(
+            user_id = self.stream['user_id'],
+            client_id = self.stream['client_id'],
+            parent_path = (self.stream.get('parent_path', '')
+                + self.stream['name'] + "/"),
+            timestamp = self.get_datetime(row),
+            value = ast.literal_eval(row['value'])
+        )
+        
+        # Later rows for the same hour replace earlier ones.
+        self.data[datum.timestamp] = datum
         
     def get_datetime(self, row):
         return iso8601.parse_date(row['date'])
         
     def finalize(self):
-        pass
+        previous = self.get_previous_values()
+        
+        # Some of the rows may have been written when the upsert fails.
+        try:
+            report = self.model_class.bulk_upsert(
+                self.data.values(), self.key_fields)
+            self.update_rollups(previous)
+        finally:
+            DataVersion.bump((datum.user_id, datum.parent_path)
+                for datum in self.data.values())
+            
+        self.data = OrderedDict()
+        
+        if report.errors:
+            self.logger.error("%s errors saving custom datastream %s: %s" % (
+                len(report.errors), self.stream.get('_id'), report))
+        
+        return report
+        
+    def get_previous_values(self):
+        """Returns the stored values of the rows about to be written."""
+        if not self.data:
+            return {}
+            
+        datum = self.data.values()[0]
+        key = {field: datum.get(field) for field in self.key_fields}
+        key['timestamp'] = {'$in': self.data.keys()}
+        
+        return {document['timestamp']: document.get('value')
+            for document in self.model_class.find(
+                key, fields = ['timestamp', 'value'])}
+        
+    def update_rollups(self, previous):
+        '''
+        Rows replace the stored values rather than adding to them, so the
+        rollups are moved by the difference between the two.
+        '''
+        counts = OrderedDict()
+        
+        for timestamp, datum in self.data.items():
+            change = get_number(datum.value) - get_number(
+                previous.get(utc_naive(timestamp)))
+            
+            if change:
+                counts[(datum.user_id, datum.parent_path, datum.name,
+                    timestamp)] = change
+                
+        return TimeSeriesRollup.increment_many(counts)
     
 
 class TimeSeriesHandler(object):
@@ -57,35 +111,35 @@ class TimeSeriesHandler(object):
                     name = path_parts[i]).save()
                 
                 parent_path = parent_path + '/'.join(path_parts[0:i+1]) + '/'
-        
-    
-    def get_accumulator_key(self, timestamp):
-        return timestamp.strftime('%Y-%m-%d %H')
 
 
 class TotalHandler(TimeSeriesHandler):
     path = 'posts'
+    # Once this many datapoints have piled up, they are written in the
+    # background while the iterator goes on fetching posts.
+    flush_size = 5000
     
     def __init__(self, *args, **kwargs):
-        self.totals = {}
+        self.totals = TimeSeriesCounter(self.model_class)
+        self.pending_writes = []
         super(TotalHandler, self).__init__(*args, **kwargs)
         
     def handle(self, post):
-        timestamp = self.get_datetime(post)
-        total_key = self.get_accumulator_key(timestamp)
-        
-        if total_key not in self.totals:
-            self.totals[total_key] = self.model_class.find_or_create(
-                user_id = self.user['_id'],
-                parent_path = self.path + "/",
-                timestamp = timestamp
-            )
-            
-        self.totals[total_key].value += 1
+        self.totals.add(self.user['_id'], self.path + "/",
+            self.get_datetime(post))
+        
+        if len(self.totals) >= self.flush_size:
+            self.pending_writes.append(self.totals.aflush())
 
     def finalize(self):
-        for total in self.totals.values():
-            total.save()
+        # Whatever did get written is seen by the cached queries even if a
+        # write failed. flush() first waits for the background writes.
+        try:
+            self.totals.flush()
+            pending, self.pending_writes = self.pending_writes, []
+            db.asynchronous.gather(pending)
+        finally:
+            self.totals.bump_versions()
     
     
 class TwitterTweet(TotalHandler):
@@ -186,7 +240,6 @@ class LastfmScrobbleEchonest(LastfmScrobble):
             
     def finalize(self):
         energy_lookup = {}
-        energy_objs = {}
         
         songs = self.get_songs(self.song_ids)
         
@@ -198,35 +251,19 @@ class LastfmScrobbleEchonest(LastfmScrobble):
                 
             energy_lookup[artist][song.title] = song.audio_summary['energy']
             
-        # Go through the scrobbles we summarized earlier and create objects
-        # containing the totals for all the song energies we looked up.
+        # Go through the scrobbles we summarized earlier and add up the totals
+        # for all the song energies we looked up.
         for scrobble in self.scrobbles:
-            energy_key = self.get_accumulator_key(scrobble['datetime'])
-            
-            if energy_key not in energy_objs:
-                energy_objs[energy_key] = {
-                    'energy/totals':
-                        self.model_class.find_or_create(
-                        user_id = self.user['_id'],
-                        parent_path = self.path + "/energy/",
-                        timestamp = scrobble['datetime']),
-                    'totals':
-                        self.model_class.find_or_create(
-                        user_id = self.user['_id'],
-                        parent_path = self.path + "/",
-                        timestamp = scrobble['datetime'])
-                }
-            
             # Unfortunately Echo Nest doesn't know about all the songs a
             # user may scrobble. Make sure we have the energy for the song
             # before we go trying to add it to our numerator.
             if (scrobble['artist'] in energy_lookup
             and scrobble['track'] in energy_lookup[scrobble['artist']]):
-                energy_objs[energy_key]['energy/totals'].value += (
+                self.totals.add(self.user['_id'], self.path + "/energy/",
+                    scrobble['datetime'],
                     energy_lookup[scrobble['artist']][scrobble['track']])
-                energy_objs[energy_key]['totals'].value += 1
+                self.totals.add(self.user['_id'], self.path + "/",
+                    scrobble['datetime'])
                 
         # Save all the totals.
-        for energy_obj in energy_objs.values():
-            energy_obj['energy/totals'].save()
-            energy_obj['totals'].save()
+        super(LastfmScrobbleEchonest, self).finalize()
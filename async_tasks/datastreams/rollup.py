@@ -0,0 +1,103 @@
+'''
+Rebuilds the TimeSeriesRollup documents from the hourly documents and day
+buckets, for turning TIMESERIES_ROLLUPS on for a database that already holds
+data, or for repairing the rollups:
+
+    python -m async_tasks.datastreams.rollup [--batch-size N]
+
+The rollups are dropped and summed up again from scratch, so stop the task
+runners while this runs; anything they write in the meantime could be
+counted twice or not at all. Once async_tasks.datastreams.compact has run,
+the day rollups from before its horizon are all that is left of those days,
+so they are kept, and the coarser rollups are summed up again from them.
+'''
+import argparse
+import logging
+import pymongo
+from collections import OrderedDict
+from ..models import (TimeSeriesData, TimeSeriesDayBucket, TimeSeriesRollup,
+    CompactionHorizon)
+
+DEFAULT_BATCH_SIZE = 10000
+LOGGER = logging.getLogger(__name__)
+
+# Every user's data, but not the filler rows the retired fill_zeroes job
+# left behind.
+USER_DATA = {'timestamp': {'$exists': True}, 'user_id': {'$ne': None}}
+
+def get_batches(model_class, spec, fields, batch_size = DEFAULT_BATCH_SIZE):
+    """Yields the documents matching spec in lists, in _id order."""
+    spec = dict(spec)
+    batch = True
+    
+    while batch:
+        batch = list(model_class.find(spec, fields = fields,
+            sort = [('_id', pymongo.ASCENDING)], limit = batch_size))
+        
+        if batch:
+            spec['_id'] = {'$gt': batch[-1]['_id']}
+            yield batch
+
+def get_counts(documents):
+    counts = OrderedDict()
+    
+    for document in documents:
+        key = (document['user_id'], document.get('parent_path'),
+            document['name'], document['timestamp'])
+        counts[key] = counts.get(key, 0) + (document.get('value') or 0)
+        
+    return counts
+
+def rebuild(batch_size = DEFAULT_BATCH_SIZE):
+    """Rebuilds the rollups. Returns the number of documents summed up."""
+    horizon = CompactionHorizon.get_horizon()
+    hourly = dict(USER_DATA)
+    daily = {}
+    summed = 0
+    
+    if horizon:
+        TimeSeriesRollup.get_collection().remove({'$or': [
+            {'period': {'$ne': 'day'}}, {'start': {'$gte': horizon}}]})
+        hourly['timestamp'] = {'$gte': horizon}
+        daily['date'] = {'$gte': horizon}
+        
+        for batch in get_batches(TimeSeriesRollup, {'period': 'day'},
+        ['user_id', 'parent_path', 'name', 'start', 'value'], batch_size):
+            TimeSeriesRollup.increment_many(OrderedDict(((rollup['user_id'],
+                rollup.get('parent_path'), rollup['name'], rollup['start']),
+                rollup.get('value') or 0) for rollup in batch),
+                periods = [period for period in TimeSeriesRollup.periods
+                    if period != 'day'])
+            summed += len(batch)
+            LOGGER.info("%s compacted days summed up so far." % summed)
+    else:
+        TimeSeriesRollup.get_collection().remove({})
+        
+    for batch in get_batches(TimeSeriesData, hourly,
+    ['user_id', 'parent_path', 'name', 'timestamp', 'value'], batch_size):
+        TimeSeriesRollup.increment_many(get_counts(
+            document for document in batch
+            if isinstance(document.get('value'), (int, long, float))))
+        summed += len(batch)
+        LOGGER.info("%s hourly documents summed up so far." % summed)
+        
+    for batch in get_batches(TimeSeriesDayBucket, daily, None, batch_size):
+        TimeSeriesRollup.increment_many(get_counts(document
+            for bucket in batch
+            for document in TimeSeriesDayBucket.get_hours(bucket)))
+        summed += len(batch)
+        LOGGER.info("%s documents summed up so far." % summed)
+        
+    return summed
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description = 'Rebuild the time series rollups.')
+    parser.add_argument('--batch-size', dest = 'batch_size', type = int,
+        default = DEFAULT_BATCH_SIZE, help = 'documents to read at a time')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    print "Rebuilt the rollups from %s documents." % rebuild(
+        get_args().batch_size)
@@ -1,4 +1,5 @@
 from pyechonest import config
+import db.asynchronous
 from bson import ObjectId
 from tasks import TwitterTasks, LastfmTasks, GoogleTasks, CSVDatastreamTasks
 from oauth_provider.models import User, UID
@@ -12,10 +13,17 @@ def run_tasks(APIS):
     csvDatastreamTasks = CSVDatastreamTasks()
     celery = Celery('bittrails_tasks', broker='amqp://guest@localhost//')
     tasks = { 'twitter': TwitterTasks, 'lastfm': LastfmTasks, 'google': GoogleTasks }
-    users = User.get_collection().find()
+    # The tasks only need the user's ID and the tokens to query the APIs with,
+    # plus the refresh tokens to renew expired Google tokens.
+    users = User.find(fields = ['external_tokens', 'refresh_tokens'])
         
     for user in users:
-        uids = UID.get_collection().find({'user_id': ObjectId(user['_id'])})
+        # Start fetching the user's custom datastreams while the API tasks run.
+        custom_streams = db.asynchronous.submit(
+            CustomTimeSeriesPath.find_paths,
+            {'url': {'$exists': True}, 'user_id': ObjectId(user['_id'])})
+        uids = UID.find({'user_id': ObjectId(user['_id'])},
+            fields = ['uid', 'datastream'])
         
         for uid in uids:
             if uid['datastream'] in tasks:
@@ -24,9 +32,6 @@ def run_tasks(APIS):
                 task.run()
                 
         # Custom datastreams
-        custom_streams = CustomTimeSeriesPath.find(
-            {'url': {'$exists': True}, 'user_id': ObjectId(user['_id'])})
-        
-        for stream in custom_streams:
+        for stream in custom_streams.result():
             csvDatastreamTasks.run(stream)
             
@@ -0,0 +1,39 @@
+'''
+Moves the TimeSeriesPath documents out of the timeseries collection, where
+they used to be kept along with the datapoints, into timeseries_paths:
+
+    python -m async_tasks.datastreams.split_paths [--batch-size N] [--dry-run]
+
+This runs the split_paths migration in db.migrations, which python . --migrate
+also runs, so see db/migrations/m0001_split_paths.py. It can run while
+everything else does, and be stopped and started again. Until it has
+finished, paths that are not in timeseries_paths are also looked for in
+timeseries, and those are saved into timeseries_paths (with the same _id)
+whenever they are saved again.
+'''
+import argparse
+import db.migrations
+import logging
+from db.migrations.m0001_split_paths import migration
+
+DEFAULT_BATCH_SIZE = 1000
+
+def split_paths(batch_size = DEFAULT_BATCH_SIZE, dry_run = False):
+    """Moves every legacy path. Returns the number of documents moved."""
+    return db.migrations.run(migration, batch_size, dry_run = dry_run)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description = 'Move the time series paths into their own collection.')
+    parser.add_argument('--batch-size', dest = 'batch_size', type = int,
+        default = DEFAULT_BATCH_SIZE, help = 'paths to move at a time')
+    parser.add_argument('--dry-run', dest = 'dry_run', action = 'store_const',
+        const = True, default = False,
+        help = 'only count the paths that would be moved')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    args = get_args()
+    print "%s paths %s." % (split_paths(args.batch_size, args.dry_run),
+        'to move' if args.dry_run else 'moved')
@@ -1,4 +1,6 @@
 import csv
+import db.asynchronous
+import db.scope
 import urllib2
 import string
 import json
@@ -7,6 +9,7 @@ import pytz
 import datetime
 from db.models import Model, mongodb_init
 from oauth_provider.models import User
+from .. import snapshots
 from ..models import LastPostRetrieved, LastCustomDataPull
 from handlers import (TwitterTweet, LastfmScrobble,
     GoogleCompletedTask, LastfmScrobbleEchonest, CSVHandler)
@@ -25,6 +28,11 @@ class Tasks(object):
             ) for handler_class in self.handler_classes]
     
     def run(self):
+        with db.scope.scope('%s tasks for user %s' % (
+        self.datastream_name, self.user['_id'])):
+            self._run()
+            
+    def _run(self):
         last_post = LastPostRetrieved.find_or_create(
             uid = self.uid, datastream = self.datastream_name)
         
@@ -51,10 +59,13 @@ class Tasks(object):
             
         finally:
             # No matter what, we want to finalize all of the handlers and then
-            # save the last post position successfully processed.
+            # save the last post position successfully processed. The handlers
+            # are finalized side by side, since some of them have API requests
+            # of their own to make before they write. They wait for their
+            # background writes, so they are not run on the db pool itself.
             try:
-                for handler in self.handlers:
-                    handler.finalize()
+                db.asynchronous.gather(db.asynchronous.spawn(handler.finalize)
+                    for handler in self.handlers)
                 last_post.save()
             
             except:
@@ -64,6 +75,15 @@ class Tasks(object):
                     ("Exception while finalizing %s task handlers "
                     + "for user %s. Last post: %s\n") % (self.datastream_name,
                         self.user['_id'], last_post.post_id))
+                
+        # Bring the user's snapshots of this datastream up to the new data.
+        try:
+            snapshots.export(self.user['_id'],
+                prefix = self.datastream_name + '/')
+        except:
+            self.logger.exception(
+                "Exception while exporting %s snapshots for user %s.\n"
+                    % (self.datastream_name, self.user['_id']))
         
     @property
     def iterator_class(self):
@@ -104,6 +124,10 @@ class CSVDatastreamTasks(object):
         self.logger = logger if logger else logging.getLogger(__name__)
         
     def run(self, stream):
+        with db.scope.scope('custom datastream %s' % stream.get('_id')):
+            self._run(stream)
+            
+    def _run(self, stream):
         handler = CSVHandler(stream)
         
         try:
@@ -115,13 +139,16 @@ class CSVDatastreamTasks(object):
                 handler.handle(post)
                 
             csv_file.close()
+            finalizing = db.asynchronous.spawn(handler.finalize)
             
-            # Update the "last pulled" timestamp.
+            # Update the "last pulled" timestamp once the data is saved.
             last_pull = LastCustomDataPull.find_or_create(
                 path = stream.get('parent_path', '') + stream['name'] + '/',
                 user_id = stream['user_id'])
+            finalizing.result()
             last_pull.last_pulled = datetime.datetime.now(pytz.utc)
             last_pull.save()
+            snapshots.export(stream['user_id'], [last_pull.path])
             
         except Exception as e:
             # If there was an exception, log it.
@@ -1,10 +1,36 @@
 import unittest
+import app
+import bson.json_util
 import datetime
+import db
+import db.migrations
+import numpy
+import pytz
+import shutil
+import tempfile
+import time
+from async_tasks import (calendar_table, local_engine, query_cache,
+    snapshots)
 from auth.mocks import APIS
 from bson import ObjectId
+from db.backends import create_backend
+from db.models import bulk_write
+from db.testing import MemoryBackendTestCase
+from db.migrations import m0002_compact_keys
+from async_tasks.datastreams import bucketize as bucketize_module
+from async_tasks.datastreams.bucketize import bucketize
+from async_tasks.datastreams.compact import compact
+from async_tasks.datastreams.rollup import rebuild
+from async_tasks.datastreams.split_paths import split_paths
 from async_tasks.datastreams.iterators import TwitterPosts
-from async_tasks.datastreams.handlers import TwitterTweet
-from oauth_provider.models import User
+from async_tasks.datastreams.handlers import TwitterTweet, CSVHandler
+from async_tasks.helper_classes import (TimeSeriesQuery, RollupSource,
+    SnapshotSource, UserTimeSeriesQuery)
+from async_tasks.models import (TimeSeriesCounter, TimeSeriesData,
+    TimeSeriesDayBucket, TimeSeriesRollup, LastPostRetrieved,
+    CompactionHorizon, TimeSeriesPath, CustomTimeSeriesPath,
+    CustomTimeSeriesData, TimeSeriesPathTree, DataVersion)
+from oauth_provider.models import User, UID
 
 class TestPosts(object):
     def test_more_than_zero(self):
@@ -103,3 +129,927 @@ class TestTwitterPostCounter(unittest.TestCase):
                 self.given_posts()
             )
         )
+
+
+class TestTimeSeriesCounter(unittest.TestCase):
+    def setUp(self):
+        self.user_id = ObjectId('50e3da15ab0ddcff7dd3c187')
+        
+    def test_increments_share_an_hour(self):
+        self.should_have_counts({
+            (self.user_id, 'posts/', 'totals',
+                datetime.datetime(2013, 3, 11, 10)): 3,
+            (self.user_id, 'posts/', 'totals',
+                datetime.datetime(2013, 3, 11, 11)): 1.5},
+            self.when_adding([
+                (datetime.datetime(2013, 3, 11, 10, 5), 1),
+                (datetime.datetime(2013, 3, 11, 10, 59, 59), 2),
+                (datetime.datetime(2013, 3, 11, 11, 0), 1.5)],
+            self.given_a_counter()))
+            
+    def test_background_flushes_write_one_at_a_time(self):
+        running = []
+        overlapping = []
+        
+        class SlowData(object):
+            simplify_timestamp = staticmethod(lambda timestamp: timestamp)
+            
+            @staticmethod
+            def increment_many(counts):
+                overlapping.append(bool(running))
+                running.append(counts)
+                time.sleep(0.01)
+                running.remove(counts)
+                
+        counter = TimeSeriesCounter(SlowData)
+        
+        for hour in range(4):
+            counter.add(self.user_id, 'posts/',
+                datetime.datetime(2013, 3, 11, hour))
+            counter.aflush()
+            
+        counter.flush()
+        self.assertEqual(overlapping, [False] * 5)
+        
+    def given_a_counter(self):
+        return TimeSeriesCounter()
+        
+    def when_adding(self, increments, counter):
+        for timestamp, amount in increments:
+            counter.add(self.user_id, 'posts/', timestamp, amount)
+        return counter
+        
+    def should_have_counts(self, counts, counter):
+        self.assertEqual(dict(counter.counts), counts)
+
+
+class TestDayBuckets(MemoryBackendTestCase):
+    settings = ('TIMESERIES_STORAGE',)
+    
+    def setUp(self):
+        super(TestDayBuckets, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        
+    def test_buckets_answer_like_hours(self):
+        hourly = self.when_queried(self.given_counts('hourly'))
+        db.set_backend(create_backend('memory'))
+        self.assertEqual(hourly, self.when_queried(self.given_counts('daily')))
+        
+    def test_bucketize(self):
+        self.given_counts('hourly')
+        hourly = self.when_queried()
+        app.app.config['TIMESERIES_STORAGE'] = 'daily'
+        
+        self.assertEqual(bucketize(batch_size = 5), 18)
+        self.assertEqual(TimeSeriesDayBucket.find().count(), 6)
+        self.assertEqual(hourly, self.when_queried())
+        
+    def test_bucketize_finishes_interrupted_batches(self):
+        self.given_counts('hourly')
+        hourly = self.when_queried()
+        app.app.config['TIMESERIES_STORAGE'] = 'daily'
+        batch = bucketize_module.get_batch(batch_size = 5)
+        token = ObjectId()
+        bucketize_module.mark(batch, token)
+        
+        def interrupt(*args):
+            raise KeyboardInterrupt
+        
+        # Stopped once the batch is in the buckets, before it is deleted.
+        bucketize_module.bulk_write = interrupt
+        
+        try:
+            self.assertRaises(KeyboardInterrupt, bucketize_module.move,
+                batch, token)
+        finally:
+            bucketize_module.bulk_write = bulk_write
+            
+        self.assertEqual(bucketize(batch_size = 5), 18)
+        self.assertEqual(hourly, self.when_queried())
+        self.assertEqual(TimeSeriesDayBucket.find(
+            {'tokens': {'$exists': True}}).count(), 0)
+        
+    def given_counts(self, storage):
+        app.app.config['TIMESERIES_STORAGE'] = storage
+        counter = TimeSeriesCounter()
+        
+        for hour in range(0, 72, 8):
+            timestamp = datetime.datetime(2013, 3, 10) + datetime.timedelta(
+                hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, hour % 3 + 1)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp,
+                hour % 2 + 1)
+            
+        counter.flush()
+        
+    def when_queried(self, *args):
+        within = {'min_date': datetime.datetime(2013, 3, 10, 12),
+            'max_date': datetime.datetime(2013, 3, 12, 12)}
+        return [getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            sort = [(field, 1) for field in group_by], group_by = group_by,
+            **kwargs), method)()
+            for method in ['totals', 'averages']
+            for group_by in [['day'], ['day', 'hour']]
+            for kwargs in [{}, within]]
+
+
+class TestRollups(MemoryBackendTestCase):
+    settings = ('TIMESERIES_ROLLUPS',)
+    
+    def setUp(self):
+        super(TestRollups, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        
+    def test_coarsest_period(self):
+        self.assertEqual(TimeSeriesRollup.find_period(['year', 'month']),
+            'month')
+        self.assertEqual(TimeSeriesRollup.find_period(['isoweek']), 'isoweek')
+        self.assertEqual(TimeSeriesRollup.find_period(['hour']), None)
+        
+    def test_period_must_line_up_with_dates(self):
+        self.assertEqual(TimeSeriesRollup.find_period(['year', 'month'],
+            min_date = datetime.datetime(2013, 3, 10)), 'day')
+        self.assertEqual(TimeSeriesRollup.find_period(['year', 'month'],
+            min_date = datetime.datetime(2013, 3, 10, 12)), None)
+        
+    def test_planner_picks_rollup(self):
+        app.app.config['TIMESERIES_ROLLUPS'] = True
+        sources = TimeSeriesQuery(self.user, 'posts/likes/',
+            group_by = ['year', 'month']).get_sources(
+            {'year': '$year', 'month': '$month'})
+        self.assertEqual([(type(source), source.period) for source in sources],
+            [(RollupSource, 'month')])
+        
+    def test_custom_data_moves_rollups_by_the_change(self):
+        stream = {'user_id': self.user['_id'], 'client_id': ObjectId(),
+            'name': 'weight'}
+        
+        for value in ['70', '72']:
+            handler = CSVHandler(stream)
+            handler.handle({'date': '2013-03-10T10:00:00Z', 'value': value})
+            handler.finalize()
+            
+        self.assertEqual(TimeSeriesRollup.find_one(
+            {'period': 'year'})['value'], 72)
+        
+    def test_rollups_answer_like_hours(self):
+        self.given_counts()
+        hours = self.when_queried(False)
+        self.assertEqual(hours, self.when_queried(True))
+        
+    def test_rebuild(self):
+        self.given_counts()
+        rollups = TimeSeriesRollup.find().count()
+        
+        self.assertEqual(rebuild(batch_size = 4), 20)
+        self.assertEqual(TimeSeriesRollup.find().count(), rollups)
+        self.assertEqual(self.when_queried(False), self.when_queried(True))
+        
+    def given_counts(self):
+        counter = TimeSeriesCounter()
+        
+        for day in range(0, 60, 6):
+            timestamp = datetime.datetime(2013, 3, 1, 5) + datetime.timedelta(
+                days = day)
+            counter.add(self.user['_id'], 'posts/', timestamp, 2)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, day % 4)
+            
+        counter.flush()
+        
+    def when_queried(self, rollups):
+        app.app.config['TIMESERIES_ROLLUPS'] = rollups
+        return [getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            sort = [(field, 1) for field in group_by], group_by = group_by,
+            **kwargs), method)()
+            for method in ['totals', 'averages']
+            for group_by in [['year', 'month'], ['isoweek'], ['day']]
+            for kwargs in [{}, {'min_date': datetime.datetime(2013, 3, 4),
+                'max_date': datetime.datetime(2013, 4, 1)}]]
+
+
+class TestContinuousQueries(MemoryBackendTestCase):
+    settings = ('TIMESERIES_ROLLUPS',)
+    
+    def setUp(self):
+        super(TestContinuousQueries, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        counter = TimeSeriesCounter()
+        
+        for day in [10, 13]:
+            timestamp = datetime.datetime(2013, 3, day, 5)
+            counter.add(self.user['_id'], 'posts/', timestamp, 4)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, 1)
+            
+        counter.flush()
+        
+    def test_totals_fill_gaps_with_zeroes(self):
+        self.assertEqual(self.when_queried('totals', ['day'],
+            min_date = datetime.datetime(2013, 3, 9),
+            max_date = datetime.datetime(2013, 3, 15)),
+            [(9, 0), (10, 1), (11, 0), (12, 0), (13, 1), (14, 0)])
+        
+    def test_averages_fill_gaps_with_zeroes(self):
+        self.assertEqual(self.when_queried('averages', ['day'],
+            max_date = datetime.datetime(2013, 3, 14)),
+            [(10, 0.25), (11, 0), (12, 0), (13, 0.25)])
+        
+    def test_hours_start_at_min_date(self):
+        days = self.when_queried('totals', ['day', 'hour'],
+            min_date = datetime.datetime(2013, 3, 10, 3, 30),
+            max_date = datetime.datetime(2013, 3, 10, 7))
+        self.assertEqual(days, [(10, 0), (10, 1), (10, 0)])
+        
+    def test_rollups_fill_gaps_too(self):
+        app.app.config['TIMESERIES_ROLLUPS'] = True
+        self.test_totals_fill_gaps_with_zeroes()
+        
+    def when_queried(self, method, group_by, **kwargs):
+        query = TimeSeriesQuery(self.user, 'posts/likes/', group_by = group_by,
+            sort = [(field, 1) for field in group_by], continuous = True,
+            **kwargs)
+        return [(row['day'], row['value'])
+            for row in getattr(query, method)()]
+
+
+class TestCalendarTable(unittest.TestCase):
+    def test_lookups_match_strftime(self):
+        start = datetime.datetime(2012, 12, 29, 3)
+        timestamps = [start + datetime.timedelta(hours = hour * 7)
+            for hour in range(2000)]
+        self.assertEqual(calendar_table.get_many(timestamps),
+            [calendar_table.compute(timestamp) for timestamp in timestamps])
+        self.assertEqual(calendar_table.get_range(start, 100), [
+            calendar_table.compute(start + datetime.timedelta(hours = hour))
+            for hour in range(100)])
+        
+    def test_lookups_as_arrays(self):
+        timestamp = datetime.datetime(2013, 3, 10, 5)
+        columns = calendar_table.TABLE.lookup(
+            [calendar_table.TABLE.get_offset(timestamp)])
+        self.assertEqual({field: values.tolist()[0]
+            for field, values in columns.items()},
+            calendar_table.compute(timestamp))
+        
+    def test_timestamps_outside_table(self):
+        for timestamp in [datetime.datetime(1969, 12, 31, 23),
+        datetime.datetime(2300, 1, 1)]:
+            self.assertEqual(calendar_table.get_dimensions(timestamp),
+                calendar_table.compute(timestamp))
+            
+    def test_aware_timestamps(self):
+        timestamp = pytz.timezone('US/Pacific').localize(
+            datetime.datetime(2013, 3, 10, 22, 30))
+        self.assertEqual(calendar_table.get_dimensions(timestamp),
+            calendar_table.compute(timestamp))
+
+
+class TestSnapshots(MemoryBackendTestCase):
+    settings = ('TIMESERIES_SNAPSHOT_DIR',)
+    
+    def setUp(self):
+        super(TestSnapshots, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        self.directory = tempfile.mkdtemp()
+        UID(uid = 'ryepdx', datastream = 'posts',
+            user_id = self.user['_id']).save()
+        self.last_post = LastPostRetrieved(uid = 'ryepdx',
+            datastream = 'posts', post_id = '1')
+        self.last_post.save()
+        self.given_counts(range(0, 72, 5))
+        
+    def tearDown(self):
+        super(TestSnapshots, self).tearDown()
+        shutil.rmtree(self.directory)
+        
+    def test_snapshots_answer_like_the_database(self):
+        expected = self.when_queried()
+        self.when_exported()
+        self.assertEqual(self.when_planned(), SnapshotSource)
+        self.assertEqual(self.when_queried(), expected)
+        
+    def test_new_data_makes_snapshot_stale(self):
+        self.when_exported()
+        self.given_counts([71, 80])
+        self.last_post.post_id = '2'
+        self.last_post.save()
+        
+        self.assertNotEqual(self.when_planned(), SnapshotSource)
+        expected = self.when_queried()
+        self.assertEqual(self.when_exported(), 6)
+        self.assertEqual(self.when_queried(), expected)
+        
+        self.assertEqual(self.when_exported(full = True), 34)
+        self.assertEqual(self.when_queried(), expected)
+        
+    def test_mapped_columns_are_not_changed(self):
+        self.when_exported()
+        snapshot = snapshots.Snapshot(self.user['_id'], self.directory)
+        name = snapshot.manifest['paths']['posts/likes/']['file']
+        mapped = numpy.memmap(snapshot.get_file(name + '.values'),
+            dtype = snapshot.manifest['paths']['posts/likes/']['dtype'],
+            mode = 'r')
+        before = list(mapped)
+        self.given_counts([70, 80])
+        self.last_post.post_id = '2'
+        self.last_post.save()
+        self.when_exported()
+        
+        self.assertEqual(list(mapped), before)
+        self.assertNotEqual(list(numpy.fromfile(snapshot.get_file(
+            name + '.values'), dtype = mapped.dtype))[:len(before)], before)
+        
+    def given_counts(self, hours):
+        counter = TimeSeriesCounter()
+        
+        for hour in hours:
+            timestamp = datetime.datetime(2013, 3, 10) + datetime.timedelta(
+                hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, hour % 3 + 1)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp,
+                hour % 2 + 1)
+            
+        counter.flush()
+        
+    def when_exported(self, full = False):
+        app.app.config['TIMESERIES_SNAPSHOT_DIR'] = self.directory
+        return snapshots.export(self.user['_id'], ['posts/likes/', 'posts/'],
+            full)
+        
+    def when_planned(self):
+        source, = TimeSeriesQuery(self.user, 'posts/likes/', group_by = ['day']
+            ).get_sources({'day': '$day'})
+        return type(source)
+        
+    def when_queried(self):
+        within = {'min_date': datetime.datetime(2013, 3, 10, 12, 30),
+            'max_date': datetime.datetime(2013, 3, 12, 12)}
+        return [getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            sort = [(field, 1) for field in group_by], group_by = group_by,
+            **kwargs), method)()
+            for method in ['totals', 'averages']
+            for group_by in [['day'], ['day', 'hour'], ['value'], []]
+            for kwargs in [{}, within, dict(within, continuous = True)]]
+
+
+class TestCompaction(MemoryBackendTestCase):
+    settings = ('TIMESERIES_ROLLUPS',)
+    
+    def setUp(self):
+        super(TestCompaction, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        self.now = datetime.datetime(2013, 4, 15, 9)
+        self.cutoff = datetime.datetime(2013, 3, 26)
+        self.given_counts(datetime.datetime(2013, 3, 1, 5), range(0, 960, 7))
+        
+    def test_queries_answer_the_same(self):
+        for rollups in [False, True]:
+            expected = self.when_queried(rollups)
+            compact(20, batch_size = 4, now = self.now)
+            self.assertEqual(self.when_queried(rollups), expected)
+            
+    def test_deletes_old_hours(self):
+        old = {'user_id': self.user['_id'], 'timestamp': {'$lt': self.cutoff}}
+        count = TimeSeriesData.find(old).count()
+        
+        self.assertEqual(compact(20, now = self.now, dry_run = True), count)
+        self.assertEqual(CompactionHorizon.get_horizon(), None)
+        self.assertEqual(compact(20, batch_size = 4, now = self.now), count)
+        self.assertEqual(TimeSeriesData.find(old).count(), 0)
+        self.assertEqual(CompactionHorizon.get_horizon(), self.cutoff)
+        
+    def test_runs_again(self):
+        expected = self.when_queried(True)
+        compact(20, now = self.now)
+        
+        self.assertEqual(compact(20, now = self.now), 0)
+        self.assertEqual(compact(30, now = self.now), 0)
+        self.assertEqual(CompactionHorizon.get_horizon(), self.cutoff)
+        self.assertEqual(self.when_queried(True), expected)
+        
+    def test_late_hours_are_kept(self):
+        compact(20, now = self.now)
+        self.given_counts(datetime.datetime(2013, 3, 20, 5), [0, 3])
+        expected = self.when_queried(True)
+        
+        self.assertEqual(expected, self.when_queried(False))
+        self.assertEqual(compact(20, now = self.now), 4)
+        self.assertEqual(self.when_queried(True), expected)
+        self.assertEqual(self.when_queried(False), expected)
+        
+    def test_rebuild_keeps_compacted_days(self):
+        expected = self.when_queried(True)
+        compact(20, now = self.now)
+        rebuild(batch_size = 4)
+        self.assertEqual(self.when_queried(True), expected)
+        
+    def given_counts(self, start, hours):
+        counter = TimeSeriesCounter()
+        
+        for hour in hours:
+            timestamp = start + datetime.timedelta(hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, 3)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, hour % 4)
+            
+        counter.flush()
+        
+    def when_queried(self, rollups):
+        app.app.config['TIMESERIES_ROLLUPS'] = rollups
+        return [getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            sort = [(field, 1) for field in group_by], group_by = group_by,
+            **kwargs), method)()
+            for method in ['totals', 'averages']
+            for group_by in [['year', 'month'], ['isoweek'], ['day'], []]
+            for kwargs in [{}, {'min_date': datetime.datetime(2013, 3, 4),
+                'max_date': datetime.datetime(2013, 4, 1)},
+                {'min_date': datetime.datetime(2013, 3, 20),
+                    'continuous': True}]]
+
+
+class TestPathTree(MemoryBackendTestCase):
+    def setUp(self):
+        super(TestPathTree, self).setUp()
+        self.user_id = ObjectId('50e3da15ab0ddcff7dd3c187')
+        TimeSeriesPathTree._cache.clear()
+        
+    def tearDown(self):
+        super(TestPathTree, self).tearDown()
+        TimeSeriesPathTree._cache.clear()
+        
+    def test_saved_paths_are_listed(self):
+        self.given_path(None, 'posts')
+        self.given_path('posts/', 'likes')
+        
+        self.assertEqual(self.when_listed(None), [('posts', None)])
+        self.assertEqual(self.when_listed('posts/'), [('likes', None)])
+        self.assertEqual(self.when_listed('posts/likes/'), [])
+        
+    def test_tree_is_built_from_existing_paths(self):
+        collection = TimeSeriesPath.get_legacy_collection()
+        collection.insert({'user_id': self.user_id, 'name': 'posts'})
+        collection.insert({'user_id': self.user_id, 'parent_path': 'posts/',
+            'name': 'totals', 'timestamp': datetime.datetime(2013, 3, 10)})
+        
+        self.assertEqual(self.when_listed(None), [('posts', None)])
+        self.assertEqual(self.when_listed('posts/'), [])
+        self.assertEqual(TimeSeriesPathTree.find().count(), 1)
+        
+    def test_titles_are_replaced(self):
+        client_id = ObjectId()
+        
+        for title in ['Weight', 'Weight (kg)']:
+            CustomTimeSeriesPath.find_or_create(user_id = self.user_id,
+                parent_path = 'health/', name = 'weight',
+                client_id = client_id, url = 'http://example.com/weight.csv',
+                title = title).save()
+            
+        self.assertEqual(self.when_listed('health/'),
+            [('weight', 'Weight (kg)')])
+        self.assertEqual(len(TimeSeriesPathTree.find_one(
+            {'user_id': self.user_id})['paths']), 1)
+        
+    def test_clients_keep_paths_of_the_same_name(self):
+        client_ids = [ObjectId(), ObjectId()]
+        
+        for client_id in client_ids:
+            for title in ['Weight', 'Weight (kg)']:
+                CustomTimeSeriesPath.find_or_create(user_id = self.user_id,
+                    name = 'weight', client_id = client_id,
+                    url = 'http://example.com/weight.csv', title = title
+                    ).save()
+                
+        for tree in [TimeSeriesPathTree.get_tree(self.user_id),
+        TimeSeriesPathTree.get_tree(self.user_id, refresh = True)]:
+            self.assertEqual(sorted((node['client_id'], node['title'])
+                for node in tree[None].values()),
+                [(client_id, 'Weight (kg)') for client_id in client_ids])
+                
+    def test_paths_added_elsewhere_are_found(self):
+        self.given_path(None, 'posts')
+        self.when_listed(None)
+        TimeSeriesPathTree.get_collection().update({'user_id': self.user_id},
+            {'$addToSet': {'paths': {'parent_path': 'posts/', 'name': 'likes',
+                'title': None, 'client_id': None}}})
+        
+        self.assertEqual(self.when_listed('posts/'), [('likes', None)])
+        
+    def test_saving_does_not_read_the_tree(self):
+        self.given_path(None, 'posts')
+        self.when_listed(None)
+        TimeSeriesPathTree._cache.clear()
+        self.given_path(None, 'posts')
+        self.given_path('posts/', 'likes')
+        
+        self.assertEqual(TimeSeriesPathTree._cache, {})
+        self.assertEqual(self.when_listed('posts/'), [('likes', None)])
+        self.assertEqual(len(TimeSeriesPathTree.find_one(
+            {'user_id': self.user_id})['paths']), 2)
+        
+    def given_path(self, parent_path, name):
+        TimeSeriesPath.find_or_create(user_id = self.user_id,
+            parent_path = parent_path, name = name).save()
+        
+    def when_listed(self, parent_path):
+        return [(node['name'], node['title']) for node in
+            TimeSeriesPathTree.get_children(self.user_id, parent_path)]
+
+
+class TestSplitPaths(MemoryBackendTestCase):
+    settings = ('TIMESERIES_LEGACY_PATHS',)
+    
+    def setUp(self):
+        super(TestSplitPaths, self).setUp()
+        self.user_id = ObjectId('50e3da15ab0ddcff7dd3c187')
+        TimeSeriesPathTree._cache.clear()
+        self.legacy = TimeSeriesPath.get_legacy_collection()
+        self.legacy.insert({'user_id': self.user_id, 'name': 'posts'})
+        self.legacy.insert({'user_id': self.user_id, 'parent_path': 'posts/',
+            'name': 'likes', 'title': 'Likes'})
+        self.legacy.insert({'user_id': self.user_id, 'parent_path': 'posts/',
+            'name': 'totals', 'timestamp': datetime.datetime(2013, 3, 10),
+            'value': 1})
+        
+    def tearDown(self):
+        super(TestSplitPaths, self).tearDown()
+        TimeSeriesPathTree._cache.clear()
+        
+    def test_legacy_paths_are_read(self):
+        self.assertEqual(self.when_found('posts/', 'likes')['title'], 'Likes')
+        self.assertEqual(self.when_found('posts/', 'totals'), None)
+        self.assertEqual(self.when_listed(), ['likes'])
+        
+        app.app.config['TIMESERIES_LEGACY_PATHS'] = False
+        self.assertEqual(self.when_found('posts/', 'likes'), None)
+        
+    def test_saving_a_legacy_path_moves_it(self):
+        path = TimeSeriesPath.find_or_create(user_id = self.user_id,
+            parent_path = 'posts/', name = 'likes')
+        path.save()
+        
+        self.assertEqual(TimeSeriesPath.find().count(), 1)
+        self.assertEqual(self.when_listed(), ['likes'])
+        
+    def test_split(self):
+        TimeSeriesPath(user_id = self.user_id, name = 'posts').save()
+        
+        self.assertEqual(split_paths(batch_size = 1, dry_run = True), 2)
+        self.assertEqual(split_paths(batch_size = 1), 2)
+        self.assertEqual(split_paths(), 0)
+        self.assertEqual(TimeSeriesPath.find().count(), 2)
+        self.assertEqual(self.legacy.find().count(), 1)
+        self.assertEqual(TimeSeriesData.find().count(), 1)
+        
+        app.app.config['TIMESERIES_LEGACY_PATHS'] = False
+        self.assertEqual(self.when_found('posts/', 'likes')['title'], 'Likes')
+        self.assertEqual(self.when_listed(), ['likes'])
+        
+    def test_split_leaves_compact_datapoints(self):
+        self.legacy.insert({'u': self.user_id, 'p': 'posts/', 'n': 'totals',
+            't': datetime.datetime(2013, 3, 11), 'v': 2})
+        
+        self.assertEqual(self.when_listed(), ['likes'])
+        self.assertEqual(split_paths(), 2)
+        self.assertEqual(TimeSeriesPath.find().count(), 2)
+        self.assertEqual(self.legacy.find().count(), 2)
+        
+    def when_found(self, parent_path, name):
+        return TimeSeriesPath.find_one({'user_id': self.user_id,
+            'parent_path': parent_path, 'name': name})
+        
+    def when_listed(self):
+        return [path['name'] for path in TimeSeriesPath.find_paths(
+            {'user_id': self.user_id, 'parent_path': 'posts/'})]
+
+
+class TestCompactKeys(MemoryBackendTestCase):
+    settings = ('TIMESERIES_COMPACT_KEYS', 'TIMESERIES_QUERY_ENGINE')
+    
+    def setUp(self):
+        super(TestCompactKeys, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        
+    def test_queries_answer_the_same(self):
+        self.given_counts()
+        expected = self.when_queried()
+        
+        db.set_backend(create_backend('memory'))
+        app.app.config['TIMESERIES_COMPACT_KEYS'] = True
+        self.given_counts()
+        
+        self.assertEqual(self.when_queried(), expected)
+        self.assertEqual(sorted(TimeSeriesData.get_collection().find_one(
+            {}).keys()), ['_id', 'n', 'p', 't', 'u', 'v'])
+        
+        # The local engine reads the decoded documents instead.
+        app.app.config['TIMESERIES_QUERY_ENGINE'] = 'local'
+        self.assertEqual(self.when_queried(), expected)
+        
+    def test_stored_documents_are_migrated(self):
+        self.given_counts()
+        self.given_counts()
+        expected = self.when_queried()
+        
+        db.set_backend(create_backend('memory'))
+        self.given_counts()
+        app.app.config['TIMESERIES_COMPACT_KEYS'] = True
+        self.given_counts()
+        
+        # Until the documents are merged, grouping by value sees them apart.
+        self.assertEqual(self.when_queried()[:6], expected[:6])
+        self.assertEqual(db.migrations.run(m0002_compact_keys.migration,
+            batch_size = 50), 116)
+        self.assertTrue(db.migrations.is_applied('compact_keys'))
+        self.assertEqual(self.when_queried(), expected)
+        self.assertEqual(TimeSeriesData.get_collection().find(
+            {'$or': [{'timestamp': {'$exists': True}},
+                {'m': {'$exists': True}}]}).count(), 0)
+        
+    def test_custom_data_round_trip(self):
+        app.app.config['TIMESERIES_COMPACT_KEYS'] = True
+        stream = {'user_id': self.user['_id'], 'client_id': ObjectId(),
+            'name': 'weight'}
+        
+        for value in ['70', '72']:
+            handler = CSVHandler(stream)
+            handler.handle({'date': '2013-03-10T10:00:00Z', 'value': value})
+            handler.finalize()
+            
+        datum, = TimeSeriesData.find({'parent_path': 'weight/'})
+        self.assertEqual((datum['value'], datum['day'], datum['hour']),
+            (72, 10, 10))
+        self.assertEqual(TimeSeriesRollup.find_one(
+            {'period': 'year'})['value'], 72)
+        
+    def given_counts(self):
+        counter = TimeSeriesCounter()
+        
+        for hour in range(0, 400, 7):
+            timestamp = datetime.datetime(2013, 3, 1, 5) + datetime.timedelta(
+                hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, 2)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, hour % 3)
+            
+        counter.flush()
+        
+    def when_queried(self):
+        return [getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            sort = [(field, 1) for field in group_by], group_by = group_by,
+            **kwargs), method)()
+            for method in ['totals', 'averages']
+            for group_by in [['day'], ['isoweek', 'hour'], ['value'],
+                ['isoyear', 'week', 'isoweekday']]
+            for kwargs in [{}, {'min_date': datetime.datetime(2013, 3, 4),
+                'max_date': datetime.datetime(2013, 3, 10, 12)},
+                {'min_date': datetime.datetime(2013, 3, 14),
+                    'continuous': True}]]
+
+
+class TestDataVersions(MemoryBackendTestCase):
+    def setUp(self):
+        super(TestDataVersions, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        
+    def test_handlers_bump_their_paths(self):
+        before = self.when_keyed()
+        
+        handler = TwitterTweet(self.user)
+        handler.handle({'created_at': 'Sun Mar 10 10:00:00 +0000 2013'})
+        handler.finalize()
+        tweeted = self.when_keyed()
+        
+        handler = CSVHandler({'user_id': self.user['_id'],
+            'client_id': ObjectId(), 'name': 'weight'})
+        handler.handle({'date': '2013-03-10T10:00:00Z', 'value': '70'})
+        handler.finalize()
+        weighed = self.when_keyed()
+        
+        self.assertEqual([key[1:] for key in [before, tweeted, weighed]],
+            [(0, 0, 0), (1, 1, 0), (2, 1, 1)])
+        self.assertEqual(before[0], None)
+        self.assertEqual(tweeted[0], weighed[0])
+        
+    def test_failed_writes_still_bump(self):
+        class FailingData(TimeSeriesData):
+            @classmethod
+            def increment_many(cls, counts, batch_size = None):
+                raise IOError("The connection dropped.")
+                
+        class FailingCustomData(CustomTimeSeriesData):
+            @classmethod
+            def bulk_upsert(cls, models, key_fields, batch_size = None):
+                raise IOError("The connection dropped.")
+                
+        handler = TwitterTweet(self.user)
+        handler.flush_size = 1
+        handler.handle({'created_at': 'Sun Mar 10 10:00:00 +0000 2013'})
+        handler.totals.model_class = FailingData
+        handler.handle({'created_at': 'Sun Mar 10 11:00:00 +0000 2013'})
+        
+        self.assertRaises(IOError, handler.finalize)
+        self.assertEqual(self.when_keyed()[1], 1)
+        
+        handler = CSVHandler({'user_id': self.user['_id'],
+            'client_id': ObjectId(), 'name': 'weight'})
+        handler.model_class = FailingCustomData
+        handler.handle({'date': '2013-03-10T10:00:00Z', 'value': '70'})
+        
+        self.assertRaises(IOError, handler.finalize)
+        self.assertEqual(self.when_keyed()[2], 1)
+        
+    def test_nothing_flushed_bumps_nothing(self):
+        handler = TwitterTweet(self.user)
+        handler.finalize()
+        self.assertEqual(DataVersion.get_key(self.user['_id']), (None, 0))
+        
+    def when_keyed(self):
+        return (DataVersion.get_key(self.user['_id'])
+            + DataVersion.get_key(self.user['_id'],
+                ['twitter/tweets/', 'weight/'])[1:])
+
+
+class TestQueryCache(MemoryBackendTestCase):
+    settings = ('TIMESERIES_QUERY_CACHE_SIZE', 'TIMESERIES_QUERY_CACHE_SHARED')
+    
+    def setUp(self):
+        super(TestQueryCache, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        query_cache.cache.clear()
+        self.given_tweets(3)
+        
+    def tearDown(self):
+        super(TestQueryCache, self).tearDown()
+        query_cache.cache.clear()
+        
+    def test_results_are_cached_until_new_data(self):
+        first = self.when_queried()
+        first[0]['value'] = None
+        
+        self.assertEqual(self.when_queried(), [{'day': 10, 'value': 3}])
+        self.assertEqual(self.when_queried('averages'),
+            [{'day': 10, 'value': 1.0}])
+        
+        self.given_tweets(1)
+        self.assertEqual(self.when_queried(), [{'day': 10, 'value': 4}])
+        self.assertEqual(self.when_queried(), [{'day': 10, 'value': 4}])
+        self.assertEqual(query_cache.get_stats(), {'hits': 2,
+            'shared_hits': 0, 'misses': 3, 'evictions': 0, 'size': 3})
+        
+    def test_least_recently_used_are_evicted(self):
+        app.app.config['TIMESERIES_QUERY_CACHE_SIZE'] = 2
+        
+        for group_by in [['day'], ['hour'], ['day'], ['month'], ['hour']]:
+            self.when_queried(group_by = group_by)
+            
+        self.assertEqual(query_cache.get_stats(), {'hits': 1,
+            'shared_hits': 0, 'misses': 4, 'evictions': 2, 'size': 2})
+        
+    def test_results_are_shared(self):
+        app.app.config['TIMESERIES_QUERY_CACHE_SHARED'] = True
+        expected = self.when_queried()
+        query_cache.cache.clear()
+        
+        self.assertEqual(self.when_queried(), expected)
+        self.assertEqual(query_cache.get_stats()['shared_hits'], 1)
+        
+    def given_tweets(self, count):
+        handler = TwitterTweet(self.user)
+        
+        for i in range(count):
+            handler.handle({'created_at': 'Sun Mar 10 10:00:00 +0000 2013'})
+            
+        handler.finalize()
+        
+    def when_queried(self, leaf_name = 'totals', group_by = ['day']):
+        return UserTimeSeriesQuery(self.user, 'twitter/tweets/', leaf_name,
+            group_by = group_by, sort = [(field, 1) for field in group_by]
+            ).get_data()
+
+
+class TestLocalEngine(MemoryBackendTestCase):
+    settings = ('TIMESERIES_QUERY_ENGINE', 'TIMESERIES_LOCAL_ENGINE_MAX_ROWS',
+        'TIMESERIES_STORAGE')
+    
+    def setUp(self):
+        super(TestLocalEngine, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        
+        with open('fixtures/async/timeseries.json') as fixture:
+            TimeSeriesData.get_collection().insert(
+                bson.json_util.loads(fixture.read()))
+            
+    def test_engines_answer_the_same(self):
+        self.given_counts()
+        self.assertEqual(self.when_queried('local'),
+            self.when_queried('mongo'))
+        
+    def test_engines_answer_the_same_over_buckets(self):
+        app.app.config['TIMESERIES_STORAGE'] = 'daily'
+        self.test_engines_answer_the_same()
+        
+    def test_planner_picks_by_rows(self):
+        self.given_counts()
+        query = TimeSeriesQuery(self.user, 'posts/likes/', group_by = ['hour'])
+        app.app.config['TIMESERIES_QUERY_ENGINE'] = 'auto'
+        app.app.config['TIMESERIES_LOCAL_ENGINE_MAX_ROWS'] = 58
+        
+        self.assertTrue(query.run_local(['posts/likes/']))
+        app.app.config['TIMESERIES_LOCAL_ENGINE_MAX_ROWS'] = 57
+        self.assertIsNone(query.run_local(['posts/likes/']))
+        
+    def test_queries_run_in_the_database_by_default(self):
+        self.given_counts()
+        self.assertIsNone(TimeSeriesQuery(self.user, 'posts/likes/',
+            group_by = ['hour']).run_local(['posts/likes/']))
+        
+    def test_averages_by_value_run_in_the_database(self):
+        self.assertIsNone(local_engine.get_fields(TimeSeriesQuery(self.user,
+            'posts/likes/', group_by = ['value']), averages = True))
+        
+    def given_counts(self):
+        counter = TimeSeriesCounter()
+        
+        for hour in range(0, 400, 7):
+            timestamp = datetime.datetime(2013, 3, 1, 5) + datetime.timedelta(
+                hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, 2)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, hour % 3)
+            
+        counter.flush()
+        
+    def when_queried(self, engine):
+        app.app.config['TIMESERIES_QUERY_ENGINE'] = engine
+        return [sorted(getattr(TimeSeriesQuery(self.user, 'posts/likes/',
+            group_by = group_by, aggregate = aggregate, match = match,
+            sort = [(field, -1) for field in group_by], **kwargs), method)())
+            for method in ['totals', 'averages']
+            for group_by, aggregate, match in [
+                ([], None, None), (['day'], None, None),
+                (['isoweek', 'hour'], None, None),
+                (['year', 'month'], None, None),
+                (['hour'], {'value': 'max'}, None),
+                ([], {'value': 'avg', 'day': 'min'},
+                    {'value': {'$gt': 0}}),
+                (['isoweekday'], {'value': 'sum'}, None)]
+            for kwargs in [{}, {'min_date': datetime.datetime(2013, 3, 4),
+                'max_date': datetime.datetime(2013, 3, 10, 12)},
+                {'max_date': datetime.datetime(2013, 3, 20),
+                    'continuous': True}]]
+
+
+class TestPathQueries(MemoryBackendTestCase):
+    settings = ('TIMESERIES_QUERY_ENGINE',)
+    
+    def setUp(self):
+        super(TestPathQueries, self).setUp()
+        self.user = {'_id': ObjectId('50e3da15ab0ddcff7dd3c187')}
+        query_cache.cache.clear()
+        counter = TimeSeriesCounter()
+        
+        for hour in range(0, 400, 7):
+            timestamp = datetime.datetime(2013, 3, 1, 5) + datetime.timedelta(
+                hours = hour)
+            counter.add(self.user['_id'], 'posts/', timestamp, 3)
+            counter.add(self.user['_id'], 'posts/likes/', timestamp, hour % 3)
+            counter.add(self.user['_id'], 'posts/shares/', timestamp,
+                hour % 2)
+            
+        counter.flush()
+        
+    def tearDown(self):
+        super(TestPathQueries, self).tearDown()
+        query_cache.cache.clear()
+        
+    def test_paths_answer_like_one_at_a_time(self):
+        app.app.config['TIMESERIES_QUERY_ENGINE'] = 'mongo'
+        
+        for method in ['totals', 'averages']:
+            for kwargs in [{'group_by': ['day']},
+            {'group_by': ['isoweek', 'hour'],
+                'min_date': datetime.datetime(2013, 3, 4),
+                'max_date': datetime.datetime(2013, 3, 10, 12)},
+            {'group_by': ['hour'], 'aggregate': {'value': 'max'}},
+            {'group_by': ['day'], 'continuous': True,
+                'max_date': datetime.datetime(2013, 3, 20)}]:
+                query = TimeSeriesQuery(self.user, 'posts/',
+                    sort = [(field, 1) for field in kwargs['group_by']],
+                    **kwargs)
+                by_path = getattr(query, method + '_by_path')(
+                    ['posts/likes/', 'posts/shares/'])
+                
+                self.assertEqual(by_path.keys(),
+                    ['posts/likes/', 'posts/shares/'])
+                
+                for parent_path, rows in by_path.items():
+                    self.assertEqual(rows, getattr(query.for_path(
+                        parent_path), method)())
+                    
+    def test_paths_are_cached_one_by_one(self):
+        query = UserTimeSeriesQuery(self.user, 'posts/likes/', 'totals',
+            group_by = ['day'], sort = [('day', 1)])
+        expected = query.get_data()
+        by_path = query.get_data_by_path(['posts/shares/', 'posts/likes/'])
+        
+        self.assertEqual(by_path['posts/likes/'], expected)
+        self.assertEqual(by_path['posts/shares/'],
+            query.for_path('posts/shares/').get_data())
+        self.assertEqual(query_cache.get_stats(), {'hits': 2,
+            'shared_hits': 0, 'misses': 2, 'evictions': 0, 'size': 2})
@@ -1,10 +1,374 @@
 """Classes that are useful to async_tasks and are not database models."""
 import bson
-from .models import TimeSeriesData
+import copy
+import datetime
+import db.backends.memory
+import numpy
+from collections import OrderedDict
+from . import calendar_table, local_engine, query_cache, snapshots
+from .models import (TimeSeriesData, TimeSeriesDayBucket, TimeSeriesRollup,
+    CompactionHorizon, use_rollups, utc_naive)
 
 class PathNotFoundException(Exception):
     pass
 
+def merge_groups(groups):
+    """
+    Adds up the values of groups with the same _id coming from different
+    sources, keeping the order in which each _id was first seen.
+    """
+    merged = OrderedDict()
+    
+    for group in groups:
+        key = tuple(sorted(group['_id'].items()))
+        
+        if key in merged:
+            merged[key]['value'] += group['value']
+        else:
+            merged[key] = dict(group)
+            
+    return merged.values()
+
+def zero_groups(group_id, start, end):
+    '''
+    Returns a group with a value of 0 for every _id group_id gives the hours
+    in [start, end), as though each hour had a document with no user, path or
+    name. Unless the hour is grouped by, one hour stands in for each day.
+    '''
+    one_hour = datetime.timedelta(hours = 1)
+    first_hour = TimeSeriesData.simplify_timestamp(start)
+    timestamps = []
+    groups = OrderedDict()
+    
+    if first_hour < start:
+        first_hour += one_hour
+        
+    day = TimeSeriesDayBucket.get_date(first_hour)
+    
+    while day < end:
+        if 'hour' in group_id:
+            hours = [day + one_hour * hour for hour in range(24)]
+        else:
+            hours = [max(day, first_hour)]
+            
+        timestamps.extend(timestamp for timestamp in hours
+            if first_hour <= timestamp < end)
+        day += datetime.timedelta(days = 1)
+        
+    for timestamp, dimensions in zip(timestamps,
+    calendar_table.get_many(timestamps)):
+        _id = db.backends.memory.evaluate(group_id, dict(dimensions,
+            user_id = None, parent_path = None, name = None,
+            timestamp = timestamp, value = 0))
+        groups.setdefault(tuple(sorted(_id.items())),
+            {'_id': _id, 'value': 0})
+        
+    return groups.values()
+
+
+def group_columns(group_id, columns, constants, values):
+    '''
+    Sums values up by group_id, like a $group stage, where each field of
+    group_id is a reference to one of the arrays in columns (running parallel
+    to values) or one of the values in constants.
+    '''
+    fields = [field for field, expression in group_id.items()
+        if expression[1:] in columns]
+    fixed = {field: constants[expression[1:]]
+        for field, expression in group_id.items()
+        if expression[1:] in constants}
+    
+    if not len(values):
+        return []
+    
+    if not fields:
+        return [{'_id': fixed, 'value': values.sum().tolist()}]
+    
+    keys = [columns[group_id[field][1:]] for field in fields]
+    order = numpy.lexsort(keys[::-1])
+    keys = [key[order] for key in keys]
+    starts = numpy.zeros(len(order), dtype = bool)
+    starts[0] = True
+    
+    for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+        
+    starts = numpy.nonzero(starts)[0]
+    sums = numpy.add.reduceat(values[order], starts).tolist()
+    
+    return [{'_id': dict(fixed.items() + zip(fields, key)), 'value': value}
+        for key, value in zip(zip(*[key[starts].tolist() for key in keys]),
+            sums)]
+
+def get_hour_offset(timestamp):
+    """Returns the offset of the first whole hour from timestamp on."""
+    offset = calendar_table.TABLE.get_offset(timestamp)
+    
+    if timestamp != TimeSeriesData.simplify_timestamp(timestamp):
+        offset += 1
+        
+    return offset
+
+
+class HourlySource(object):
+    """Reads the hourly documents of a TimeSeriesData model."""
+    def __init__(self, model_class = TimeSeriesData):
+        self.model_class = model_class
+        
+    def get_groups(self, query, parent_paths, group_id):
+        """
+        Returns the values matching the query on parent_paths summed up by
+        group_id, as {'_id': ..., 'value': ...} documents.
+        """
+        return self.model_class.aggregate(
+            query.begin_aggregation(parent_paths) + [
+            {'$group': {'_id': group_id, 'value': {'$sum': '$value'}}}])
+        
+    def get_columns(self, query, parent_paths, group_id):
+        """
+        Returns the fields grouped by and the values of the documents
+        matching the query on parent_paths, as the arrays local_engine reads.
+        """
+        return local_engine.get_columns(list(self.model_class.find(
+            query.begin_aggregation(parent_paths)[0]['$match'],
+            fields = list(group_id) + ['value'])), group_id)
+        
+    def estimate_rows(self, query, parent_paths):
+        """Returns how many rows get_columns() would read."""
+        return self.model_class.find(
+            query.begin_aggregation(parent_paths)[0]['$match']).count()
+        
+    def get_first_date(self, query, parent_paths):
+        """Returns the earliest timestamp the query could read, if any."""
+        for document in self.model_class.find(
+        query.begin_aggregation(parent_paths)[0]['$match'],
+        fields = ['timestamp']).sort('timestamp', 1).limit(1):
+            return document['timestamp']
+        
+    def aggregate(self, query, parent_paths, aggregation):
+        """Runs a whole aggregation built by the query in the database."""
+        return self.model_class.aggregate(aggregation)
+        
+
+class RollupSource(object):
+    """Reads the TimeSeriesRollup documents of one period."""
+    def __init__(self, period, rollup_class = TimeSeriesRollup):
+        self.period = period
+        self.rollup_class = rollup_class
+        
+    def get_match(self, query, parent_paths):
+        match = {'user_id': query.user['_id'],
+            'parent_path': {'$in': parent_paths}, 'name': 'totals',
+            'period': self.period}
+        
+        if query.min_date or query.max_date:
+            match['start'] = {}
+            
+            if query.min_date:
+                match['start']['$gte'] = utc_naive(query.min_date)
+                
+            if query.max_date:
+                match['start']['$lt'] = utc_naive(query.max_date)
+                
+        return match
+        
+    def get_groups(self, query, parent_paths, group_id):
+        return self.rollup_class.aggregate([
+            {'$match': self.get_match(query, parent_paths)},
+            {'$group': {'_id': group_id, 'value': {'$sum': '$value'}}}])
+        
+    def estimate_rows(self, query, parent_paths):
+        return self.rollup_class.find(
+            self.get_match(query, parent_paths)).count()
+        
+    def get_first_date(self, query, parent_paths):
+        for document in self.rollup_class.find(
+        self.get_match(query, parent_paths), fields = ['start']).sort(
+        'start', 1).limit(1):
+            return document['start']
+        
+    def aggregate(self, query, parent_paths, aggregation):
+        """Runs the aggregation with its $match swapped for the rollups'."""
+        return self.rollup_class.aggregate(
+            [{'$match': self.get_match(query, parent_paths)}]
+            + aggregation[1:])
+        
+
+class DayBucketSource(object):
+    '''
+    Reads the TimeSeriesDayBucket documents of the 'daily' storage layout.
+    Whole days are summed up by the database, using the day's sum, unless the
+    grouping needs something only the hours have. Those queries, and the days
+    cut in two by min_date or max_date, have their buckets split back into
+    hourly documents that are summed up here.
+    '''
+    hourly_fields = ['hour', 'value', 'timestamp']
+    
+    def __init__(self, bucket_class = TimeSeriesDayBucket):
+        self.bucket_class = bucket_class
+        
+    def get_groups(self, query, parent_paths, group_id):
+        match = {'user_id': query.user['_id'],
+            'parent_path': {'$in': parent_paths}, 'name': 'totals'}
+        min_date = utc_naive(query.min_date)
+        max_date = utc_naive(query.max_date)
+        groups = []
+        partial = [(min_date, max_date)]
+        
+        if not any(field in self.hourly_fields for field in group_id):
+            first_day = min_date and self.bucket_class.get_date(min_date)
+            last_day = max_date and self.bucket_class.get_date(max_date)
+            
+            if first_day and first_day < min_date:
+                first_day += datetime.timedelta(days = 1)
+                
+            if not (first_day and last_day and first_day >= last_day):
+                groups = self.bucket_class.aggregate([
+                    {'$match': self.get_spec(match, first_day, last_day)},
+                    {'$group': {'_id': group_id,
+                        'value': {'$sum': '$value'}}}])
+                partial = [(start, end) for start, end in [
+                    (min_date, first_day), (last_day, max_date)]
+                    if start != end]
+                
+        hours = [document for start, end in partial
+            for document in self.get_hours(match, start, end)]
+        
+        if hours:
+            groups += db.backends.memory.aggregate(hours, [
+                {'$group': {'_id': group_id, 'value': {'$sum': '$value'}}}])
+            
+        return groups
+    
+    def get_first_date(self, query, parent_paths):
+        match = {'user_id': query.user['_id'],
+            'parent_path': {'$in': parent_paths}, 'name': 'totals'}
+        
+        for bucket in self.bucket_class.find(self.get_spec(match,
+        utc_naive(query.min_date), utc_naive(query.max_date)),
+        fields = ['date']).sort('date', 1).limit(1):
+            return bucket['date']
+        
+    def estimate_rows(self, query, parent_paths):
+        """Returns how many buckets get_groups() would read at most."""
+        match = {'user_id': query.user['_id'],
+            'parent_path': {'$in': parent_paths}, 'name': 'totals'}
+        return self.bucket_class.find(self.get_spec(match,
+            utc_naive(query.min_date), utc_naive(query.max_date))).count()
+        
+    def get_spec(self, match, start, end):
+        spec = dict(match)
+        
+        if start or end:
+            spec['date'] = {}
+            
+            if start:
+                spec['date']['$gte'] = self.bucket_class.get_date(start)
+                
+            if end:
+                spec['date']['$lt'] = end
+                
+        return spec
+        
+    def get_hours(self, match, start, end):
+        """Yields the hourly documents in [start, end) held by the buckets."""
+        for bucket in self.bucket_class.find(self.get_spec(match, start, end),
+        fields = ['user_id', 'parent_path', 'name', 'date', 'values']):
+            for document in self.bucket_class.get_hours(bucket):
+                if ((not start or document['timestamp'] >= start)
+                and (not end or document['timestamp'] < end)):
+                    yield document
+                    
+
+class SnapshotSource(object):
+    '''
+    Reads the hours of fresh snapshot files (see async_tasks.snapshots)
+    rather than the database, grouping them up with numpy. The calendar fields
+    grouped by are looked up for each UTC hour.
+    '''
+    def __init__(self, series):
+        self.series = series
+        
+    def get_range(self, query):
+        return tuple(get_hour_offset(utc_naive(date)) if date else None
+            for date in [query.min_date, query.max_date])
+        
+    def get_groups(self, query, parent_paths, group_id):
+        groups = []
+        
+        for parent_path in parent_paths:
+            hours, values = self.series[parent_path].between(
+                *self.get_range(query))
+            columns = calendar_table.TABLE.lookup(hours) if any(
+                expression[1:] in calendar_table.FIELDS
+                for expression in group_id.values()) else {}
+            columns['value'] = values
+            groups += group_columns(group_id, columns, {
+                'user_id': query.user['_id'], 'parent_path': parent_path,
+                'name': 'totals'}, values)
+            
+        return groups
+    
+    def get_first_date(self, query, parent_paths):
+        first = [hours[0] for hours, _ in (self.series[parent_path].between(
+            *self.get_range(query)) for parent_path in parent_paths)
+            if len(hours)]
+        
+        if first:
+            return calendar_table.TABLE.get_timestamp(int(min(first)))
+        
+    def estimate_rows(self, query, parent_paths):
+        """Snapshots are read from memory-mapped files, not the database."""
+        return 0
+        
+
+class ClippedSource(object):
+    '''
+    Reads another source only from start up to end (either of which can be
+    None), by narrowing the date range of the queries it is given.
+    '''
+    def __init__(self, source, start = None, end = None):
+        self.source = source
+        self.start = start
+        self.end = end
+        
+    def clip(self, query):
+        """Returns the query narrowed down, or None if nothing is left."""
+        min_date = utc_naive(query.min_date)
+        max_date = utc_naive(query.max_date)
+        
+        if self.start and (not min_date or min_date < self.start):
+            min_date = self.start
+            
+        if self.end and (not max_date or max_date > self.end):
+            max_date = self.end
+            
+        if min_date and max_date and min_date >= max_date:
+            return None
+            
+        return query.clipped(min_date, max_date)
+        
+    def get_groups(self, query, parent_paths, group_id):
+        query = self.clip(query)
+        return self.source.get_groups(query, parent_paths, group_id
+            ) if query else []
+        
+    def get_first_date(self, query, parent_paths):
+        query = self.clip(query)
+        
+        if query:
+            return self.source.get_first_date(query, parent_paths)
+        
+    def get_columns(self, query, parent_paths, group_id):
+        clipped = self.clip(query)
+        return local_engine.read_columns(self.source, clipped, parent_paths,
+            group_id) if clipped else local_engine.from_groups([], group_id)
+        
+    def estimate_rows(self, query, parent_paths):
+        query = self.clip(query)
+        return self.source.estimate_rows(query, parent_paths) if query else 0
+        
+
 class TimeSeriesQuery(object):
     """Represents a user query against time series data."""
     def __init__(self, user, parent_path, match = None, group_by = None,
@@ -24,8 +388,26 @@ class TimeSeriesQuery(object):
     
     def totals(self):
         """Returns summed totals."""
+        result = self.run_local([self.parent_path])
+        
+        if result is not None:
+            return result
+            
+        return self.run(self.get_totals_aggregation([self.parent_path]),
+            [self.parent_path])
+        
+    def totals_by_path(self, parent_paths):
+        '''
+        Returns what totals() would for each of parent_paths, as an
+        OrderedDict, reading them all at once.
+        '''
+        return self.run_by_path(self.get_totals_aggregation(parent_paths),
+            OrderedDict((parent_path, [parent_path])
+                for parent_path in parent_paths))
+        
+    def get_totals_aggregation(self, parent_paths):
         pre_grouping_id = {}
-        aggregation = self.begin_aggregation([self.parent_path])
+        aggregation = self.begin_aggregation(parent_paths)
         
         for dimension in self.group_by:
             if dimension != "value":
@@ -41,14 +423,30 @@ class TimeSeriesQuery(object):
         
         aggregation += self.finish_aggregation()
         
-        return self.model_class.get_collection(
-            ).aggregate(aggregation).get('result')
+        return aggregation
         
     def averages(self):
         """Returns summed totals divided by the parent path's summed totals."""
-        aggregation = self.begin_aggregation([
-            "/".join(self.parent_path[0:-1].split("/")[0:-1])+"/",
-            self.parent_path])
+        parent_paths = self.get_average_paths()
+        result = self.run_local(parent_paths, averages = True)
+        
+        if result is not None:
+            return result
+            
+        return self.run(self.get_averages_aggregation(parent_paths),
+            parent_paths)
+        
+    def averages_by_path(self, parent_paths):
+        '''
+        Returns what averages() would for each of parent_paths, as an
+        OrderedDict, reading them and their parent paths all at once.
+        '''
+        return self.run_by_path(self.get_averages_aggregation(parent_paths),
+            OrderedDict((parent_path, self.get_average_paths(parent_path))
+                for parent_path in parent_paths))
+        
+    def get_averages_aggregation(self, parent_paths):
+        aggregation = self.begin_aggregation(parent_paths)
         grouping_id = self.get_grouping_id()
         
         # subgrouping_id is also used for projecting the fields in the previous
@@ -65,9 +463,9 @@ class TimeSeriesQuery(object):
         # Collect total sums according to user_id.
         # There should be at most two user_ids in our pipeline at this point:
         # the current user's user_id and (if we're getting a "continuous"
-        # stream) a null user_id. By using "max" and "min," we are able to split
-        # up the sums from the two paths we're concerned with and pass them on
-        # to the next grouping operator.
+        # stream) the null user_id of the zero groups run() adds. By using
+        # "max" and "min," we are able to split up the sums from the two paths
+        # we're concerned with and pass them on to the next grouping operator.
         aggregation.append({"$group": {
             "_id": dict(subgrouping_id.items() + [("user_id", "$_id.user_id")]),
              "numerator": {"$min": "$value"},
@@ -93,24 +491,203 @@ class TimeSeriesQuery(object):
         
         aggregation += self.finish_aggregation()
         
-        return self.model_class.get_collection(
-            ).aggregate(aggregation).get('result')
+        return aggregation
         
-    def begin_aggregation(self, parent_paths):
-        """Sets up initial filtering based on min_date, max_date, and user_id"""
-        aggregation = []
-        parent_path_query = [{"parent_path": path} for path in parent_paths]
+    def get_sources(self, group_id, parent_paths = None):
+        '''
+        Picks where to read the data on parent_paths grouped by group_id
+        from: the coarsest rollup that has every calendar field grouped by and
+        lines up with the date range if there is one, then the user's snapshot
+        files if they are fresh, and otherwise every layout the data for this
+        query's model is stored in.
+        
+        Once old hours have been compacted, anything but a rollup is only read
+        from the compaction horizon on, and the days before it are read from
+        the day rollups. Hourly groupings have nothing to read there, and
+        compacted days cut in two by min_date or max_date are left out.
+        '''
+        fields = [field for field in group_id
+            if field not in ('user_id', 'parent_path')]
+        sources = self.get_layout_sources(fields, parent_paths)
+        horizon = (CompactionHorizon.get_horizon()
+            if self.model_class is TimeSeriesData else None)
+        
+        if (not horizon or isinstance(sources[0], RollupSource)
+        or (self.min_date and utc_naive(self.min_date) >= horizon)):
+            return sources
+            
+        clipped = []
+        
+        if all(field in TimeSeriesRollup.periods['day'] for field in fields):
+            clipped.append(ClippedSource(RollupSource('day'), end = horizon))
+            
+        if not self.max_date or utc_naive(self.max_date) > horizon:
+            clipped += [ClippedSource(source, start = horizon)
+                for source in sources]
+            
+        return clipped
+        
+    def get_layout_sources(self, fields, parent_paths = None):
+        if use_rollups() and self.model_class is TimeSeriesData:
+            period = TimeSeriesRollup.find_period(
+                fields, self.min_date, self.max_date)
+            
+            if period:
+                return [RollupSource(period)]
+            
+        if self.model_class is TimeSeriesData:
+            series = snapshots.load(self.user['_id'],
+                parent_paths or [self.parent_path])
+            
+            if series:
+                return [SnapshotSource(series)]
+            
+        sources = [HourlySource(self.model_class)]
+        
+        if self.model_class.is_bucketed():
+            sources.append(DayBucketSource())
+            
+        return sources
+        
+    def clipped(self, min_date, max_date):
+        """Returns a copy of the query over another date range."""
+        query = copy.copy(self)
+        query.min_date = min_date
+        query.max_date = max_date
+        return query
+        
+    def run(self, aggregation, parent_paths):
+        '''
+        Runs an aggregation built by totals() or averages(). When a single
+        source can run it, the whole aggregation runs in the database.
+        Otherwise its first two stages, the $match and the $group summing up
+        values, are answered by each source, and the rest of the stages are
+        run over the merged groups in process. Continuous queries always take
+        the second route, so that the gaps can be filled with zero groups.
+        '''
+        group_id = aggregation[1]['$group']['_id']
+        sources = self.get_sources(group_id, parent_paths)
+        
+        if (len(sources) == 1 and hasattr(sources[0], 'aggregate')
+        and not self.continuous):
+            return sources[0].aggregate(self, parent_paths, aggregation)
+            
+        groups = [group for source in sources
+            for group in source.get_groups(self, parent_paths, group_id)]
         
         if self.continuous:
-            user_id_query = {
-                "$or": [{"user_id": self.user['_id']}, {"user_id":None}]}
-            name_query = {"$or": [{"name": "totals"}, {"name": None}]}
-            parent_path_query.append({'parent_path': None})
-        else:
-            user_id_query = {"user_id": self.user['_id']}
-            name_query = {"name": "totals"}
+            groups += self.get_zero_groups(sources, parent_paths, group_id)
+            
+        return db.backends.memory.aggregate(merge_groups(groups),
+            aggregation[2:])
         
-        match = [user_id_query, {"$or": parent_path_query}, name_query]
+    def run_local(self, parent_paths, averages = False):
+        '''
+        Answers totals(), or averages(), with async_tasks.local_engine
+        instead of an aggregation pipeline. Returns None when the engine is
+        turned off, cannot answer the query, or the sources expect to read
+        more rows than it is allowed to.
+        '''
+        mode = local_engine.get_mode()
+        fields = local_engine.get_fields(self, averages)
+        
+        if mode == 'mongo' or fields is None:
+            return None
+            
+        if averages:
+            fields += local_engine.KEY_FIELDS
+            
+        group_id = {field: '$' + field for field in fields}
+        sources = self.get_sources(group_id, parent_paths)
+        
+        if mode == 'auto' and sum(source.estimate_rows(self, parent_paths)
+        for source in sources) > local_engine.get_max_rows():
+            return None
+            
+        columns = [local_engine.read_columns(source, self, parent_paths,
+            group_id) for source in sources]
+        
+        if self.continuous:
+            columns.append(local_engine.from_groups(self.get_zero_groups(
+                sources, parent_paths, group_id), group_id))
+            
+        engine = local_engine.averages if averages else local_engine.totals
+        return engine(self, local_engine.concat(columns))
+        
+    def run_by_path(self, aggregation, read_paths):
+        '''
+        Runs an aggregation built by totals() or averages() for each path
+        read_paths maps to the paths it reads. Every path is read with a
+        single $match and $group, also grouping by path, and the rest of the
+        stages are run over each path's groups in process.
+        '''
+        group_id = aggregation[1]['$group']['_id']
+        by_path_id = dict(group_id, parent_path = '$parent_path')
+        parent_paths = sorted(set(parent_path
+            for paths in read_paths.values() for parent_path in paths))
+        sources = self.get_sources(by_path_id, parent_paths)
+        groups = [group for source in sources
+            for group in source.get_groups(self, parent_paths, by_path_id)]
+        results = OrderedDict()
+        
+        for parent_path, paths in read_paths.items():
+            path_groups = [group for group in groups
+                if group['_id']['parent_path'] in paths]
+            
+            if 'parent_path' not in group_id:
+                path_groups = [dict(group, _id = {field: value
+                    for field, value in group['_id'].items()
+                    if field != 'parent_path'}) for group in path_groups]
+                
+            if self.continuous:
+                path_groups += self.get_zero_groups(sources, paths, group_id)
+                
+            results[parent_path] = db.backends.memory.aggregate(
+                merge_groups(path_groups), aggregation[2:])
+            
+        return results
+        
+    def get_average_paths(self, parent_path = None):
+        """Returns the paths averages() divides, denominator first."""
+        parent_path = parent_path or self.parent_path
+        return ["/".join(parent_path[0:-1].split("/")[0:-1])+"/",
+            parent_path]
+        
+    def for_path(self, parent_path):
+        """Returns a copy of the query on another path."""
+        query = copy.copy(self)
+        query.parent_path = parent_path
+        return query
+        
+    def get_zero_groups(self, sources, parent_paths, group_id):
+        '''
+        Returns the zero groups filling the gaps in a continuous query, for
+        every hour from min_date, or else the start of the first day with data,
+        up to max_date, or else the end of the current hour.
+        '''
+        start = utc_naive(self.min_date)
+        end = utc_naive(self.max_date)
+        
+        if not start:
+            dates = [date for date in (source.get_first_date(self,
+                parent_paths) for source in sources) if date]
+            
+            if not dates:
+                return []
+            
+            start = TimeSeriesDayBucket.get_date(min(dates))
+            
+        if not end:
+            end = TimeSeriesData.simplify_timestamp(datetime.datetime.utcnow()
+                ) + datetime.timedelta(hours = 1)
+            
+        return zero_groups(group_id, start, end)
+        
+    def begin_aggregation(self, parent_paths):
+        """Sets up initial filtering based on min_date, max_date, and user_id"""
+        aggregation = []
+        match = [{"user_id": self.user['_id']},
+            {"parent_path": {"$in": list(parent_paths)}}, {"name": "totals"}]
         
         if self.min_date:
             match.append({"timestamp": {"$gte": self.min_date}})
@@ -181,12 +758,36 @@ class UserTimeSeriesQuery(TimeSeriesQuery):
         self.aspect_name = leaf_name
         super(UserTimeSeriesQuery, self).__init__(user, parent_path, **kwargs)
     
-    def get_data(self):
+    def get_read_paths(self):
+        """Returns the paths get_data() reads."""
         if self.aspect_name == "totals":
-            return self.totals()
+            return [self.parent_path]
         elif self.aspect_name == "averages":
-            return self.averages()
+            return self.get_average_paths()
         else:
             raise PathNotFoundException(
                 "Path not recognized: %s" % self.aspect_name)
+    
+    def get_data(self):
+        """Returns the totals or averages, from async_tasks.query_cache."""
+        return query_cache.get_data(self, self.get_read_paths(),
+            getattr(self, self.aspect_name))
+        
+    def get_data_by_path(self, parent_paths):
+        '''
+        Returns what get_data() would for each of parent_paths, as an
+        OrderedDict. The results that are not cached are worked out together,
+        with totals_by_path() or averages_by_path().
+        '''
+        queries = [(query, query.get_read_paths()) for query in [
+            self.for_path(parent_path)
+            for parent_path in OrderedDict.fromkeys(parent_paths)]]
+        by_path = getattr(self, self.aspect_name + '_by_path')
+        
+        def compute(missing):
+            results = by_path([query.parent_path for query, _ in missing])
+            return [results[query.parent_path] for query, _ in missing]
+            
+        return OrderedDict(zip([query.parent_path for query, _ in queries],
+            query_cache.get_many(queries, compute)))
             
@@ -0,0 +1,256 @@
+'''
+Answers TimeSeriesQuery.totals() and averages() in process, instead of with
+their aggregation pipelines. The rows a query matches are read once, as
+numpy arrays: the hourly documents through a cursor projecting only the
+fields needed, and the other sources as the groups they return. The sums,
+the ratios of averages(), the min, max, avg and sum aggregates and the sort
+are then worked out with vectorized operations, giving the same results the
+pipelines would.
+
+TimeSeriesQuery picks the engine when TIMESERIES_QUERY_ENGINE is 'local', or
+when it is 'auto' and its sources expect to read at most
+TIMESERIES_LOCAL_ENGINE_MAX_ROWS rows; bigger queries are left to the
+database rather than having every row sent over. 'auto' counts the rows
+first, which costs every query a round trip, so 'mongo', which always runs
+the pipelines, is the default. Queries grouping by fields other than the
+calendar fields, or averages grouping by value, always run as pipelines
+too.
+'''
+import app as platform
+import db.backends.memory
+import numpy
+from . import calendar_table
+from .models import get_number
+
+AGGREGATORS = ['sum', 'avg', 'min', 'max']
+DEFAULT_MAX_ROWS = 50000
+KEY_FIELDS = ['parent_path', 'user_id']
+
+def get_mode():
+    return platform.get_setting('TIMESERIES_QUERY_ENGINE', 'mongo')
+
+def get_max_rows():
+    return platform.get_setting('TIMESERIES_LOCAL_ENGINE_MAX_ROWS',
+        DEFAULT_MAX_ROWS)
+
+def get_fields(query, averages = False):
+    '''
+    Returns the calendar fields the matching rows are first summed up by, or
+    None if the engine cannot answer the query.
+    '''
+    if averages:
+        fields = query.get_grouping_id().keys()
+
+        if 'value' in fields:
+            return None
+    else:
+        fields = [field for field in query.group_by if field != 'value']
+
+    if any(field not in calendar_table.FIELDS for field in fields):
+        return None
+
+    # The fields of the rows the rest of the stages run over.
+    columns = set(fields + ['value'])
+
+    if query.aggregate:
+        keys = query.group_by or query.get_grouping_id().keys()
+
+        if not (set(keys) <= columns and set(query.aggregate) <= columns
+        and set(query.aggregate.values()) <= set(AGGREGATORS)):
+            return None
+
+        columns = set(query.group_by) | set(query.aggregate)
+
+    if query.sort and not set(field for field, _ in get_sort(query.sort)
+    ) <= columns:
+        return None
+
+    return sorted(fields)
+
+def get_sort(sort):
+    return sort.items() if isinstance(sort, dict) else list(sort)
+
+def to_array(values):
+    array = numpy.array(values)
+
+    # Strings, None and mixed values stay Python objects, as they are.
+    if array.dtype.kind not in 'biuf':
+        array = numpy.empty(len(values), dtype = object)
+        array[:] = values
+
+    return array
+
+def get_columns(rows, fields):
+    """Returns the given fields and the values of rows, as arrays."""
+    columns = {field: to_array([row.get(field) for row in rows])
+        for field in fields}
+    columns['value'] = to_array([get_number(row.get('value'))
+        for row in rows])
+    return columns
+
+def from_groups(groups, group_id):
+    """Returns the columns of the groups a source summed up by group_id."""
+    columns = get_columns([group['_id'] for group in groups], group_id)
+    columns['value'] = to_array([get_number(group['value'])
+        for group in groups])
+    return columns
+
+def read_columns(source, query, parent_paths, group_id):
+    '''
+    Returns the columns of what a source holds for the query on
+    parent_paths, as the rows it stores when it can give them, and as the
+    groups it sums up by group_id otherwise.
+    '''
+    if hasattr(source, 'get_columns'):
+        return source.get_columns(query, parent_paths, group_id)
+
+    return from_groups(source.get_groups(query, parent_paths, group_id),
+        group_id)
+
+def concat(columns):
+    # Empty arrays are left out, as they would turn integers into floats.
+    columns = [part for part in columns if count(part)] or columns[:1]
+    return {field: numpy.concatenate([part[field] for part in columns])
+        for field in columns[0]}
+
+def count(columns):
+    return len(columns['value'])
+
+def encode(array):
+    """Returns numbers that are equal wherever the array's values are."""
+    if array.dtype != object:
+        return array
+
+    codes = {}
+    return numpy.array([codes.setdefault(value, len(codes))
+        for value in array.tolist()], dtype = int)
+
+def group(columns, keys):
+    '''
+    Returns the order sorting the rows by keys and the positions in that
+    order where each group of rows with the same keys starts.
+    '''
+    arrays = [encode(columns[key]) for key in keys]
+    order = (numpy.lexsort(arrays[::-1]) if arrays
+        else numpy.arange(count(columns)))
+    starts = numpy.zeros(len(order), dtype = bool)
+    starts[:1] = True
+
+    for array in arrays:
+        array = array[order]
+        starts[1:] |= array[1:] != array[:-1]
+
+    return order, numpy.nonzero(starts)[0]
+
+def reduce(values, order, starts, aggregator):
+    values = values[order]
+
+    if aggregator == 'min':
+        return numpy.minimum.reduceat(values, starts)
+    elif aggregator == 'max':
+        return numpy.maximum.reduceat(values, starts)
+
+    sums = numpy.add.reduceat(values, starts)
+
+    if aggregator == 'avg':
+        return sums.astype(float) / numpy.diff(numpy.append(starts,
+            len(values)))
+
+    return sums
+
+def group_by(columns, keys, accumulators):
+    '''
+    Groups the rows by keys, like a $group stage, returning the keys of each
+    group and its accumulators, given as {field: (aggregator, column)}.
+    '''
+    order, starts = group(columns, keys)
+    grouped = {key: columns[key][order][starts] for key in keys}
+    grouped.update({field: reduce(columns[column], order, starts, aggregator)
+        for field, (aggregator, column) in accumulators.items()})
+    return grouped
+
+def totals(query, columns):
+    """Answers TimeSeriesQuery.totals() over the columns it read."""
+    if not count(columns):
+        return []
+
+    rows = group_by(columns, get_fields(query), {'value': ('sum', 'value')})
+    return finish(query, rows)
+
+def averages(query, columns):
+    """Answers TimeSeriesQuery.averages() over the columns it read."""
+    if not count(columns):
+        return []
+
+    fields = get_fields(query, averages = True)
+    sums = group_by(columns, fields + KEY_FIELDS,
+        {'value': ('sum', 'value')})
+    # Each path's sum goes to the numerator or the denominator, by size.
+    ratios = group_by(sums, fields + ['user_id'], {
+        'numerator': ('min', 'value'), 'denominator': ('max', 'value')})
+
+    if query.continuous:
+        ratios = group_by(ratios, fields, {
+            'numerator': ('sum', 'numerator'),
+            'denominator': ('sum', 'denominator')})
+
+    denominator = ratios['denominator']
+    zero = denominator == 0
+    rows = {field: ratios[field] for field in fields}
+    rows['value'] = ratios['numerator'].astype(float) / numpy.where(zero, 1,
+        denominator)
+    rows['value'][zero] = 0
+    return finish(query, rows)
+
+def finish(query, rows):
+    '''
+    Runs the stages of TimeSeriesQuery.finish_aggregation() over the rows
+    totals() or averages() worked out, and returns them as documents.
+    '''
+    if not count(rows):
+        return []
+
+    if query.aggregate:
+        if query.match:
+            rows = filter_rows(rows, query.match)
+
+        if not count(rows):
+            return []
+
+        rows = group_by(rows, query.group_by or sorted(query.aggregate), {
+            field: (aggregator, field)
+            for field, aggregator in query.aggregate.items()})
+
+        for key in set(rows) - set(query.group_by) - set(query.aggregate):
+            del rows[key]
+
+    if query.sort:
+        rows = sort_rows(rows, get_sort(query.sort))
+
+    fields = rows.keys()
+    return [dict(zip(fields, values))
+        for values in zip(*[rows[field].tolist() for field in fields])]
+
+def filter_rows(rows, spec):
+    fields = rows.keys()
+    keep = numpy.array([db.backends.memory.match(dict(zip(fields, values)),
+        spec) for values in zip(*[rows[field].tolist() for field in fields])],
+        dtype = bool)
+    return {field: rows[field][keep] for field in fields}
+
+def sort_rows(rows, sort):
+    keys = []
+
+    for field, direction in sort:
+        array = rows[field]
+
+        if array.dtype == object:
+            # Ranked the way $sort orders values of different types.
+            values = array.tolist()
+            ranks = sorted(set(values), cmp = db.backends.memory.compare)
+            array = numpy.array([ranks.index(value) for value in values])
+
+        keys.append(array if direction >= 0 else -array)
+
+    order = numpy.lexsort(keys[::-1])
+    return {field: array[order] for field, array in rows.items()}
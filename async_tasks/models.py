@@ -1,17 +1,94 @@
 """Supporting models for all asynchronous tasks."""
 import app as platform
+import datetime
+import db.asynchronous
+import db.migrations
+import db.scope
+import pytz
+import threading
+import time
+from bson.objectid import ObjectId
+from collections import OrderedDict
 from json import JSONEncoder
-from db.models import Model, mongodb_init
+from . import calendar_table
+from db.encoding import DualReadEncoding, KeyEncoding
+from db.models import Model, Index, mongodb_init, bulk_write
 
 if 'DATABASES' in platform.app.config:
     DEFAULT_DATABASE = platform.app.config['DATABASES']['async']
 else:
     DEFAULT_DATABASE = 'platform_async'
 
+STORAGE_LAYOUTS = ['hourly', 'daily']
+DEFAULT_STORAGE = 'hourly'
+
+def get_storage():
+    '''
+    Returns the layout time series counts are written in, from the
+    TIMESERIES_STORAGE setting (the task runners read it from settings, since
+    they do not set up the app): 'hourly' stores one TimeSeriesData document
+    per datapoint, 'daily' one TimeSeriesDayBucket per user, path and day.
+    '''
+    storage = platform.get_setting('TIMESERIES_STORAGE', DEFAULT_STORAGE)
+    
+    if storage not in STORAGE_LAYOUTS:
+        raise ValueError("Unknown TIMESERIES_STORAGE %r. Expected one of %s."
+            % (storage, ', '.join(STORAGE_LAYOUTS)))
+        
+    return storage
+
+def use_rollups():
+    '''
+    Whether TimeSeriesQuery may answer queries from TimeSeriesRollup, from
+    the TIMESERIES_ROLLUPS setting. The rollups are always kept up to date,
+    but only cover the data written since they were introduced until
+    async_tasks.datastreams.rollup has been run.
+    '''
+    return platform.get_setting('TIMESERIES_ROLLUPS', False)
+
+def use_legacy_paths():
+    '''
+    Whether paths missing from the timeseries_paths collection are also
+    looked for among the datapoints in timeseries, where they used to be
+    kept. The TIMESERIES_LEGACY_PATHS setting decides if it is set, and
+    otherwise they are until the split_paths migration has moved them.
+    '''
+    legacy = platform.get_setting('TIMESERIES_LEGACY_PATHS')
+    return (legacy if legacy is not None
+        else not db.migrations.is_applied('split_paths'))
+
+def use_compact_keys():
+    '''
+    Whether TimeSeriesData documents are stored in their compact encoding,
+    from the TIMESERIES_COMPACT_KEYS setting. Documents already stored are
+    converted by the compact_keys migration, and both forms are read until
+    it has finished.
+    '''
+    return platform.get_setting('TIMESERIES_COMPACT_KEYS', False)
+
+def add_calendar_fields(document):
+    """Adds the calendar fields of a document's timestamp, if it has one."""
+    if document.get('timestamp'):
+        document.update(calendar_table.get_dimensions(
+            utc_naive(document['timestamp'])))
+
+def utc_naive(timestamp):
+    """Converts an aware datetime to naive UTC, the way MongoDB stores it."""
+    if timestamp is not None and timestamp.tzinfo is not None:
+        return timestamp.astimezone(pytz.utc).replace(tzinfo = None)
+    
+    return timestamp
+
+def get_number(value):
+    """Returns a value if it can be added up, and 0 otherwise."""
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return value
+    
+    return 0
+
 class AsyncModel(Model):
-    @classmethod
-    def get_collection(cls, database = DEFAULT_DATABASE):
-        return super(AsyncModel, cls).get_collection(database = database)
+    database_key = 'async'
+    default_database = DEFAULT_DATABASE
         
         
 class LastCustomDataPull(AsyncModel):
@@ -19,6 +96,8 @@ class LastCustomDataPull(AsyncModel):
     Keeps track of when custom datastreams were last checked for updates.
     '''
     table = 'last_post_retrieved'
+    indexes = [Index('user_id', 'path')]
+    fields = ('user_id', 'path', 'last_pulled')
     
     @mongodb_init
     def __init__(self, user_id = None, path = '', last_pulled = None):
@@ -33,6 +112,8 @@ class LastPostRetrieved(AsyncModel):
     '''
     table = 'last_post_retrieved'
     do_not_convert = ('post_id',)
+    indexes = [Index('uid', 'datastream')]
+    fields = ('uid', 'datastream', 'post_id')
     
     @mongodb_init
     def __init__(self, uid = '', datastream = '', post_id = ''):
@@ -42,7 +123,61 @@ class LastPostRetrieved(AsyncModel):
         
 
 class TimeSeriesPath(AsyncModel):
-    table = "timeseries"
+    '''
+    A node in a user's tree of datastream paths. Paths used to be kept in
+    the timeseries collection along with the datapoints; until
+    async_tasks.datastreams.split_paths has moved them out, paths not found
+    here are also looked for there (see use_legacy_paths).
+    '''
+    table = "timeseries_paths"
+    legacy_table = "timeseries"
+    indexes = [
+        Index('user_id', 'parent_path', 'name'),
+        Index('parent_path', 'name')
+    ]
+    fields = ('user_id', 'parent_path', 'name', 'title')
+    # Whether saving a document adds it to its user's TimeSeriesPathTree.
+    in_path_tree = True
+    
+    @classmethod
+    def get_legacy_collection(cls):
+        return db.get_collection(cls.get_database_name(), cls.legacy_table)
+    
+    @classmethod
+    def get_legacy_spec(cls, spec):
+        '''
+        Narrows spec down to the paths among the legacy datapoints, leaving
+        out the datapoints with compact keys, which have no timestamp either.
+        '''
+        return dict(spec or {}, timestamp = {'$exists': False},
+            t = {'$exists': False}, n = {'$exists': False})
+        
+    @classmethod
+    def find_one(cls, attrs, as_obj = False, fields = None):
+        result = super(TimeSeriesPath, cls).find_one(attrs, as_obj, fields)
+        
+        if (result is None and cls.legacy_table and use_legacy_paths()
+        and isinstance(attrs, dict)):
+            result = cls.get_legacy_collection().find_one(
+                cls.get_legacy_spec(attrs), fields = fields)
+            
+            if as_obj and result:
+                return cls(**result)
+            
+        return result
+    
+    @classmethod
+    def find_paths(cls, spec = None, fields = None):
+        """Returns a list of the paths matching spec, wherever they are."""
+        paths = list(cls.find(spec, fields = fields))
+        
+        if cls.legacy_table and use_legacy_paths():
+            found = set(path['_id'] for path in paths)
+            paths += [path for path in cls.get_legacy_collection().find(
+                cls.get_legacy_spec(spec), fields = fields)
+                if path['_id'] not in found]
+            
+        return paths
     
     @mongodb_init
     def __init__(self, user_id = '', parent_path = None, name = '',
@@ -71,11 +206,16 @@ class TimeSeriesPath(AsyncModel):
     def save(self, *args, **kwargs):
         # No, really. it's not optional.
         assert 'user_id' in self and self['user_id']
-        return super(TimeSeriesPath, self).save(*args, **kwargs)
+        saved = super(TimeSeriesPath, self).save(*args, **kwargs)
+        
+        if self.in_path_tree:
+            TimeSeriesPathTree.add(self['user_id'], self)
+            
+        return saved
         
         
 class CustomTimeSeriesPath(TimeSeriesPath):
-    table = "timeseries"
+    fields = TimeSeriesPath.fields + ('client_id', 'url')
     
     @mongodb_init
     def __init__(self, url = None, client_id = None, **kwargs):
@@ -88,11 +228,197 @@ class CustomTimeSeriesPath(TimeSeriesPath):
         
         super(CustomTimeSeriesPath, self).__init__(**kwargs)
 
-   
+
+
+class TimeSeriesPathTree(AsyncModel):
+    '''
+    All of a user's paths, materialized into one document per user, so that
+    listing a directory takes a single indexed read rather than a count and
+    a $group over the paths. TimeSeriesPath.save() adds every path it saves,
+    and a user's tree is built from the TimeSeriesPath documents the first
+    time it is asked for.
+    
+    Trees are cached in process for TIMESERIES_PATH_CACHE_SECONDS. Paths
+    saved in the same process show up at once, and a directory missing from
+    a cached tree is looked up again before it is reported missing, so only
+    new entries in directories listed elsewhere can show up late.
+    '''
+    table = 'timeseries_path_trees'
+    indexes = [Index('user_id', unique = True)]
+    fields = ('user_id', 'paths')
+    max_cached = 1000
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+    
+    @classmethod
+    def get_max_age(cls):
+        return platform.get_setting('TIMESERIES_PATH_CACHE_SECONDS', 60)
+    
+    @classmethod
+    def get_node(cls, path):
+        return {'parent_path': path.get('parent_path') or None,
+            'name': path['name'], 'title': path.get('title'),
+            'client_id': path.get('client_id')}
+    
+    @classmethod
+    def get_key(cls, node):
+        """
+        Returns what tells a node apart from the others under its parent.
+        Clients can each have a path of the same name.
+        """
+        return (node['name'], node['client_id'])
+    
+    @classmethod
+    def index(cls, nodes):
+        """Arranges nodes by parent path. The last node of a key wins."""
+        tree = {}
+        
+        for node in nodes:
+            tree.setdefault(node['parent_path'], OrderedDict())[
+                cls.get_key(node)] = node
+            
+        return tree
+        
+    @classmethod
+    def build(cls, user_id):
+        """
+        Materializes a user's tree from the TimeSeriesPath documents. Paths
+        whose title changed can have a document per title; the last wins.
+        """
+        nodes = OrderedDict()
+        
+        for path in TimeSeriesPath.find_paths({'user_id': user_id},
+        fields = ['parent_path', 'name', 'title', 'client_id']):
+            node = cls.get_node(path)
+            nodes[(node['parent_path'],) + cls.get_key(node)] = node
+            
+        nodes = nodes.values()
+        cls.get_collection().update({'user_id': user_id},
+            {'$addToSet': {'paths': {'$each': nodes}}}, upsert = True)
+        return nodes
+        
+    @classmethod
+    def load(cls, user_id):
+        tree = cls.find_one({'user_id': user_id}, fields = ['paths'])
+        nodes = tree.get('paths', []) if tree else cls.build(user_id)
+        tree = cls.index(nodes)
+        
+        with cls._lock:
+            cls._cache.pop(user_id, None)
+            cls._cache[user_id] = (time.time(), tree)
+            
+            while len(cls._cache) > cls.max_cached:
+                cls._cache.popitem(last = False)
+                
+        return tree
+        
+    @classmethod
+    def get_tree(cls, user_id, refresh = False):
+        '''
+        Returns a dictionary mapping each parent path of the user's (None for
+        the top level) to the nodes under it by get_key().
+        '''
+        with cls._lock:
+            cached = cls._cache.get(user_id)
+            
+        if (refresh or not cached
+        or time.time() - cached[0] > cls.get_max_age()):
+            return cls.load(user_id)
+        
+        return cached[1]
+    
+    @classmethod
+    def get_children(cls, user_id, parent_path = None):
+        '''
+        Returns the nodes ({'parent_path', 'name', 'title', 'client_id'})
+        under parent_path, or an empty list if there are none.
+        '''
+        children = cls.get_tree(user_id).get(parent_path)
+        
+        if not children:
+            children = cls.get_tree(user_id, refresh = True).get(parent_path)
+            
+        return children.values() if children else []
+    
+    @classmethod
+    def add(cls, user_id, path):
+        """
+        Adds a path to the user's tree unless it is already there. Nothing
+        is read: a path found in the cached tree costs nothing, and any other
+        costs one update, which only writes if the path is missing. Users
+        without a tree get the path when theirs is built.
+        """
+        node = cls.get_node(path)
+        key = cls.get_key(node)
+        
+        with cls._lock:
+            cached = cls._cache.get(user_id)
+            
+        if cached and cached[1].get(node['parent_path'], {}).get(key) == node:
+            return
+        
+        collection = cls.get_collection()
+        db.scope.invalidate(collection.full_name)
+        result = collection.update({'user_id': user_id,
+            'paths': {'$ne': node}}, {'$addToSet': {'paths': node}})
+        
+        if result is None or result.get('n'):
+            # The node is added before any other version of it is taken out,
+            # so readers never miss the path.
+            collection.update({'user_id': user_id}, {'$pull': {'paths': {
+                'parent_path': node['parent_path'], 'name': node['name'],
+                'client_id': node['client_id'],
+                'title': {'$ne': node['title']}}}})
+            
+        if cached:
+            with cls._lock:
+                cached[1].setdefault(node['parent_path'], OrderedDict())[
+                    key] = node
+                    
+
 class TimeSeriesData(TimeSeriesPath):
+    table = "timeseries"
+    legacy_table = None
+    in_path_tree = False
+    indexes = [
+        # Serves both the upserts in increment_many and the $match at the
+        # start of every TimeSeriesQuery aggregation.
+        Index('user_id', 'parent_path', 'name', 'timestamp')
+    ]
     dimensions = ['year', 'month', 'week', 'day', 'day_of_week', 'hour', 
         'isoyear', 'isoweek', 'isoweekday', 'value']
     default_group_by = ['year', 'month', 'day']
+    calendar_fields = ['year', 'month', 'week', 'day', 'isoyear', 'isoweek',
+        'isoweekday', 'hour']
+    fields = ('user_id', 'parent_path', 'name', 'timestamp', 'value'
+        ) + tuple(calendar_fields)
+    # Whether the 'daily' storage layout writes this model's counts to
+    # TimeSeriesDayBucket instead. Custom datastreams set their values rather
+    # than adding to them, so they always stay hourly.
+    bucketed = True
+    # The compact encoding keeps single-letter keys and works the calendar
+    # fields out from the (UTC) timestamp on the way back, rather than
+    # storing them. They are the same unless aware timestamps in other time
+    # zones were written.
+    key_encoding = KeyEncoding({'user_id': 'u', 'parent_path': 'p',
+        'name': 'n', 'timestamp': 't', 'value': 'v', 'client_id': 'c'},
+        derived = calendar_fields, derive = add_calendar_fields,
+        derived_from = ['timestamp'],
+        expressions = calendar_table.get_expressions('$t'))
+    
+    dual_read_encoding = DualReadEncoding(key_encoding, 'timestamp')
+    
+    @classmethod
+    def get_encoding(cls):
+        if not use_compact_keys():
+            return None
+            
+        return (cls.key_encoding if db.migrations.is_applied('compact_keys')
+            else cls.dual_read_encoding)
+    
+    @classmethod
+    def is_bucketed(cls):
+        return cls.bucketed and get_storage() == 'daily'
     
     @classmethod
     def find_one(cls, attrs, **kwargs):
@@ -108,6 +434,53 @@ class TimeSeriesData(TimeSeriesPath):
         # entries than necessary.
         return timestamp.replace(minute=0, second=0, microsecond=0)
         
+    @classmethod
+    def get_dimensions(cls, timestamp):
+        """Returns the calendar fields we record for the given timestamp."""
+        return calendar_table.get_dimensions(timestamp)
+        
+    @classmethod
+    def increment_many(cls, counts, batch_size = None):
+        """
+        Adds to the values of many datapoints using unordered bulk operations,
+        one per batch. Takes a dictionary mapping
+        (user_id, parent_path, name, timestamp) tuples to the amounts to add.
+        
+        Each datapoint is upserted with $inc, so concurrent runs cannot lose
+        each other's increments, and the calendar fields are only written when
+        the datapoint is first created.
+        """
+        TimeSeriesRollup.increment_many(counts, batch_size)
+        
+        if cls.is_bucketed():
+            return TimeSeriesDayBucket.increment_many(counts, batch_size)
+        
+        def add_increment(bulk, item):
+            (key, amount), dimensions = item
+            user_id, parent_path, name, timestamp = key
+            datum = cls(user_id = user_id, parent_path = parent_path,
+                name = name, timestamp = timestamp, **dimensions)
+            bulk.find(cls.encode_spec(datum.get_key())).upsert().update_one(
+                cls.encode_update({
+                    '$inc': {'value': amount},
+                    '$setOnInsert': dimensions
+                }))
+            
+        items = counts.items()
+        dimensions = calendar_table.get_many(
+            [timestamp for (_, _, _, timestamp), _ in items])
+        
+        return bulk_write(cls.get_collection(), zip(items, dimensions),
+            add_increment, batch_size = batch_size)
+        
+    @classmethod
+    def increment(cls, user_id, parent_path, timestamp, amount = 1,
+    name = 'totals'):
+        """Adds to the value of a single datapoint with one upsert."""
+        return cls.increment_many({
+            (user_id, parent_path, name, cls.simplify_timestamp(timestamp)):
+                amount})
+        
     @mongodb_init
     def __init__(self, value = 0, timestamp = None, name = 'totals',
     hour = None, day = None, week = None, month = None, year = None,
@@ -115,17 +488,28 @@ class TimeSeriesData(TimeSeriesPath):
         assert timestamp
         
         super(TimeSeriesData, self).__init__(name = name, **kwargs)
-        isocalendar = timestamp.isocalendar()
+        given = {'year': year, 'month': month, 'week': week, 'day': day,
+            'isoyear': isoyear, 'isoweek': isoweek, 'isoweekday': isoweekday,
+            'hour': hour}
+        
+        # Documents read back carry their calendar fields already.
+        if any(value is None for value in given.values()):
+            dimensions = self.get_dimensions(timestamp)
+        else:
+            dimensions = given
+            
         self.timestamp = self.simplify_timestamp(timestamp)
-        self.year = year if year else timestamp.year
-        self.month = month if month else timestamp.month
-        self.week = week if week else int(timestamp.strftime("%W"))
-        self.day = day if day else timestamp.day
-        self.isoyear = isoyear if isoyear else isocalendar[0]
-        self.isoweek = isoweek if isoweek else isocalendar[1]
-        self.isoweekday = isoweekday if isoweekday else isocalendar[2]
-        self.hour = hour if hour else timestamp.hour
+        
+        for field in self.calendar_fields:
+            self[field] = given[field] if given[field] else dimensions[field]
+            
         self.value = value
+        
+    def get_key(self):
+        """Returns the fields that uniquely identify this datapoint."""
+        return {'user_id': self.user_id,
+            'parent_path': self.get('parent_path'), 'name': self.name,
+            'timestamp': self.timestamp}
     
     @property
     def path(self):
@@ -135,7 +519,419 @@ class TimeSeriesData(TimeSeriesPath):
     def children(self):
         return None
         
+
+class TimeSeriesDayBucket(AsyncModel):
+    '''
+    A day of a time series in the 'daily' storage layout: the day's 24 hourly
+    values in an array indexed by UTC hour, their sum, and the calendar fields
+    of the day. Stands in for up to 24 TimeSeriesData documents.
+    '''
+    table = 'timeseries_days'
+    hours = 24
+    indexes = [Index('user_id', 'parent_path', 'name', 'date', unique = True)]
+    calendar_fields = ['year', 'month', 'week', 'day', 'isoyear', 'isoweek',
+        'isoweekday']
+    fields = ('user_id', 'parent_path', 'name', 'date', 'value', 'values'
+        ) + tuple(calendar_fields)
+    
+    @classmethod
+    def get_date(cls, timestamp):
+        """Returns the (naive UTC) midnight starting a timestamp's day."""
+        return utc_naive(timestamp).replace(
+            hour = 0, minute = 0, second = 0, microsecond = 0)
+        
+    @classmethod
+    def get_key(cls, user_id, parent_path, name, date):
+        if user_id and not isinstance(user_id, ObjectId):
+            user_id = ObjectId(user_id)
+            
+        return {'user_id': user_id, 'parent_path': parent_path,
+            'name': name, 'date': date}
+        
+    @classmethod
+    def get_dimensions(cls, date):
+        dimensions = TimeSeriesData.get_dimensions(date)
+        return {field: dimensions[field] for field in cls.calendar_fields}
+    
+    @classmethod
+    def increment_many(cls, counts, batch_size = None, token = None):
+        """
+        Takes the same counts as TimeSeriesData.increment_many. The counts are
+        grouped into days and written with two unordered bulk passes: the
+        first creates any missing buckets with their values zeroed, since $inc
+        can only address an array slot that exists, and the second adds to the
+        hourly slots and the day's sum with one $inc per bucket.
+        
+        Given a token, each bucket records it and is only added to if it
+        does not have it yet, so that the same counts can be written again
+        safely (see async_tasks.datastreams.bucketize).
+        """
+        days = OrderedDict()
+        
+        for (user_id, parent_path, name, timestamp), amount in counts.items():
+            timestamp = utc_naive(timestamp)
+            hours = days.setdefault(
+                (user_id, parent_path, name, cls.get_date(timestamp)), {})
+            hours[timestamp.hour] = hours.get(timestamp.hour, 0) + amount
+            
+        def add_allocation(bulk, key):
+            bulk.find(cls.get_key(*key)).upsert().update_one({
+                '$setOnInsert': dict(cls.get_dimensions(key[3]),
+                    value = 0, values = [0] * cls.hours)})
+            
+        def add_increment(bulk, item):
+            key, hours = item
+            increments = {'values.%d' % hour: amount
+                for hour, amount in hours.items()}
+            increments['value'] = sum(hours.values())
+            
+            if token:
+                bulk.find(dict(cls.get_key(*key), tokens = {'$ne': token})
+                    ).update_one({'$inc': increments,
+                        '$addToSet': {'tokens': token}})
+            else:
+                bulk.find(cls.get_key(*key)).update_one({'$inc': increments})
+            
+        collection = cls.get_collection()
+        bulk_write(collection, days.keys(), add_allocation, batch_size)
+        return bulk_write(collection, days.items(), add_increment, batch_size)
+    
+    @classmethod
+    def clear_tokens(cls):
+        """Drops the tokens increment_many() recorded in the buckets."""
+        collection = cls.get_collection()
+        db.scope.invalidate(collection.full_name)
+        collection.update({'tokens': {'$exists': True}},
+            {'$unset': {'tokens': 1}}, multi = True)
+        
+    @classmethod
+    def get_hours(cls, bucket):
+        '''
+        Yields the documents the hourly layout would hold for a bucket. Hours
+        at zero are left out, since the hourly layout only has documents for
+        the hours something was counted in.
+        '''
+        dimensions = calendar_table.get_range(bucket['date'], cls.hours)
+        
+        for hour, value in enumerate(bucket['values']):
+            if value:
+                timestamp = bucket['date'] + datetime.timedelta(hours = hour)
+                yield dict(dimensions[hour],
+                    user_id = bucket['user_id'],
+                    parent_path = bucket['parent_path'],
+                    name = bucket['name'], timestamp = timestamp,
+                    value = value)
+                
+    @mongodb_init
+    def __init__(self, user_id = None, parent_path = None, name = 'totals',
+    date = None, value = 0, values = None, **kwargs):
+        self.update(kwargs)
+        self.user_id = user_id
+        self.parent_path = parent_path
+        self.name = name
+        self.date = date
+        self.value = value
+        self.values = values if values is not None else [0] * self.hours
+        
+
+class TimeSeriesRollup(AsyncModel):
+    '''
+    The sum of a time series over a day, ISO week, month or year. Every write
+    made through TimeSeriesData.increment_many (and every change a custom
+    datastream makes) is added to the rollups of the periods it falls in.
+    Each rollup carries the calendar fields that stay the same throughout its
+    period, so queries grouping by those fields alone can be answered from the
+    rollups rather than by summing up hours.
+    '''
+    table = 'timeseries_rollups'
+    indexes = [Index('user_id', 'parent_path', 'name', 'period', 'start',
+        unique = True)]
+    # From the finest period to the coarsest.
+    periods = OrderedDict([
+        ('day', TimeSeriesDayBucket.calendar_fields),
+        ('isoweek', ['isoyear', 'isoweek']),
+        ('month', ['year', 'month']),
+        ('year', ['year'])
+    ])
+    fields = ('user_id', 'parent_path', 'name', 'period', 'start', 'value'
+        ) + tuple(periods['day'])
+    
+    @classmethod
+    def get_start(cls, period, timestamp):
+        """Returns the (naive UTC) start of the period a timestamp is in."""
+        day = TimeSeriesDayBucket.get_date(timestamp)
+        
+        if period == 'day':
+            return day
+        elif period == 'isoweek':
+            return day - datetime.timedelta(days = day.weekday())
+        elif period == 'month':
+            return day.replace(day = 1)
+        elif period == 'year':
+            return day.replace(month = 1, day = 1)
+        
+        raise ValueError("Unknown rollup period %r." % period)
+        
+    @classmethod
+    def get_key(cls, user_id, parent_path, name, period, start):
+        if user_id and not isinstance(user_id, ObjectId):
+            user_id = ObjectId(user_id)
+            
+        return {'user_id': user_id, 'parent_path': parent_path, 'name': name,
+            'period': period, 'start': start}
+        
+    @classmethod
+    def get_dimensions(cls, period, start):
+        dimensions = TimeSeriesData.get_dimensions(start)
+        return {field: dimensions[field] for field in cls.periods[period]}
+        
+    @classmethod
+    def find_period(cls, fields, min_date = None, max_date = None):
+        '''
+        Returns the coarsest period whose rollups carry all of the given
+        calendar fields and start on min_date and max_date (if given), or None
+        if no period can answer for them.
+        '''
+        for period in reversed(cls.periods.keys()):
+            if (all(field in cls.periods[period] for field in fields)
+            and all(cls.get_start(period, date) == utc_naive(date)
+                for date in [min_date, max_date] if date)):
+                return period
+    
+    @classmethod
+    def increment_many(cls, counts, batch_size = None, periods = None):
+        """
+        Adds the same counts as TimeSeriesData.increment_many to the rollups
+        of the given periods (all of them by default).
+        """
+        totals = OrderedDict()
+        
+        for (user_id, parent_path, name, timestamp), amount in counts.items():
+            for period in (periods or cls.periods):
+                key = (user_id, parent_path, name, period,
+                    cls.get_start(period, timestamp))
+                totals[key] = totals.get(key, 0) + amount
+                
+        def add_increment(bulk, item):
+            key, amount = item
+            bulk.find(cls.get_key(*key)).upsert().update_one({
+                '$inc': {'value': amount},
+                '$setOnInsert': cls.get_dimensions(key[3], key[4])})
+            
+        return bulk_write(cls.get_collection(), totals.items(), add_increment,
+            batch_size = batch_size)
+        
+    @mongodb_init
+    def __init__(self, user_id = None, parent_path = None, name = 'totals',
+    period = 'day', start = None, value = 0, **kwargs):
+        self.update(kwargs)
+        self.user_id = user_id
+        self.parent_path = parent_path
+        self.name = name
+        self.period = period
+        self.start = start
+        self.value = value
+        
+
+class CompactionHorizon(AsyncModel):
+    '''
+    Records how far back async_tasks.datastreams.compact has folded the hours
+    of TimeSeriesData and TimeSeriesDayBucket into day rollups. Before the
+    horizon, a series only has its day (and coarser) rollups, plus whatever
+    hours were written there since.
+    '''
+    table = 'timeseries_compaction'
+    indexes = [Index('name', unique = True)]
+    fields = ('name', 'horizon', 'compacted_at')
+    
+    @classmethod
+    def get_horizon(cls, name = 'timeseries'):
+        """Returns the (naive UTC) horizon, or None if nothing is compacted."""
+        horizon = cls.find_one({'name': name}, fields = ['horizon'])
+        return horizon['horizon'] if horizon else None
+    
+    @classmethod
+    def set_horizon(cls, horizon, name = 'timeseries'):
+        compaction = cls.find_or_create(name = name)
+        compaction.horizon = horizon
+        compaction.compacted_at = datetime.datetime.utcnow()
+        return compaction.save()
+        
+    @mongodb_init
+    def __init__(self, name = 'timeseries', horizon = None,
+    compacted_at = None):
+        self.name = name
+        self.horizon = horizon
+        self.compacted_at = compacted_at
+        
+
+class DataVersion(AsyncModel):
+    '''
+    Counts the changes to each user's time series, for keying cached results
+    so they are dropped when the data under them changes. The version goes
+    up with every write to any of the user's series, and the count under
+    paths with every write to the series at that parent path. Both are kept
+    in one document per user, so one find_one reads them all.
+    
+    Writers bump them once their data is written, so a reader that sees the
+    new version also sees the new data. The epoch is set when the document
+    is created, so versions that start over do not repeat old keys.
+    '''
+    table = 'data_versions'
+    indexes = [Index('user_id', unique = True)]
+    fields = ('user_id', 'epoch', 'version', 'paths')
+    
+    @classmethod
+    def get_field(cls, parent_path):
+        """Returns the field counting a path's changes, dots escaped."""
+        return 'paths.' + parent_path.replace('%', '%25').replace(
+            '.', '%2E').replace('$', '%24')
+        
+    @classmethod
+    def bump(cls, changes, batch_size = None):
+        """
+        Bumps the versions of the (user_id, parent_path) pairs given, with
+        one upsert per user. A parent_path of None only bumps the user's
+        version.
+        """
+        paths = OrderedDict()
+        
+        for user_id, parent_path in changes:
+            if user_id:
+                paths.setdefault(ObjectId(user_id), set()).add(parent_path)
+                
+        def add_bump(bulk, item):
+            user_id, parent_paths = item
+            increments = {cls.get_field(parent_path): 1
+                for parent_path in parent_paths if parent_path}
+            increments['version'] = 1
+            bulk.find({'user_id': user_id}).upsert().update_one({
+                '$inc': increments, '$setOnInsert': {'epoch': ObjectId()}})
+            
+        return bulk_write(cls.get_collection(), paths.items(), add_bump,
+            batch_size)
+        
+    @classmethod
+    def get_key(cls, user_id, parent_paths = None):
+        '''
+        Returns a tuple that changes whenever the user's data does, or only
+        the data at parent_paths if they are given.
+        '''
+        fields = ['epoch'] + (['version'] if parent_paths is None
+            else [cls.get_field(parent_path) for parent_path in parent_paths])
+        versions = cls.find_one({'user_id': ObjectId(user_id)},
+            fields = fields) or {}
+        
+        if parent_paths is None:
+            return (versions.get('epoch'), versions.get('version', 0))
+            
+        return (versions.get('epoch'),) + tuple(versions.get('paths', {}).get(
+            cls.get_field(parent_path)[len('paths.'):], 0)
+            for parent_path in parent_paths)
+        
+    @mongodb_init
+    def __init__(self, user_id = None, epoch = None, version = 0,
+    paths = None):
+        self.user_id = user_id
+        self.epoch = epoch
+        self.version = version
+        self.paths = paths or {}
+        
+
+class CachedQueryResult(AsyncModel):
+    '''
+    A query result shared between processes by async_tasks.query_cache,
+    under the hash of the query and the data versions it was computed at.
+    Results are never stale, as new data means new versions, so old ones are
+    only dropped by MongoDB once they are max_age seconds old.
+    '''
+    table = 'timeseries_query_cache'
+    max_age = 24 * 60 * 60
+    indexes = [Index('key', unique = True),
+        Index('stored_at', expireAfterSeconds = max_age)]
+    fields = ('key', 'data', 'stored_at')
+    
+    @mongodb_init
+    def __init__(self, key = None, data = None, stored_at = None):
+        self.key = key
+        self.data = data
+        self.stored_at = stored_at
+        
+
+class TimeSeriesCounter(object):
+    """
+    Accumulates increments to time series datapoints in memory and writes them
+    all at once, with a single bulk operation, whenever it is flushed.
+    
+    A counter's writes are made one after another, even when flushed in the
+    background: two flushes upserting the same hour at once could each
+    insert a datapoint for it, as the timeseries index is not unique.
+    """
+    def __init__(self, model_class = TimeSeriesData):
+        self.model_class = model_class
+        self.counts = OrderedDict()
+        # The (user_id, parent_path) of every series flushed so far.
+        self.flushed = set()
+        # The Future of the last background write.
+        self.pending = None
+        
+    def add(self, user_id, parent_path, timestamp, amount = 1,
+    name = 'totals'):
+        key = (user_id, parent_path, name,
+            self.model_class.simplify_timestamp(timestamp))
+        self.counts[key] = self.counts.get(key, 0) + amount
+        
+    def flush(self):
+        self.wait()
+        # Recorded first, as a failed write may still have written some.
+        self.add_flushed(self.counts)
+        result = self.model_class.increment_many(self.counts)
+        self.counts = OrderedDict()
+        return result
+        
+    def aflush(self):
+        """
+        Hands the counts accumulated so far to the db executor to be written,
+        once the previous background write is done, and starts afresh.
+        Returns a Future for the write's report.
+        """
+        counts, self.counts = self.counts, OrderedDict()
+        self.add_flushed(counts)
+        previous = self.pending
+        
+        def write():
+            # The executor starts work in the order it is submitted, so the
+            # previous write is already running or done. Its failure is
+            # raised by whoever gathers its Future, not here.
+            if previous:
+                previous.exception()
+                
+            return self.model_class.increment_many(counts)
+            
+        self.pending = db.asynchronous.submit(write)
+        return self.pending
+        
+    def wait(self):
+        """Waits for the background writes to finish, failed or not."""
+        if self.pending:
+            self.pending.exception()
+        
+    def add_flushed(self, counts):
+        self.flushed.update((user_id, parent_path)
+            for user_id, parent_path, name, timestamp in counts)
+        
+    def bump_versions(self):
+        """Bumps the DataVersion of every series flushed since last time."""
+        flushed, self.flushed = self.flushed, set()
+        return DataVersion.bump(flushed)
+    
+    def __len__(self):
+        return len(self.counts)
+    
+
 class CustomTimeSeriesData(TimeSeriesData):
+    bucketed = False
+    
     def __init__(self, client_id, **kwargs):
         self.client_id = client_id
         super(CustomTimeSeriesData, self).__init__(**kwargs)
@@ -145,6 +941,10 @@ class Correlation(AsyncModel):
     Keeps track of what correlations we've found.
     '''
     table = "correlation"
+    indexes = [Index('key', 'start')]
+    fields = ('user_id', 'start', 'end', 'paths', 'group_by', 'sort',
+        'correlation', 'threshold', 'key')
+    record_methods = ('json_filter',)
     
     @mongodb_init
     def __init__(self, user_id = '', dimension = '', start = '', end = '',
@@ -0,0 +1,190 @@
+'''
+Caches the results of UserTimeSeriesQuery.get_data(), which dashboards ask
+for over and over, and of get_data_by_path(), which is cached path by path.
+
+A result is keyed on a normalized form of its query (the user, paths, match,
+grouping, aggregation, dates, sort and whether it is continuous) plus the
+DataVersion of the paths it reads, which the ingestion handlers bump once
+they have written new data. New data thus means a new key, and cached
+results are never stale; old ones are simply evicted. Continuous queries
+without a max_date fill zeroes up to the current hour, so they are keyed on
+the hour too.
+
+Each process keeps the TIMESERIES_QUERY_CACHE_SIZE most recently used
+results (0 turns the cache off). With TIMESERIES_QUERY_CACHE_SHARED set,
+results are also kept in the timeseries_query_cache collection, so that
+every worker can use what any of them has computed. get_stats() counts the
+hits, misses and evictions in this process.
+'''
+import app as platform
+import bson.json_util
+import copy
+import datetime
+import db.scope
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from .models import (TimeSeriesData, DataVersion, CachedQueryResult,
+    utc_naive)
+
+DEFAULT_SIZE = 1000
+LOGGER = logging.getLogger(__name__)
+
+def get_size():
+    return platform.get_setting('TIMESERIES_QUERY_CACHE_SIZE', DEFAULT_SIZE)
+
+def use_shared():
+    return platform.get_setting('TIMESERIES_QUERY_CACHE_SHARED', False)
+
+
+class QueryCache(object):
+    """A size-bounded, least recently used cache of query results."""
+    def __init__(self):
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(
+            ['hits', 'shared_hits', 'misses', 'evictions'], 0)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        with self.lock:
+            if key in self.results:
+                self.results[key] = self.results.pop(key)
+                return True, self.results[key]
+
+        return False, None
+
+    def put(self, key, data, size):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = data
+
+            while len(self.results) > size:
+                self.results.popitem(last = False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+            for stat in self.stats:
+                self.stats[stat] = 0
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, size = len(self.results))
+
+
+cache = QueryCache()
+
+def get_key(query, parent_paths):
+    """Returns the normalized query and data versions, as a string."""
+    continuous_until = None
+
+    if query.continuous and not query.max_date:
+        continuous_until = TimeSeriesData.simplify_timestamp(
+            datetime.datetime.utcnow())
+
+    sort = query.sort.items() if isinstance(query.sort, dict) else query.sort
+    return bson.json_util.dumps([
+        query.model_class.__name__, query.user['_id'], query.parent_path,
+        query.aspect_name, query.match or None, sorted(query.group_by),
+        query.aggregate or None, utc_naive(query.min_date),
+        utc_naive(query.max_date), list(sort) if sort else None,
+        bool(query.continuous), continuous_until,
+        DataVersion.get_key(query.user['_id'], parent_paths)],
+        sort_keys = True)
+
+def get_shared(key):
+    result = CachedQueryResult.find_one({'key': key}, fields = ['data'])
+    return (True, result['data']) if result else (False, None)
+
+def put_shared(key, data):
+    collection = CachedQueryResult.get_collection()
+    db.scope.invalidate(collection.full_name)
+    collection.update({'key': key}, {'$set': {
+        'data': data, 'stored_at': datetime.datetime.utcnow()}},
+        upsert = True)
+
+def lookup(key, size):
+    '''
+    Returns whether a result is cached under key, the result if it is, and
+    the key to share it under, if results are shared.
+    '''
+    found, data = cache.get(key)
+
+    if found:
+        cache.count('hits')
+        return True, copy.deepcopy(data), None
+
+    # The shared collection is keyed on a hash, as the keys can get long.
+    shared_key = hashlib.sha1(key).hexdigest() if use_shared() else None
+
+    if shared_key:
+        found, data = get_shared(shared_key)
+
+    if found:
+        cache.count('shared_hits')
+        cache.put(key, copy.deepcopy(data), size)
+    else:
+        cache.count('misses')
+        LOGGER.debug("Query cache miss: %s" % key)
+
+    return found, data, shared_key
+
+def store(key, shared_key, data, size):
+    if shared_key:
+        put_shared(shared_key, data)
+
+    cache.put(key, copy.deepcopy(data), size)
+
+def get_data(query, parent_paths, compute):
+    '''
+    Returns the cached result of a query reading parent_paths, or else what
+    compute() returns, after caching it. Results are copied on the way in
+    and out, so callers are free to change them.
+    '''
+    size = get_size()
+
+    if not size:
+        return compute()
+
+    key = get_key(query, parent_paths)
+    found, data, shared_key = lookup(key, size)
+
+    if not found:
+        data = compute()
+        store(key, shared_key, data, size)
+
+    return data
+
+def get_many(queries, compute):
+    '''
+    Returns the results of a list of (query, parent_paths) pairs, as
+    get_data() would, where compute() takes the pairs that are not cached
+    and works out the list of their results together.
+    '''
+    size = get_size()
+
+    if not size:
+        return compute(queries)
+
+    keys = [get_key(query, parent_paths) for query, parent_paths in queries]
+    looked_up = [lookup(key, size) for key in keys]
+    missing = [i for i, (found, _, _) in enumerate(looked_up) if not found]
+    results = [data for _, data, _ in looked_up]
+
+    if missing:
+        for i, data in zip(missing, compute([queries[i] for i in missing])):
+            store(keys[i], looked_up[i][2], data, size)
+            results[i] = data
+
+    return results
+
+def get_stats():
+    """Returns the hits, shared hits, misses and evictions so far."""
+    return cache.get_stats()
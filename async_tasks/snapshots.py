@@ -0,0 +1,350 @@
+'''
+Snapshots of users' hourly time series in local, memory-mapped files, so that
+correlation jobs and heavy queries can read a user's history without going
+back to the database every time.
+
+Each user gets a directory under the TIMESERIES_SNAPSHOT_DIR setting (no
+snapshots are written or read while it is unset) holding, for every parent
+path, two columns of the same length in raw binary files:
+
+    <path>.hours    int32 offsets in hours from calendar_table.EPOCH, sorted
+    <path>.values   int64 values, or float64 if any value is fractional
+
+plus a manifest.json recording how many rows each path has and the progress
+markers it was exported at: the LastPostRetrieved positions of the path's
+datastream and the LastCustomDataPull time of a custom datastream's path.
+A snapshot is fresh while those markers are unchanged and it is younger than
+TIMESERIES_SNAPSHOT_MAX_AGE seconds.
+
+Exporting a stale path only re-reads the hours from the last one it has,
+since ingestion only adds to recent hours, and writes them after the rows it
+keeps. Custom datastreams can replace any of their values, so their paths are
+exported in full. Either way, the columns are written into new files that
+replace the old ones, so readers still mapping those never see them change.
+
+    python -m async_tasks.snapshots [--user USER_ID] [--full]
+'''
+import app as platform
+import argparse
+import datetime
+import errno
+import json
+import logging
+import numpy
+import os
+import urllib
+from bson.objectid import ObjectId
+from oauth_provider.models import UID, User
+from . import calendar_table
+from .models import (TimeSeriesData, TimeSeriesDayBucket, LastPostRetrieved,
+    LastCustomDataPull, get_number, utc_naive)
+
+MANIFEST = 'manifest.json'
+HOURS_DTYPE = numpy.int32
+DEFAULT_MAX_AGE = 24 * 60 * 60
+LOGGER = logging.getLogger(__name__)
+
+def get_root():
+    """Returns the directory snapshots are kept in, or None if they are off."""
+    return platform.get_setting('TIMESERIES_SNAPSHOT_DIR')
+
+def get_max_age():
+    return datetime.timedelta(seconds = platform.get_setting(
+        'TIMESERIES_SNAPSHOT_MAX_AGE', DEFAULT_MAX_AGE))
+
+def get_markers(user_id, parent_paths):
+    '''
+    Returns a dictionary mapping each of parent_paths to the progress markers
+    whose changes mean there may be new data under it: the positions of the
+    user's accounts on the path's datastream, and the last pull of the
+    custom datastream at the path. They are read for all the paths at once.
+    '''
+    datastreams = sorted(set(path.split('/')[0] for path in parent_paths))
+    uids = {}
+    positions = {}
+    pulls = {}
+
+    for row in UID.find({'user_id': user_id, 'datastream': {
+    '$in': datastreams}}, fields = ['uid', 'datastream']):
+        uids.setdefault(row['datastream'], set()).add(row['uid'])
+
+    if uids:
+        for row in LastPostRetrieved.find({'uid': {'$in': sorted(set.union(
+        *uids.values()))}, 'datastream': {'$in': sorted(uids)}},
+        fields = ['uid', 'datastream', 'post_id']):
+            if row['uid'] in uids[row['datastream']]:
+                positions.setdefault(row['datastream'], []).append(
+                    '%s:%s' % (row['datastream'], row.get('post_id')))
+
+    for row in LastCustomDataPull.find({'user_id': user_id,
+    'path': {'$in': list(parent_paths)}}, fields = ['path', 'last_pulled']):
+        pulls.setdefault(row['path'], []).append(
+            'custom:%s' % row.get('last_pulled'))
+
+    return {path: sorted(positions.get(path.split('/')[0], []))
+        + sorted(pulls.get(path, [])) for path in parent_paths}
+
+def read_hours(user_id, parent_path, since = None):
+    '''
+    Returns the hours from since on of a user's data under parent_path,
+    from both storage layouts, as sorted arrays of hour offsets and values.
+    '''
+    spec = {'user_id': user_id, 'parent_path': parent_path, 'name': 'totals'}
+    hourly = dict(spec, timestamp = {'$gte': since} if since else {
+        '$exists': True})
+    daily = dict(spec, date = {'$gte': TimeSeriesDayBucket.get_date(since)}
+        ) if since else spec
+    hours = {}
+
+    documents = list(TimeSeriesData.find(hourly,
+        fields = ['timestamp', 'value']))
+
+    for bucket in TimeSeriesDayBucket.find(daily,
+    fields = ['user_id', 'parent_path', 'name', 'date', 'values']):
+        documents.extend(document
+            for document in TimeSeriesDayBucket.get_hours(bucket)
+            if not since or document['timestamp'] >= since)
+
+    for document in documents:
+        offset = calendar_table.TABLE.get_offset(
+            utc_naive(document['timestamp']))
+        hours[offset] = hours.get(offset, 0) + get_number(
+            document.get('value'))
+
+    offsets = sorted(hours)
+    values = [hours[offset] for offset in offsets]
+    dtype = (numpy.int64 if all(isinstance(value, (int, long))
+        for value in values) else numpy.float64)
+
+    return (numpy.array(offsets, dtype = HOURS_DTYPE),
+        numpy.array(values, dtype = dtype))
+
+def get_parent_paths(user_id, prefix = ''):
+    """Returns every parent path the user has time series data under."""
+    paths = set(TimeSeriesData.find({'user_id': user_id,
+        'timestamp': {'$exists': True}}).distinct('parent_path'))
+    paths.update(TimeSeriesDayBucket.find({'user_id': user_id}).distinct(
+        'parent_path'))
+
+    return sorted(path for path in paths if path and path.startswith(prefix))
+
+
+class Series(object):
+    '''
+    The hours and values of one path, memory-mapped read-only from its
+    snapshot files.
+    '''
+    def __init__(self, snapshot, parent_path, entry):
+        self.parent_path = parent_path
+        self.entry = entry
+        self.hours = snapshot.open_column(entry['file'] + '.hours',
+            HOURS_DTYPE, entry['rows'])
+        self.values = snapshot.open_column(entry['file'] + '.values',
+            numpy.dtype(entry['dtype']), entry['rows'])
+
+    def __len__(self):
+        return len(self.hours)
+
+    def between(self, first = None, last = None):
+        '''
+        Returns the hours and values of the rows with offsets in [first, last),
+        as views onto the files.
+        '''
+        start = (numpy.searchsorted(self.hours, first) if first is not None
+            else 0)
+        end = (numpy.searchsorted(self.hours, last) if last is not None
+            else len(self.hours))
+        return self.hours[start:end], self.values[start:end]
+
+
+class Snapshot(object):
+    """A user's snapshot directory and its manifest."""
+    def __init__(self, user_id, root = None):
+        self.user_id = user_id
+        self.directory = os.path.join(root or get_root(), str(user_id))
+        self.manifest = self.read_manifest()
+
+    def get_file(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_manifest(self):
+        try:
+            with open(self.get_file(MANIFEST)) as manifest:
+                return json.load(manifest)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+            return {'paths': {}}
+
+    def write_manifest(self):
+        # Written aside and moved into place, so readers never see half of it.
+        temporary = self.get_file(MANIFEST + '.tmp')
+
+        with open(temporary, 'w') as manifest:
+            json.dump(self.manifest, manifest, indent = 1, sort_keys = True)
+
+        os.rename(temporary, self.get_file(MANIFEST))
+
+    def open_column(self, name, dtype, rows):
+        if not rows:
+            return numpy.zeros(0, dtype = dtype)
+
+        return numpy.memmap(self.get_file(name), dtype = dtype, mode = 'r',
+            shape = (rows,))
+
+    def is_fresh(self, parent_path, markers = None, now = None):
+        entry = self.manifest['paths'].get(parent_path)
+
+        if not entry:
+            return False
+
+        exported = datetime.datetime.strptime(entry['exported_at'],
+            '%Y-%m-%dT%H:%M:%S')
+
+        if (now or datetime.datetime.utcnow()) - exported > get_max_age():
+            return False
+
+        if markers is None:
+            markers = get_markers(self.user_id, [parent_path])[parent_path]
+
+        return entry['markers'] == markers
+
+    def get_series(self, parent_path):
+        entry = self.manifest['paths'].get(parent_path)
+        return Series(self, parent_path, entry) if entry else None
+
+    def export(self, parent_path, full = False, markers = None):
+        '''
+        Brings the snapshot of parent_path up to date unless it is fresh,
+        given the path's markers if they have been read already. Returns the
+        number of rows read from the database.
+        '''
+        # The markers are read before the data, so that the snapshot never
+        # claims to include data it has not read.
+        if markers is None:
+            markers = get_markers(self.user_id, [parent_path])[parent_path]
+
+        entry = self.manifest['paths'].get(parent_path)
+
+        if entry and not full and self.is_fresh(parent_path, markers):
+            return 0
+
+        incremental = (entry and not full and entry['rows']
+            and not any(marker.startswith('custom:') for marker in markers))
+        since = (calendar_table.TABLE.get_timestamp(entry['last'])
+            if incremental else None)
+        hours, values = read_hours(self.user_id, parent_path, since)
+
+        if incremental and values.dtype != numpy.dtype(entry['dtype']):
+            if values.dtype == numpy.int64:
+                values = values.astype(numpy.float64)
+            else:
+                return self.export(parent_path, True, markers)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if incremental:
+            # The last hour is read again, so it is replaced along with
+            # everything after it.
+            kept = entry['rows'] - 1
+        else:
+            kept = 0
+            entry = {'file': urllib.quote(parent_path, safe = ''),
+                'dtype': values.dtype.name}
+
+        self.write_columns(entry['file'], hours, values, kept)
+
+        rows = kept + len(hours)
+        entry.update({'rows': rows, 'markers': markers,
+            'exported_at': datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S'),
+            'first': entry.get('first') if kept else (
+                int(hours[0]) if len(hours) else None),
+            'last': int(hours[-1]) if len(hours) else entry.get('last')})
+        self.manifest['paths'][parent_path] = entry
+        self.write_manifest()
+
+        return len(hours)
+
+    def write_columns(self, name, hours, values, kept = 0):
+        '''
+        Writes the columns of a path after the first kept rows of the old
+        ones. New files are moved over the old ones, so anything still
+        mapping the old files keeps reading them unchanged.
+        '''
+        for suffix, column in [('.hours', hours), ('.values', values)]:
+            path = self.get_file(name + suffix)
+            temporary = path + '.tmp'
+
+            with open(temporary, 'wb') as column_file:
+                if kept:
+                    with open(path, 'rb') as old_file:
+                        column_file.write(old_file.read(
+                            kept * column.itemsize))
+
+                column_file.write(column.tostring())
+
+            os.rename(temporary, path)
+
+
+def load(user_id, parent_paths):
+    '''
+    Returns a dictionary mapping each of parent_paths to its Series if the
+    user has a fresh snapshot of every one of them, and None otherwise.
+    '''
+    if not get_root():
+        return None
+
+    snapshot = Snapshot(user_id)
+
+    if not all(path in snapshot.manifest['paths'] for path in parent_paths):
+        return None
+
+    markers = get_markers(user_id, parent_paths)
+
+    if not all(snapshot.is_fresh(path, markers[path])
+    for path in parent_paths):
+        return None
+
+    return {path: snapshot.get_series(path) for path in parent_paths}
+
+def export(user_id, parent_paths = None, full = False, prefix = ''):
+    '''
+    Brings a user's snapshots of parent_paths (by default, every path with
+    data starting with prefix) up to date. Returns the number of rows read
+    from the database.
+    '''
+    if not get_root():
+        return 0
+
+    snapshot = Snapshot(user_id)
+    parent_paths = parent_paths or get_parent_paths(user_id, prefix)
+    markers = get_markers(user_id, parent_paths)
+    exported = 0
+
+    for parent_path in parent_paths:
+        exported += snapshot.export(parent_path, full, markers[parent_path])
+
+    return exported
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description = "Bring users' time series snapshots up to date.")
+    parser.add_argument('--user', dest = 'user_id', default = None,
+        help = 'only export this user')
+    parser.add_argument('--full', dest = 'full', action = 'store_const',
+        const = True, default = False,
+        help = 'export everything again rather than just the new hours')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    args = get_args()
+    user_ids = ([ObjectId(args.user_id)] if args.user_id else
+        [user['_id'] for user in User.find(fields = ['_id'])])
+
+    for user_id in user_ids:
+        LOGGER.info("%s rows exported for user %s." % (
+            export(user_id, full = args.full), user_id))
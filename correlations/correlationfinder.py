@@ -78,26 +78,16 @@ class CorrelationFinder(object):
             correlation.save()
             
     def retrieve_cache(self, correlation_key):
-        correlations = []
         params = {'key': correlation_key}
         
         if self.start:
-            params['start'] = {'$gte': start}
+            params['start'] = {'$gte': self.start}
         
         if self.end:
             params['end'] = {'$lte': self.end}
-                
-        #cache = [row for row in Correlation.get_collection().find(params
-        #    ).sort('start', pymongo.ASCENDING)]
             
-        
-        cache = Correlation.get_collection().find(params
-            ).sort('start', pymongo.ASCENDING)
-        
-        for row in cache:
-            correlations.append(Correlation(**row))
-        
-        return correlations
+        return list(Correlation.find_records(params,
+            sort = [('start', pymongo.ASCENDING)]))
 
     def generate_correlation_key(self):
         '''
@@ -128,18 +118,29 @@ class CorrelationFinder(object):
         if not end:
             end = self.end
         
-        # Get the data corresponding to every aspect required.
-        for path in self.paths:            
-            # And get the data for that aspect for every interval.
-            path, leaf_name = path.rsplit('/', 1)
-            query = UserTimeSeriesQuery(self.user, path+'/', leaf_name,
+        # Paths with the same aspect are read together, in one aggregation.
+        by_aspect = OrderedDict()
+        
+        for path in self.paths:
+            parent_path, leaf_name = path.rsplit('/', 1)
+            by_aspect.setdefault(leaf_name, []).append(parent_path + '/')
+            
+        data = {}
+        
+        for leaf_name, parent_paths in by_aspect.items():
+            query = UserTimeSeriesQuery(self.user, parent_paths[0], leaf_name,
                 match = self.match, group_by = self.group_by,
-                min_date = self.start, max_date = self.end, sort = self.sort)
-            datapoints = query.get_data()
+                min_date = start, max_date = end, sort = self.sort)
             
+            for parent_path, datapoints in query.get_data_by_path(
+            parent_paths).items():
+                data[parent_path + leaf_name] = datapoints
+        
+        # And get the data for every aspect for every interval.
+        for path in self.paths:
             path_data.append(OrderedDict([
                 (str([row[field] for field in self.group_by]), row['value']
-                ) for row in datapoints]))
+                ) for row in data[path]]))
 
         return path_data
 
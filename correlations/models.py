@@ -1,7 +1,10 @@
-from db.models import Model, mongodb_init
+from db.models import Model, Index, mongodb_init
 
 class Buff(Model):
     table = "buff"
+    fields = ('user_id', 'interval', 'start', 'end', 'correlation', 'aspects',
+        'template_key')
+    indexes = [Index('user_id')]
     
     @mongodb_init
     def __init__(self, user_id = '', interval = '', start = '',
@@ -20,6 +23,8 @@ class Buff(Model):
 
 class BuffTemplate(Model):
     table = "buff_template"
+    fields = ('text', 'key')
+    indexes = [Index('key')]
     
     @mongodb_init
     def __init__(self, text, key = 'default'):
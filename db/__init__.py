@@ -1,10 +1,47 @@
-import pymongo
+'''
+Entry points to the storage backend every model reads and writes through.
+
+The backend is picked by the DATABASE_BACKEND setting: 'mongo' (the default)
+talks to MongoDB through a pooled pymongo client, while 'memory' keeps
+everything in-process (see db.backends.memory), which lets benchmarks and
+tests run without a mongod. Both hand out objects with the subset of the
+pymongo client, database and collection API that the models use.
+'''
 import app as platform
+import threading
+from db.backends import create_backend
+
+_lock = threading.Lock()
+_backend = None
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = create_backend(
+                    platform.get_setting('DATABASE_BACKEND', 'mongo'))
+
+    return _backend
 
-if 'DATABASE_PORT' in platform.app.config:
-    PORT = platform.app.config['DATABASE_PORT']
-else:
-    PORT = 27017
+def set_backend(backend):
+    """
+    Replaces the current backend, e.g. with create_backend('memory'), and
+    returns the one it replaced.
+    """
+    global _backend
+
+    with _lock:
+        previous, _backend = _backend, backend
+
+    return previous
+
+def get_client(host = None, port = None):
+    return get_backend().get_client(host, port)
 
 def get_connection(db_name):
-    return pymongo.MongoClient(port = PORT)[db_name]
+    return get_backend().get_database(db_name)
+
+def get_collection(db_name, collection_name):
+    return get_backend().get_collection(db_name, collection_name)
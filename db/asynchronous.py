@@ -0,0 +1,157 @@
+'''
+Non-blocking variants of the Model API.
+
+The async methods on Model (afind_one, afind, aaggregate, abulk_insert,
+abulk_save, abulk_upsert, asave, ainsert) run their synchronous counterparts
+on a shared pool of worker threads and return concurrent.futures Futures, so
+that callers can start database work, carry on with something else (e.g. an
+HTTP fetch) and collect the result later:
+
+    pending = LastPostRetrieved.afind_one({'uid': uid})
+    page = fetch_next_page()
+    last_post = pending.result()
+
+Work submitted from inside a db.scope runs inside that same scope, so it
+shares its identity map and query stats, which lock themselves for it. The
+pool size is taken from the DATABASE_ASYNC_WORKERS setting and defaults to
+the connection pool size. Work that waits on the pool itself, like finalizing
+the ingestion handlers, runs on threads of its own through spawn().
+'''
+import app as platform
+import db.scope
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import islice
+
+DEFAULT_WORKERS = 10
+DEFAULT_CURSOR_BATCH_SIZE = 500
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+def get_executor():
+    """
+    Returns the shared executor, starting a new one in a process that was
+    forked after the current one was started, since threads do not survive a
+    fork.
+    """
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(platform.get_setting(
+                    'DATABASE_ASYNC_WORKERS', platform.get_setting(
+                        'DATABASE_POOL_SIZE', DEFAULT_WORKERS)))
+                _executor_pid = os.getpid()
+
+    return _executor
+
+def shutdown(wait = True):
+    global _executor
+
+    with _lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait = wait)
+
+        _executor = None
+
+def submit(func, *args, **kwargs):
+    """Runs func on the executor, inside the caller's current db scope."""
+    opened = db.scope.current_scope()
+
+    def run():
+        with db.scope.use_scope(opened):
+            return func(*args, **kwargs)
+
+    return get_executor().submit(run)
+
+def spawn(func, *args, **kwargs):
+    '''
+    Runs func on a thread of its own, inside the caller's current db scope,
+    and returns a Future for it. Unlike work given to submit(), func may wait
+    on work it submits itself: once such calls took every worker of the
+    pool, they would each wait for work that no worker is left to run.
+    '''
+    opened = db.scope.current_scope()
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            with db.scope.use_scope(opened):
+                result = func(*args, **kwargs)
+        except BaseException:
+            future.set_exception_info(*sys.exc_info()[1:])
+        else:
+            future.set_result(result)
+
+    thread = threading.Thread(target = run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def gather(futures):
+    """
+    Waits for every future and returns their results in order. If any of them
+    failed, the first failure is raised once all of them have finished.
+    """
+    futures = list(futures)
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+class AsyncCursor(object):
+    '''
+    Iterates over the results of a find() while fetching them in batches on
+    the executor. The next batch is requested as soon as the previous one
+    arrives, so the database round trip overlaps with whatever the caller
+    does with the documents it already has.
+    '''
+    def __init__(self, open_cursor, batch_size = None):
+        self._open_cursor = open_cursor
+        self._cursor = None
+        self._batch_size = batch_size or DEFAULT_CURSOR_BATCH_SIZE
+        self._documents = deque()
+        self._pending = submit(self._fetch)
+
+    def _fetch(self):
+        if self._cursor is None:
+            self._cursor = self._open_cursor()
+
+        return list(islice(self._cursor, self._batch_size))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self._documents:
+            if self._pending is None:
+                raise StopIteration
+
+            batch = self._pending.result()
+            self._pending = submit(self._fetch) if len(
+                batch) == self._batch_size else None
+            self._documents.extend(batch)
+
+        return self._documents.popleft()
+
+    __next__ = next
+
+    def close(self):
+        if self._pending is not None and not self._pending.cancel():
+            # The fetch is already running; let it finish with the cursor.
+            wait([self._pending])
+
+        self._pending = None
+
+        if self._cursor is not None:
+            self._cursor.close()
+
+        self._documents.clear()
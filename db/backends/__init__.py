@@ -0,0 +1,16 @@
+"""Storage backends for the db layer. See db.get_backend()."""
+
+BACKENDS = ['mongo', 'memory']
+
+def create_backend(name, config = None):
+    if name == 'mongo':
+        from db.backends.mongo import MongoBackend
+        return MongoBackend(config)
+
+    elif name == 'memory':
+        from db.backends.memory import MemoryBackend
+        return MemoryBackend()
+
+    else:
+        raise ValueError("Unknown database backend %r. Expected one of %s."
+            % (name, ', '.join(BACKENDS)))
@@ -0,0 +1,1185 @@
+'''
+An in-process storage backend with the subset of the pymongo API the models
+use: find/find_one with projections, sorting, skip and limit, insert, save,
+update and remove with the common update operators, unordered and ordered bulk
+operations and the aggregation framework stages used by TimeSeriesQuery
+($match, $group, $project, $sort, $limit, $skip and $unwind).
+
+Documents are stored the way MongoDB would hand them back: datetimes become
+naive UTC with millisecond precision, and everything is copied on the way in
+and out. Indexes are recorded so that index_information() and ensure_indexes
+work, but they are not used or enforced, apart from the unique _id.
+
+It exists so that benchmarks and tests can run without a mongod; select it
+with DATABASE_BACKEND = 'memory' or db.set_backend(create_backend('memory')).
+The module level match() and aggregate() functions work on any list of
+documents.
+'''
+import copy
+import datetime
+import re
+import threading
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+from pymongo.errors import BulkWriteError, DuplicateKeyError, InvalidOperation
+
+class Missing(object):
+    """Stands in for a field that is not present in a document."""
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = Missing()
+REGEX_TYPE = type(re.compile(''))
+
+
+class MemoryBackend(object):
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clients = {}
+
+    def get_client(self, host = None, port = None):
+        address = (host, port)
+
+        with self._lock:
+            if address not in self._clients:
+                self._clients[address] = MemoryClient(self._lock)
+
+        return self._clients[address]
+
+    def get_database(self, db_name, host = None, port = None):
+        return self.get_client(host, port)[db_name]
+
+    def get_collection(self, db_name, collection_name, host = None,
+    port = None):
+        return self.get_database(db_name, host, port)[collection_name]
+
+    def close(self):
+        self._clients = {}
+
+
+class MemoryClient(object):
+    def __init__(self, lock = None):
+        self._lock = lock or threading.RLock()
+        self._databases = {}
+
+    def __getitem__(self, db_name):
+        with self._lock:
+            if db_name not in self._databases:
+                self._databases[db_name] = MemoryDatabase(self, db_name)
+
+        return self._databases[db_name]
+
+    def __getattr__(self, db_name):
+        if db_name.startswith('_'):
+            raise AttributeError(db_name)
+
+        return self[db_name]
+
+    def database_names(self):
+        return self._databases.keys()
+
+    def drop_database(self, db_name):
+        self._databases.pop(getattr(db_name, 'name', db_name), None)
+
+    def close(self):
+        pass
+
+
+class MemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, collection_name):
+        with self.client._lock:
+            if collection_name not in self._collections:
+                self._collections[collection_name] = MemoryCollection(
+                    self, collection_name)
+
+        return self._collections[collection_name]
+
+    def __getattr__(self, collection_name):
+        if collection_name.startswith('_'):
+            raise AttributeError(collection_name)
+
+        return self[collection_name]
+
+    def collection_names(self):
+        return self._collections.keys()
+
+    def drop_collection(self, collection_name):
+        self._collections.pop(getattr(collection_name, 'name',
+            collection_name), None)
+
+
+class MemoryCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._lock = database.client._lock
+        self._documents = []
+        self._ids = {}
+        self._positions = {}
+        self._inserted = 0
+        self._lookups = {}
+        self._indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    # Reads
+
+    def find(self, spec = None, fields = None, skip = 0, limit = 0,
+    sort = None, **kwargs):
+        return MemoryCursor(self, spec, fields, skip, limit, sort)
+
+    def find_one(self, spec_or_id = None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+
+        for document in self.find(spec_or_id, *args, **kwargs).limit(1):
+            return document
+
+    def count(self):
+        return len(self._documents)
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def aggregate(self, pipeline, **kwargs):
+        if isinstance(pipeline, dict):
+            pipeline = [pipeline]
+
+        return {'result': aggregate(self._documents, pipeline), 'ok': 1.0}
+
+    def _matching(self, spec):
+        if not spec:
+            return list(self._documents)
+
+        if set(spec.keys()) == set(['_id']) and not isinstance(
+        spec['_id'], dict):
+            document = self._ids.get(_id_key(spec['_id']))
+            return [document] if document is not None else []
+
+        spec = normalize(spec)
+        lookup = self._get_lookup(spec)
+        documents = self._documents
+
+        if lookup is not None:
+            fields, lookup = lookup
+            documents = sorted(lookup.get(lookup_key(spec, fields), [])
+                + lookup[None], key = lambda document: self._positions[
+                    id(document)])
+
+        return [document for document in documents if match(document, spec)]
+
+    def _get_lookup(self, spec):
+        '''
+        Equality queries on plain values are answered from a hash of the
+        documents by the queried fields, which is built on first use and kept
+        up to date by every write. This keeps the upserts made by the bulk
+        writers from scanning the whole collection once per document.
+        '''
+        fields = tuple(sorted(spec.keys()))
+
+        if any(field.startswith('$') or not is_plain(spec[field])
+        for field in fields):
+            return None
+
+        if fields not in self._lookups:
+            lookup = self._lookups[fields] = {None: []}
+
+            for document in self._documents:
+                add_to_lookup(lookup, fields, document)
+
+        return fields, self._lookups[fields]
+
+    # Writes
+
+    def insert(self, doc_or_docs, manipulate = True, **kwargs):
+        documents = doc_or_docs if isinstance(doc_or_docs, list) else [
+            doc_or_docs]
+        ids = []
+
+        with self._lock:
+            for document in documents:
+                if '_id' not in document:
+                    document['_id'] = ObjectId()
+
+                self._add(copy.deepcopy(normalize(document)))
+                ids.append(document['_id'])
+
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def save(self, to_save, manipulate = True, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save)
+
+        self.update({'_id': to_save['_id']}, to_save, upsert = True)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert = False, manipulate = False,
+    multi = False, **kwargs):
+        with self._lock:
+            matched = self._matching(spec)
+
+            if not multi:
+                matched = matched[:1]
+
+            for existing in matched:
+                self._replace(existing, apply_update(existing, document))
+
+            result = {'n': len(matched), 'updatedExisting': bool(matched),
+                'ok': 1.0, 'err': None}
+
+            if not matched and upsert:
+                created = apply_update(upsert_base(spec), document,
+                    inserting = True)
+
+                if '_id' not in created:
+                    created['_id'] = ObjectId()
+
+                self._add(created)
+                result.update({'n': 1, 'upserted': created['_id']})
+
+        return result
+
+    def remove(self, spec_or_id = None, multi = True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+
+        with self._lock:
+            matched = self._matching(spec_or_id)
+
+            if not multi:
+                matched = matched[:1]
+
+            removed = set(id(document) for document in matched)
+            self._documents = [document for document in self._documents
+                if id(document) not in removed]
+
+            for document in matched:
+                del self._ids[_id_key(document['_id'])]
+                del self._positions[id(document)]
+
+                for fields, lookup in self._lookups.items():
+                    remove_from_lookup(lookup, fields, document)
+
+        return {'n': len(matched), 'ok': 1.0, 'err': None}
+
+    def drop(self):
+        with self._lock:
+            self._documents = []
+            self._ids = {}
+            self._positions = {}
+            self._lookups = {}
+            self._indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def _add(self, document):
+        key = _id_key(document['_id'])
+
+        if key in self._ids:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error index: %s.$_id_  dup key: { : %r }'
+                % (self.full_name, document['_id']), 11000)
+
+        self._ids[key] = document
+        self._positions[id(document)] = self._inserted
+        self._inserted += 1
+        self._documents.append(document)
+
+        for fields, lookup in self._lookups.items():
+            add_to_lookup(lookup, fields, document)
+
+    def _replace(self, existing, updated):
+        if _id_key(updated.get('_id')) != _id_key(existing['_id']):
+            raise InvalidOperation("The _id field cannot be changed.")
+
+        for fields, lookup in self._lookups.items():
+            remove_from_lookup(lookup, fields, existing)
+
+        existing.clear()
+        existing.update(updated)
+
+        for fields, lookup in self._lookups.items():
+            add_to_lookup(lookup, fields, existing)
+
+    # Indexes
+
+    def create_index(self, key_or_list, **kwargs):
+        if not isinstance(key_or_list, list):
+            key_or_list = [(key_or_list, 1)]
+
+        name = kwargs.pop('name', None) or '_'.join(
+            '%s_%s' % (key, direction) for key, direction in key_or_list)
+        self._indexes[name] = dict(kwargs, key = list(key_or_list))
+        return name
+
+    ensure_index = create_index
+
+    def index_information(self):
+        return copy.deepcopy(self._indexes)
+
+    def drop_index(self, index_or_name):
+        self._indexes.pop(index_or_name, None)
+
+    # Bulk operations
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulkOperation(self, ordered = False)
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulkOperation(self, ordered = True)
+
+    def __repr__(self):
+        return "<MemoryCollection (%s, %s documents)>" % (
+            self.full_name, len(self._documents))
+
+
+class MemoryCursor(object):
+    def __init__(self, collection, spec = None, fields = None, skip = 0,
+    limit = 0, sort = None):
+        self.collection = collection
+        self._spec = spec or {}
+        self._fields = fields
+        self._skip = skip
+        self._limit = limit
+        self._sort = sort
+        self._results = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = iter(self._execute())
+
+        return self._results.next()
+
+    __next__ = next
+
+    def _execute(self):
+        with self.collection._lock:
+            documents = self.collection._matching(self._spec)
+
+        if self._sort:
+            documents = sort_documents(documents, self._sort)
+
+        if self._skip:
+            documents = documents[self._skip:]
+
+        if self._limit:
+            documents = documents[:abs(self._limit)]
+
+        return [project_fields(document, self._fields)
+            for document in documents]
+
+    def sort(self, key_or_list, direction = 1):
+        if not isinstance(key_or_list, list):
+            key_or_list = [(key_or_list, direction)]
+
+        self._sort = key_or_list
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def count(self, with_limit_and_skip = False):
+        if not with_limit_and_skip:
+            return len(self.collection._matching(self._spec))
+
+        return len(self.clone()._execute())
+
+    def distinct(self, key):
+        values = []
+
+        for document in self.clone().limit(0).skip(0)._execute():
+            for value in resolve(document, key):
+                for item in (value if isinstance(value, list) else [value]):
+                    if item not in values:
+                        values.append(item)
+
+        return values
+
+    def clone(self):
+        return MemoryCursor(self.collection, self._spec, self._fields,
+            self._skip, self._limit, self._sort)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.clone().skip(index.start or 0).limit(
+                (index.stop - (index.start or 0)) if index.stop else 0)
+
+        for document in self.clone().skip(self._skip + index).limit(1):
+            return document
+
+        raise IndexError("no such item for Cursor instance")
+
+    def close(self):
+        self._results = iter([])
+
+
+class MemoryBulkOperation(object):
+    '''
+    Mirrors pymongo's BulkOperationBuilder: operations are queued with
+    insert() and find(...).update_one() and friends, then run by execute(),
+    which returns (or raises with a BulkWriteError) a result in the same
+    format.
+    '''
+    def __init__(self, collection, ordered = True):
+        self.collection = collection
+        self.ordered = ordered
+        self.operations = []
+        self.executed = False
+
+    def insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+
+        self.operations.append(('insert', document, None, False))
+
+    def find(self, selector):
+        return MemoryBulkSelector(self, selector)
+
+    def execute(self):
+        if self.executed:
+            raise InvalidOperation(
+                "Bulk operations can only be executed once.")
+
+        if not self.operations:
+            raise InvalidOperation("No operations to execute")
+
+        self.executed = True
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+            'nModified': 0, 'nRemoved': 0, 'upserted': [], 'writeErrors': [],
+            'writeConcernErrors': []}
+
+        for index, (kind, document, selector, upsert) in enumerate(
+        self.operations):
+            try:
+                self._run(result, index, kind, document, selector, upsert)
+            except DuplicateKeyError as err:
+                result['writeErrors'].append({'index': index, 'code': 11000,
+                    'errmsg': str(err), 'op': document})
+
+                if self.ordered:
+                    break
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+
+        return result
+
+    def _run(self, result, index, kind, document, selector, upsert):
+        collection = self.collection
+
+        if kind == 'insert':
+            collection.insert(document)
+            result['nInserted'] += 1
+
+        elif kind in ('update', 'update_one', 'replace_one'):
+            if kind == 'replace_one' and '_id' in selector:
+                document = dict(document, _id = selector['_id'])
+
+            outcome = collection.update(selector, document, upsert = upsert,
+                multi = kind == 'update')
+
+            if 'upserted' in outcome:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': index,
+                    '_id': outcome['upserted']})
+            else:
+                result['nMatched'] += outcome['n']
+                result['nModified'] += outcome['n']
+
+        else:
+            result['nRemoved'] += collection.remove(selector,
+                multi = kind == 'remove')['n']
+
+
+class MemoryBulkSelector(object):
+    def __init__(self, bulk, selector, upsert = False):
+        self.bulk = bulk
+        self.selector = selector
+        self._upsert = upsert
+
+    def upsert(self):
+        return MemoryBulkSelector(self.bulk, self.selector, True)
+
+    def _add(self, kind, document = None):
+        self.bulk.operations.append((kind, document, self.selector,
+            self._upsert))
+
+    def update_one(self, document):
+        self._add('update_one', document)
+
+    def update(self, document):
+        self._add('update', document)
+
+    def replace_one(self, document):
+        self._add('replace_one', document)
+
+    def remove_one(self):
+        self._add('remove_one')
+
+    def remove(self):
+        self._add('remove')
+
+
+# Values
+
+def _id_key(value):
+    return repr(normalize(value))
+
+def normalize(value):
+    """
+    Converts a value to what MongoDB would store: naive UTC datetimes with
+    millisecond precision, lists instead of tuples and plain dicts.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(utc).replace(tzinfo = None)
+
+        return value.replace(microsecond = value.microsecond // 1000 * 1000)
+
+    elif isinstance(value, dict):
+        return dict((key, normalize(item)) for key, item in value.items())
+
+    elif isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+
+    return value
+
+def is_plain(value):
+    """Whether a value only ever equals values of the same type and value."""
+    return not isinstance(value, (dict, list, REGEX_TYPE))
+
+def lookup_key(document, fields):
+    """
+    The key a document is hashed under in an equality lookup, or None when it
+    holds arrays or documents in those fields and has to be matched in full.
+    """
+    values = [first(document, field) for field in fields]
+
+    if not all(is_plain(value) for value in values):
+        return None
+
+    return tuple(sort_key(value) for value in values)
+
+def add_to_lookup(lookup, fields, document):
+    lookup.setdefault(lookup_key(document, fields), []).append(document)
+
+def remove_from_lookup(lookup, fields, document):
+    bucket = lookup.get(lookup_key(document, fields), [])
+
+    for index, candidate in enumerate(bucket):
+        if candidate is document:
+            del bucket[index]
+            break
+
+def type_rank(value):
+    """Orders values of different types the way BSON comparisons do."""
+    if value is None or value is MISSING:
+        return 1
+    elif isinstance(value, bool):
+        return 8
+    elif isinstance(value, (int, long, float)):
+        return 2
+    elif isinstance(value, basestring):
+        return 3
+    elif isinstance(value, dict):
+        return 4
+    elif isinstance(value, list):
+        return 5
+    elif isinstance(value, ObjectId):
+        return 7
+    elif isinstance(value, datetime.datetime):
+        return 9
+    elif isinstance(value, REGEX_TYPE):
+        return 11
+    return 6
+
+def sort_key(value):
+    rank = type_rank(value)
+
+    if rank == 1:
+        return (rank, None)
+    elif rank == 4:
+        return (rank, [(key, sort_key(item)) for key, item in value.items()])
+    elif rank == 5:
+        return (rank, [sort_key(item) for item in value])
+    return (rank, value)
+
+def compare(a, b):
+    return cmp(sort_key(a), sort_key(b))
+
+def equals(a, b):
+    return type_rank(a) == type_rank(b) and (type_rank(a) == 1 or a == b)
+
+def sort_documents(documents, spec):
+    """Sorts documents by a list of (field, direction) pairs or a SON/dict."""
+    if isinstance(spec, dict):
+        spec = spec.items()
+
+    documents = list(documents)
+
+    for key, direction in reversed(list(spec)):
+        documents.sort(key = lambda document: sort_key(first(document, key)),
+            reverse = direction < 0)
+
+    return documents
+
+
+# Field paths
+
+def resolve(value, path):
+    """
+    Returns every value found at a dotted path, looking inside arrays along the
+    way. An empty list means the path is missing.
+    """
+    parts = path.split('.') if isinstance(path, basestring) else path
+
+    if not parts:
+        return [value]
+
+    head, rest = parts[0], parts[1:]
+
+    if isinstance(value, dict):
+        return resolve(value[head], rest) if head in value else []
+
+    elif isinstance(value, list):
+        if head.isdigit():
+            index = int(head)
+            return resolve(value[index], rest) if index < len(value) else []
+
+        return [found for item in value if isinstance(item, dict)
+            for found in resolve(item, parts)]
+
+    return []
+
+def first(document, path):
+    values = resolve(document, path)
+    return values[0] if values else MISSING
+
+def set_path(document, path, value):
+    parts = path.split('.')
+    target = document
+
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+
+        if isinstance(target, list):
+            position = int(part)
+
+            while len(target) <= position:
+                target.append(None)
+
+            if last:
+                target[position] = value
+            elif not isinstance(target[position], (dict, list)):
+                target[position] = {}
+
+            target = target[position]
+
+        else:
+            if last:
+                target[part] = value
+            elif not isinstance(target.get(part), (dict, list)):
+                target[part] = {}
+
+            target = target[part]
+
+def unset_path(document, path):
+    parts = path.split('.')
+    found = resolve(document, parts[:-1]) if len(parts) > 1 else [document]
+
+    for parent in found:
+        if isinstance(parent, dict):
+            parent.pop(parts[-1], None)
+        elif isinstance(parent, list) and parts[-1].isdigit() and int(
+        parts[-1]) < len(parent):
+            parent[int(parts[-1])] = None
+
+def project_fields(document, fields):
+    """Applies a find() projection, given as a list of fields or a dict."""
+    if fields is None:
+        return copy.deepcopy(document)
+
+    if not isinstance(fields, dict):
+        fields = dict((field, 1) for field in fields)
+
+    including = [field for field, value in fields.items()
+        if value and field != '_id']
+
+    if including:
+        projected = {}
+
+        if fields.get('_id', 1) and '_id' in document:
+            projected['_id'] = copy.deepcopy(document['_id'])
+
+        for field in including:
+            value = first(document, field)
+
+            if value is not MISSING:
+                set_path(projected, field, copy.deepcopy(value))
+
+        return projected
+
+    projected = copy.deepcopy(document)
+
+    for field, value in fields.items():
+        if not value:
+            unset_path(projected, field)
+
+    return projected
+
+
+# Queries
+
+def match(document, query):
+    """Returns whether a document matches a find() query."""
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(match(document, part) for part in condition):
+                return False
+
+        elif key == '$or':
+            if not any(match(document, part) for part in condition):
+                return False
+
+        elif key == '$nor':
+            if any(match(document, part) for part in condition):
+                return False
+
+        elif key.startswith('$'):
+            raise NotImplementedError("Query operator %s" % key)
+
+        elif not matches_condition(resolve(document, key), condition):
+            return False
+
+    return True
+
+def is_operator_dict(value):
+    return isinstance(value, dict) and value and all(
+        key.startswith('$') for key in value.keys())
+
+def candidates(values):
+    """Values at a path plus the elements of any arrays among them."""
+    expanded = list(values)
+
+    for value in values:
+        if isinstance(value, list):
+            expanded.extend(value)
+
+    return expanded
+
+def matches_value(values, target):
+    if isinstance(target, REGEX_TYPE):
+        return any(isinstance(value, basestring) and target.search(value)
+            for value in candidates(values))
+
+    if target is None and not values:
+        return True
+
+    return any(equals(value, target) for value in candidates(values))
+
+def matches_condition(values, condition):
+    if not is_operator_dict(condition):
+        return matches_value(values, condition)
+
+    for operator, operand in condition.items():
+        if operator == '$eq':
+            matched = matches_value(values, operand)
+        elif operator == '$ne':
+            matched = not matches_value(values, operand)
+        elif operator == '$in':
+            matched = any(matches_value(values, item) for item in operand)
+        elif operator == '$nin':
+            matched = not any(matches_value(values, item) for item in operand)
+        elif operator == '$exists':
+            matched = bool(values) == bool(operand)
+        elif operator in COMPARISONS:
+            matched = any(type_rank(value) == type_rank(operand)
+                and COMPARISONS[operator](compare(value, operand))
+                for value in candidates(values))
+        elif operator == '$regex':
+            flags = re.I if 'i' in condition.get('$options', '') else 0
+            matched = matches_value(values, re.compile(operand, flags))
+        elif operator == '$options':
+            matched = True
+        elif operator == '$all':
+            matched = all(matches_value(values, item) for item in operand)
+        elif operator == '$size':
+            matched = any(isinstance(value, list) and len(value) == operand
+                for value in values)
+        elif operator == '$elemMatch':
+            matched = any(isinstance(item, dict) and match(item, operand)
+                for value in values if isinstance(value, list)
+                for item in value)
+        elif operator == '$not':
+            matched = not matches_condition(values, operand)
+        else:
+            raise NotImplementedError("Query operator %s" % operator)
+
+        if not matched:
+            return False
+
+    return True
+
+COMPARISONS = {
+    '$gt': lambda result: result > 0,
+    '$gte': lambda result: result >= 0,
+    '$lt': lambda result: result < 0,
+    '$lte': lambda result: result <= 0}
+
+
+# Updates
+
+def upsert_base(spec):
+    """The document an upsert starts from: the equality fields of its query."""
+    document = {}
+
+    for key, condition in (spec or {}).items():
+        if key == '$and':
+            for part in condition:
+                document.update(upsert_base(part))
+
+        elif not key.startswith('$') and not is_operator_dict(condition):
+            set_path(document, key, copy.deepcopy(condition))
+
+    return normalize(document)
+
+def apply_update(existing, update, inserting = False):
+    """Returns a copy of existing with an update document applied to it."""
+    update = normalize(update)
+
+    if not any(key.startswith('$') for key in update.keys()):
+        replaced = copy.deepcopy(update)
+
+        if '_id' in existing:
+            replaced['_id'] = existing['_id']
+
+        return replaced
+
+    document = copy.deepcopy(existing)
+
+    for operator, changes in update.items():
+        if operator == '$setOnInsert' and not inserting:
+            continue
+
+        for path, value in changes.items():
+            current = first(document, path)
+
+            if operator in ('$set', '$setOnInsert'):
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == '$unset':
+                unset_path(document, path)
+            elif operator == '$inc':
+                set_path(document, path, value if current in (None, MISSING)
+                    else current + value)
+            elif operator in ('$push', '$addToSet'):
+                items = value['$each'] if is_operator_dict(value) else [value]
+                current = list(current) if isinstance(current, list) else []
+
+                for item in items:
+                    if operator == '$push' or item not in current:
+                        current.append(copy.deepcopy(item))
+
+                set_path(document, path, current)
+            elif operator == '$pull':
+                if isinstance(current, list):
+                    set_path(document, path, [item for item in current
+                        if not (match(item, value) if isinstance(value, dict)
+                            and isinstance(item, dict) else item == value)])
+            else:
+                raise NotImplementedError("Update operator %s" % operator)
+
+    return document
+
+
+# Aggregation
+
+def aggregate(documents, pipeline):
+    """Runs an aggregation pipeline over a list of documents."""
+    for stage in pipeline:
+        (operator, spec), = stage.items()
+
+        if operator == '$match':
+            spec = normalize(spec)
+            documents = [document for document in documents
+                if match(document, spec)]
+        elif operator == '$group':
+            documents = group(documents, spec)
+        elif operator == '$project':
+            documents = [project(document, spec) for document in documents]
+        elif operator == '$sort':
+            documents = sort_documents(documents, spec)
+        elif operator == '$limit':
+            documents = documents[:spec]
+        elif operator == '$skip':
+            documents = documents[spec:]
+        elif operator == '$unwind':
+            documents = unwind(documents, spec)
+        else:
+            raise NotImplementedError("Aggregation stage %s" % operator)
+
+    return [copy.deepcopy(document) for document in documents]
+
+def group(documents, spec):
+    groups = {}
+    order = []
+    accumulators = [(field, accumulator.items()[0])
+        for field, accumulator in spec.items() if field != '_id']
+
+    for document in documents:
+        group_id = evaluate(spec['_id'], document)
+        group_id = None if group_id is MISSING else group_id
+        key = repr(sort_key(group_id))
+
+        if key not in groups:
+            groups[key] = {'_id': group_id, '__state__': {}}
+            order.append(key)
+
+        state = groups[key]['__state__']
+
+        for field, (operator, expression) in accumulators:
+            accumulate(state, field, operator, evaluate(expression, document))
+
+    results = []
+
+    for key in order:
+        result = {'_id': groups[key]['_id']}
+        state = groups[key]['__state__']
+
+        for field, (operator, expression) in accumulators:
+            result[field] = finish_accumulator(state, field, operator)
+
+        results.append(result)
+
+    return results
+
+def accumulate(state, field, operator, value):
+    if operator in ('$sum', '$avg'):
+        total, count = state.get(field, (0, 0))
+
+        if isinstance(value, (int, long, float)) and not isinstance(
+        value, bool):
+            total, count = total + value, count + 1
+
+        state[field] = (total, count)
+
+    elif operator in ('$min', '$max'):
+        if value is None or value is MISSING:
+            state.setdefault(field, None)
+            return
+
+        best = state.get(field)
+        better = compare(value, best) < 0 if operator == '$min' else compare(
+            value, best) > 0
+
+        if best is None or better:
+            state[field] = value
+
+    elif operator == '$first':
+        state.setdefault(field, value)
+
+    elif operator == '$last':
+        state[field] = value
+
+    elif operator in ('$push', '$addToSet'):
+        items = state.setdefault(field, [])
+
+        if value is not MISSING and (operator == '$push'
+        or value not in items):
+            items.append(value)
+
+    else:
+        raise NotImplementedError("Group accumulator %s" % operator)
+
+def finish_accumulator(state, field, operator):
+    value = state.get(field)
+
+    if operator == '$sum':
+        return value[0]
+    elif operator == '$avg':
+        return float(value[0]) / value[1] if value[1] else None
+
+    return None if value is MISSING else value
+
+def project(document, spec):
+    projected = {}
+
+    if spec.get('_id', 1) and '_id' in document:
+        projected['_id'] = document['_id']
+
+    for field, expression in spec.items():
+        if field == '_id' and not expression:
+            continue
+
+        if expression is True or (isinstance(expression, (int, long))
+        and not isinstance(expression, bool) and expression == 1):
+            value = first(document, field)
+        else:
+            value = evaluate(expression, document)
+
+        if value is not MISSING:
+            set_path(projected, field, value)
+
+    return projected
+
+def unwind(documents, path):
+    field = path.lstrip('$')
+    unwound = []
+
+    for document in documents:
+        values = first(document, field)
+
+        if isinstance(values, list):
+            for value in values:
+                item = copy.deepcopy(document)
+                set_path(item, field, value)
+                unwound.append(item)
+
+    return unwound
+
+def evaluate(expression, document):
+    """Evaluates an aggregation expression against a document."""
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        return first(document, expression[1:])
+
+    elif isinstance(expression, dict):
+        if len(expression) == 1 and expression.keys()[0].startswith('$'):
+            (operator, operand), = expression.items()
+
+            if operator == '$literal':
+                return operand
+
+            if operator == '$cond':
+                # Only the branch taken is evaluated, as in MongoDB, so that a
+                # $cond can guard a $divide against dividing by zero.
+                if isinstance(operand, dict):
+                    operand = [operand['if'], operand['then'], operand['else']]
+
+                condition, then, otherwise = operand
+                return evaluate(then if _truthy(evaluate(condition, document))
+                    else otherwise, document)
+
+            if operator not in OPERATORS:
+                raise NotImplementedError("Expression operator %s" % operator)
+
+            if not isinstance(operand, list):
+                operand = [operand]
+
+            return OPERATORS[operator](*[evaluate(argument, document)
+                for argument in operand])
+
+        # Fields that evaluate to missing values are left out, as in MongoDB.
+        evaluated = ((key, evaluate(value, document))
+            for key, value in expression.items())
+        return dict((key, value) for key, value in evaluated
+            if value is not MISSING)
+
+    elif isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+
+    return expression
+
+def _null(value):
+    return value is None or value is MISSING
+
+def _add(*values):
+    if any(_null(value) for value in values):
+        return None
+
+    dates = [value for value in values if isinstance(value, datetime.datetime)]
+    total = sum(value for value in values
+        if not isinstance(value, datetime.datetime))
+
+    if dates:
+        return dates[0] + datetime.timedelta(milliseconds = total)
+
+    return total
+
+def _subtract(a, b):
+    if _null(a) or _null(b):
+        return None
+
+    if isinstance(a, datetime.datetime) and isinstance(b, datetime.datetime):
+        delta = a - b
+        return (delta.days * 86400 + delta.seconds) * 1000 + (
+            delta.microseconds // 1000)
+
+    if isinstance(a, datetime.datetime):
+        return a - datetime.timedelta(milliseconds = b)
+
+    return a - b
+
+def _multiply(*values):
+    if any(_null(value) for value in values):
+        return None
+
+    return reduce(lambda a, b: a * b, values, 1)
+
+def _divide(a, b):
+    if _null(a) or _null(b):
+        return None
+
+    if b == 0:
+        raise ZeroDivisionError("$divide by zero")
+
+    return float(a) / b
+
+def _truthy(value):
+    return not (_null(value) or value is False or value == 0)
+
+def _date_part(part):
+    def extract(value):
+        if not isinstance(value, datetime.datetime):
+            raise TypeError("Date operators need a date, not %r" % (value,))
+
+        return part(value)
+
+    return extract
+
+OPERATORS = {
+    '$add': _add,
+    '$subtract': _subtract,
+    '$multiply': _multiply,
+    '$divide': _divide,
+    '$mod': lambda a, b: None if _null(a) or _null(b) else a % b,
+    '$eq': lambda a, b: equals(a, b),
+    '$ne': lambda a, b: not equals(a, b),
+    '$gt': lambda a, b: compare(a, b) > 0,
+    '$gte': lambda a, b: compare(a, b) >= 0,
+    '$lt': lambda a, b: compare(a, b) < 0,
+    '$lte': lambda a, b: compare(a, b) <= 0,
+    '$cmp': compare,
+    '$and': lambda *values: all(_truthy(value) for value in values),
+    '$or': lambda *values: any(_truthy(value) for value in values),
+    '$not': lambda value: not _truthy(value),
+    '$ifNull': lambda value, default: default if _null(value) else value,
+    '$concat': lambda *values: None if any(_null(value) for value in values)
+        else ''.join(values),
+    '$toLower': lambda value: '' if _null(value) else value.lower(),
+    '$toUpper': lambda value: '' if _null(value) else value.upper(),
+    '$size': len,
+    '$year': _date_part(lambda date: date.year),
+    '$month': _date_part(lambda date: date.month),
+    '$dayOfMonth': _date_part(lambda date: date.day),
+    '$dayOfYear': _date_part(lambda date: date.timetuple().tm_yday),
+    '$dayOfWeek': _date_part(lambda date: date.isoweekday() % 7 + 1),
+    '$week': _date_part(lambda date: (date.timetuple().tm_yday + 6
+        - date.isoweekday() % 7) // 7),
+    '$hour': _date_part(lambda date: date.hour),
+    '$minute': _date_part(lambda date: date.minute),
+    '$second': _date_part(lambda date: date.second),
+    '$millisecond': _date_part(lambda date: date.microsecond // 1000)}
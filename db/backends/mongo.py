@@ -0,0 +1,110 @@
+"""The default storage backend: a pooled pymongo client per (host, port)."""
+import os
+import threading
+import pymongo
+import app as platform
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 27017
+DEFAULT_POOL_SIZE = 10
+
+
+class MongoBackend(object):
+    '''
+    Keeps one pooled MongoClient per (host, port) for the life of the process,
+    along with the database and collection handles built from them.
+
+    MongoClient sockets must not be shared between a parent process and its
+    children, so the backend notices when it is being used from a new process
+    (e.g. a Celery prefork worker or a forked ingestion runner) and starts over
+    with fresh clients.
+
+    Its settings come from the config it is given, or else through
+    app.get_setting, so processes that never set the app up (the task
+    runners and the command line) read them from settings.py too.
+    '''
+    name = 'mongo'
+
+    def __init__(self, config = None):
+        self.config = config
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._databases = {}
+        self._collections = {}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Drop the parent's handles without closing them. Closing them here
+            # would close sockets the parent process is still using.
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def get_setting(self, key, default = None):
+        if self.config is not None:
+            return self.config.get(key, default)
+
+        return platform.get_setting(key, default)
+
+    def get_client_options(self):
+        options = {'max_pool_size': self.get_setting('DATABASE_POOL_SIZE',
+            DEFAULT_POOL_SIZE)}
+        connect_timeout = self.get_setting('DATABASE_CONNECT_TIMEOUT_MS')
+        socket_timeout = self.get_setting('DATABASE_SOCKET_TIMEOUT_MS')
+
+        if connect_timeout:
+            options['connectTimeoutMS'] = connect_timeout
+
+        if socket_timeout:
+            options['socketTimeoutMS'] = socket_timeout
+
+        return options
+
+    def get_address(self, host = None, port = None):
+        return (host or self.get_setting('DATABASE_HOST', DEFAULT_HOST),
+            port or self.get_setting('DATABASE_PORT', DEFAULT_PORT))
+
+    def get_client(self, host = None, port = None):
+        self._check_pid()
+        address = self.get_address(host, port)
+
+        if address not in self._clients:
+            with self._lock:
+                if address not in self._clients:
+                    self._clients[address] = pymongo.MongoClient(
+                        host = address[0], port = address[1],
+                        **self.get_client_options())
+
+        return self._clients[address]
+
+    def get_database(self, db_name, host = None, port = None):
+        self._check_pid()
+        key = self.get_address(host, port) + (db_name,)
+
+        if key not in self._databases:
+            self._databases[key] = self.get_client(*key[:2])[db_name]
+
+        return self._databases[key]
+
+    def get_collection(self, db_name, collection_name, host = None,
+    port = None):
+        self._check_pid()
+        key = self.get_address(host, port) + (db_name, collection_name)
+
+        if key not in self._collections:
+            self._collections[key] = self.get_database(
+                db_name, *key[:2])[collection_name]
+
+        return self._collections[key]
+
+    def close(self):
+        '''Closes every client opened by this process.'''
+        with self._lock:
+            if self._pid == os.getpid():
+                for client in self._clients.values():
+                    client.close()
+            self._reset()
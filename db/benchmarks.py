@@ -0,0 +1,262 @@
+'''
+Micro-benchmarks for the db layer. They work on generated documents and the
+in-memory backend (see db.backends.memory), so they do not need a running
+database and give the same results from run to run.
+
+    python -m db.benchmarks
+'''
+import datetime
+import db
+import db.migrations
+import logging
+import shutil
+import tempfile
+import time
+from bson.objectid import ObjectId
+from contextlib import contextmanager
+from db.backends import create_backend
+
+def sample_timeseries_documents(count, start = datetime.datetime(2012, 1, 1)):
+    """Builds documents shaped like the hourly rows in the timeseries table."""
+    from async_tasks import calendar_table
+    user_id = ObjectId()
+    documents = []
+
+    for i, document in enumerate(calendar_table.get_range(start, count)):
+        timestamp = start + datetime.timedelta(hours = i)
+        document.update({'_id': ObjectId(), 'user_id': user_id,
+            'parent_path': 'twitter/tweets/', 'name': 'totals',
+            'timestamp': timestamp, 'value': i % 7})
+        documents.append(document)
+
+    return documents
+
+def sample_correlation_documents(count, start = datetime.datetime(2012, 1, 1)):
+    """Builds documents shaped like cached correlations."""
+    user_id = ObjectId()
+
+    return [{'_id': ObjectId(), 'user_id': user_id,
+        'start': start + datetime.timedelta(days = i),
+        'end': start + datetime.timedelta(days = i + 7),
+        'paths': ['twitter/tweets/totals', 'lastfm/scrobbles/totals'],
+        'group_by': ['year', 'month', 'day'],
+        'sort': {'year': 1, 'month': 1, 'day': 1}, 'correlation': 0.62,
+        'threshold': '> 0.5', 'key': 'benchmark'} for i in range(0, count)]
+
+@contextmanager
+def memory_backend():
+    """Runs the with block against a fresh, empty in-memory backend."""
+    backend = create_backend('memory')
+    previous = db.set_backend(backend)
+
+    try:
+        yield backend
+    finally:
+        db.set_backend(previous)
+        db.migrations.forget()
+
+def best_of(func, repeat = 3):
+    """Returns the fastest of several runs of func, in seconds."""
+    timings = []
+
+    for i in range(0, repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+
+    return min(timings)
+
+def report(name, rows, seconds):
+    print "%-45s %8.2f us/row  (%d rows in %.3fs)" % (
+        name, seconds / rows * 1000000, rows, seconds)
+
+def benchmark_hydration(rows = 20000):
+    """Compares building Models against building Records for query results."""
+    from async_tasks.models import TimeSeriesData, Correlation
+
+    for model_class, documents in [
+    (TimeSeriesData, sample_timeseries_documents(rows)),
+    (Correlation, sample_correlation_documents(rows))]:
+        record_class = model_class.record_class()
+        report('%s(**document)' % model_class.__name__, rows,
+            best_of(lambda: [model_class(**document)
+                for document in documents]))
+        report('%s.record_class()(document)' % model_class.__name__, rows,
+            best_of(lambda: [record_class(document)
+                for document in documents]))
+
+        models = [model_class(**document) for document in documents]
+        records = [record_class(document) for document in documents]
+        report('%s model attribute reads' % model_class.__name__, rows,
+            best_of(lambda: [(model.user_id, model._id) for model in models]))
+        report('%s record attribute reads' % model_class.__name__, rows,
+            best_of(lambda: [(record.user_id, record._id)
+                for record in records]))
+
+@contextmanager
+def timeseries_settings(**settings):
+    """Overrides TIMESERIES_* settings for the with block."""
+    import app
+    previous = dict((key, app.app.config.get(key)) for key in settings)
+    app.app.config.update(settings)
+
+    try:
+        yield settings
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                del app.app.config[key]
+            else:
+                app.app.config[key] = value
+
+# Storage layouts and query planners to compare.
+LAYOUTS = [
+    ('hourly', {'TIMESERIES_STORAGE': 'hourly', 'TIMESERIES_ROLLUPS': False}),
+    ('daily', {'TIMESERIES_STORAGE': 'daily', 'TIMESERIES_ROLLUPS': False}),
+    ('rollups', {'TIMESERIES_STORAGE': 'hourly', 'TIMESERIES_ROLLUPS': True})]
+
+def ingest(documents):
+    """Counts the sample documents under two paths, as the handlers would."""
+    from async_tasks.models import TimeSeriesCounter
+    counter = TimeSeriesCounter()
+
+    for document in documents:
+        for parent_path in ['twitter/tweets/', 'twitter/']:
+            counter.add(document['user_id'], parent_path,
+                document['timestamp'], document['value'])
+
+    return counter.flush()
+
+def benchmark_ingestion(rows = 5000):
+    """Times flushing hourly counts through TimeSeriesCounter."""
+    documents = sample_timeseries_documents(rows)
+
+    def run():
+        with memory_backend():
+            ingest(documents)
+
+    for name, settings in LAYOUTS[:2]:
+        with timeseries_settings(**settings):
+            report('TimeSeriesCounter.flush (%s)' % name, rows * 2,
+                best_of(run))
+
+def benchmark_queries(rows = 5000):
+    """Times the TimeSeriesQuery pipelines over hourly rows."""
+    from async_tasks import snapshots
+    from async_tasks.helper_classes import TimeSeriesQuery
+    from async_tasks.models import (TimeSeriesData, TimeSeriesDayBucket,
+        TimeSeriesRollup)
+
+    documents = sample_timeseries_documents(rows)
+    user = {'_id': documents[0]['user_id']}
+    directory = tempfile.mkdtemp()
+    layouts = LAYOUTS + [('snapshots', {'TIMESERIES_STORAGE': 'hourly',
+        'TIMESERIES_ROLLUPS': False, 'TIMESERIES_SNAPSHOT_DIR': directory}),
+        ('compact', {'TIMESERIES_STORAGE': 'hourly',
+        'TIMESERIES_ROLLUPS': False, 'TIMESERIES_COMPACT_KEYS': True})]
+
+    for layout, settings in layouts:
+        with timeseries_settings(**settings), memory_backend():
+            # Nothing is left to migrate, so the compact layout is not read
+            # in both forms.
+            db.migrations.migrate()
+            ingest(documents)
+            snapshots.export(user['_id'])
+            print "%s layout: %s documents" % (layout, dict(
+                (model_class.__name__, model_class.find().count())
+                for model_class in [TimeSeriesData, TimeSeriesDayBucket,
+                    TimeSeriesRollup]))
+
+            for name, query in [
+            ('totals by day', TimeSeriesQuery(user, 'twitter/tweets/',
+                group_by = ['year', 'month', 'day'])),
+            ('totals by weekday', TimeSeriesQuery(user, 'twitter/tweets/',
+                group_by = ['isoweekday'], aggregate = {'value': 'avg'})),
+            ('averages by month', TimeSeriesQuery(user, 'twitter/tweets/',
+                group_by = ['year', 'month'])),
+            ('averages by hour', TimeSeriesQuery(user, 'twitter/tweets/',
+                group_by = ['hour']))]:
+                method = query.averages if name.startswith('averages') else (
+                    query.totals)
+                report('TimeSeriesQuery %s (%s)' % (name, layout), rows,
+                    best_of(method))
+
+    shutil.rmtree(directory)
+
+def benchmark_query_engines(rows = 5000):
+    """Compares the aggregation pipelines against async_tasks.local_engine."""
+    from async_tasks.helper_classes import TimeSeriesQuery
+
+    documents = sample_timeseries_documents(rows)
+    user = {'_id': documents[0]['user_id']}
+
+    with timeseries_settings(**LAYOUTS[0][1]), memory_backend():
+        ingest(documents)
+
+        for name, query in [
+        ('totals by day', TimeSeriesQuery(user, 'twitter/tweets/',
+            group_by = ['year', 'month', 'day'])),
+        ('totals by weekday', TimeSeriesQuery(user, 'twitter/tweets/',
+            group_by = ['isoweekday'], aggregate = {'value': 'avg'})),
+        ('averages by hour', TimeSeriesQuery(user, 'twitter/tweets/',
+            group_by = ['hour']))]:
+            method = query.averages if name.startswith('averages') else (
+                query.totals)
+
+            for engine in ['mongo', 'local']:
+                with timeseries_settings(TIMESERIES_QUERY_ENGINE = engine):
+                    report('TimeSeriesQuery %s (%s)' % (name, engine), rows,
+                        best_of(method))
+
+def benchmark_storage(rows = 5000, users = 10000):
+    '''
+    Compares the size of the hourly documents in the long and the compact
+    encodings, and projects it to a year of hours under two paths for each
+    of a number of users. Field names are not part of index entries, so the
+    indexes stay the same size.
+    '''
+    from async_tasks.models import TimeSeriesData
+    from db.instrumentation import document_size
+
+    documents = sample_timeseries_documents(rows)
+    year = 365 * 24 * 2 * users
+
+    for name, compact in [('long keys', False), ('compact keys', True)]:
+        with timeseries_settings(TIMESERIES_COMPACT_KEYS = compact), (
+        memory_backend()):
+            ingest(documents)
+            stored = list(TimeSeriesData.get_collection().find())
+            size = sum(document_size(document) for document in stored)
+            print "%-45s %8.1f bytes/document, %.1f GB for %s user-years" % (
+                'TimeSeriesData (%s)' % name, float(size) / len(stored),
+                float(size) / len(stored) * year / 1e9, users)
+
+def benchmark_calendar(rows = 100000):
+    """Compares working out calendar fields against looking them up."""
+    from async_tasks import calendar_table
+    start = datetime.datetime(2012, 1, 1)
+    timestamps = [start + datetime.timedelta(hours = i)
+        for i in range(0, rows)]
+
+    report('calendar_table.compute', rows, best_of(lambda: [
+        calendar_table.compute(timestamp) for timestamp in timestamps]))
+    report('calendar_table.get_dimensions', rows, best_of(lambda: [
+        calendar_table.get_dimensions(timestamp) for timestamp in timestamps]))
+    report('calendar_table.get_many', rows,
+        best_of(lambda: calendar_table.get_many(timestamps)))
+    report('calendar_table.get_range', rows,
+        best_of(lambda: calendar_table.get_range(start, rows)))
+
+BENCHMARKS = [benchmark_hydration, benchmark_calendar, benchmark_ingestion,
+    benchmark_queries, benchmark_query_engines, benchmark_storage]
+
+def main():
+    # The in-memory backend is slow enough to trip the slow query log.
+    logging.getLogger('db.slow_queries').addHandler(logging.NullHandler())
+
+    for benchmark in BENCHMARKS:
+        print "\n" + benchmark.__name__
+        benchmark()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+'''
+Compact storage encodings for models with many small documents.
+
+A KeyEncoding stores a model's fields under short keys (say 'u' for
+'user_id') and can leave out fields that are worked out again from the
+others whenever a document is read. Model translates everything that goes
+through it when its get_encoding() returns one: query specs, projections,
+sorts, documents written and read back, and aggregation pipelines. A
+pipeline keeps its $match at the start, encoded, followed by a $project
+handing the rest of the stages the fields they use in the long form, the
+left out ones worked out by the aggregation expressions given for them.
+
+Operators, and field names the encoding does not know, pass through
+unchanged, so documents and specs in the long form are left as they are.
+
+While a migration is encoding the documents already stored, a
+DualReadEncoding makes Model read both forms: each find becomes one query for
+the encoded documents and one for the long ones, read through a DualCursor.
+'''
+import itertools
+from db.instrumentation import InstrumentedCursor
+
+def add_condition(spec, key, condition):
+    """Returns a copy of spec that also requires condition of key."""
+    if key in spec:
+        return {'$and': [spec, {key: condition}]}
+
+    return dict(spec, **{key: condition})
+
+def get_field_names(value, keys = False):
+    '''
+    Returns the names of the fields an aggregation expression refers to (the
+    first part of each '$field.path'), and with keys, those of the keys of
+    the dictionaries in it that are not operators too.
+    '''
+    names = set()
+
+    if isinstance(value, basestring):
+        if value.startswith('$') and not value.startswith('$$'):
+            names.add(value[1:].partition('.')[0])
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if keys and not key.startswith('$'):
+                names.add(key.partition('.')[0])
+
+            names |= get_field_names(item, keys)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            names |= get_field_names(item, keys)
+
+    return names
+
+class KeyEncoding(object):
+    def __init__(self, keys, derived = (), derive = None, derived_from = (),
+    expressions = None):
+        '''
+        Takes a dictionary mapping field names to the keys stored for them,
+        the names of the fields that are not stored, a function adding those
+        fields to a decoded document and the fields it needs to do so, and
+        the aggregation expressions working the fields out from the stored
+        keys.
+        '''
+        self.keys = dict(keys)
+        self.names = {key: name for name, key in keys.items()}
+        self.derived = frozenset(derived)
+        self.derive = derive
+        self.derived_from = list(derived_from)
+        self.expressions = dict(expressions or {})
+
+        if len(self.names) != len(self.keys):
+            raise ValueError("Two fields share a stored key in %r." % keys)
+
+    def encode_key(self, name):
+        """Encodes a field name, or the first part of a dotted path."""
+        field, dot, rest = name.partition('.')
+        return self.keys.get(field, field) + dot + rest
+
+    def encode_spec(self, spec):
+        """Encodes the field names in a query spec, however deeply nested."""
+        if isinstance(spec, dict):
+            return {(key if key.startswith('$') else self.encode_key(key)):
+                (self.encode_spec(value) if key in ('$and', '$or', '$nor')
+                    else value) for key, value in spec.items()}
+        elif isinstance(spec, (list, tuple)):
+            return [self.encode_spec(item) for item in spec]
+
+        return spec
+
+    def encode_match(self, spec):
+        """Encodes the spec of a $match stage."""
+        return self.encode_spec(spec)
+
+    def get_expression(self, name):
+        """Returns the aggregation expression reading a field, by name."""
+        if name in self.derived:
+            if name not in self.expressions:
+                raise ValueError("%s cannot be worked out in the database."
+                    % name)
+
+            return self.expressions[name]
+
+        return '$' + self.encode_key(name)
+
+    def encode_pipeline(self, pipeline):
+        '''
+        Returns an aggregation pipeline that runs over the encoded documents
+        the way pipeline runs over the decoded ones.
+        '''
+        pipeline = list(pipeline)
+        stages = []
+
+        # A $match on derived fields has to wait for them to be worked out.
+        if pipeline and '$match' in pipeline[0] and not (get_field_names(
+        pipeline[0]['$match'], keys = True) & self.derived):
+            stages.append({'$match': self.encode_match(
+                pipeline.pop(0)['$match'])})
+
+        # Only the stages up to the first $group or $project see the
+        # documents themselves. Without one, they are handed back whole.
+        names = set()
+
+        for stage in pipeline:
+            names |= get_field_names(stage, keys = True)
+
+            if '$group' in stage or '$project' in stage:
+                break
+        else:
+            names |= set(self.keys) | self.derived
+
+        names.discard('_id')
+        projection = {name: self.get_expression(name) for name in names}
+        return stages + [{'$project': projection or {'_id': 1}}] + pipeline
+
+    def encode_fields(self, fields):
+        """Encodes a projection, given as a list or a dictionary."""
+        if fields is None:
+            return None
+        elif isinstance(fields, dict):
+            return {self.encode_key(field): value
+                for field, value in fields.items()
+                if field not in self.derived}
+
+        encoded = [self.encode_key(field) for field in fields
+            if field not in self.derived]
+
+        if any(field in self.derived for field in fields):
+            encoded += [self.encode_key(field) for field in self.derived_from
+                if self.encode_key(field) not in encoded]
+
+        return encoded
+
+    def encode_sort(self, sort):
+        if isinstance(sort, basestring):
+            return self.encode_key(sort)
+
+        return [(self.encode_key(field), direction)
+            for field, direction in sort]
+
+    def encode(self, document):
+        """Copies a document into short keys, leaving out derived fields."""
+        return {self.encode_key(field): value
+            for field, value in document.items() if field not in self.derived}
+
+    def encode_update(self, update):
+        if not any(key.startswith('$') for key in update):
+            return self.encode(update)
+
+        # Operators left with nothing to do once the derived fields are
+        # dropped are left out, as MongoDB rejects empty ones.
+        encoded = {operator: self.encode(changes)
+            for operator, changes in update.items()}
+        return {operator: changes for operator, changes in encoded.items()
+            if changes}
+
+    def decode(self, document):
+        """Returns a document in the long form, derived fields and all."""
+        if document is None:
+            return None
+
+        decoded = {self.names.get(key, key): value
+            for key, value in document.items()}
+
+        if self.derive:
+            self.derive(decoded)
+
+        return decoded
+
+
+class DualReadEncoding(KeyEncoding):
+    '''
+    A KeyEncoding for while the documents stored in the long form are being
+    encoded. Documents are written encoded, but reads find both forms, told
+    apart by whether they have the stored key of marker, a field every
+    document has.
+    '''
+    def __init__(self, encoding, marker):
+        self.__dict__.update(encoding.__dict__)
+        self.marker = marker
+
+    def get_specs(self, spec):
+        """Returns the specs finding the encoded and the long documents."""
+        spec = spec or {}
+        key = self.encode_key(self.marker)
+        return (add_condition(self.encode_spec(spec), key, {'$exists': True}),
+            add_condition(spec, key, {'$exists': False}))
+
+    def encode_match(self, spec):
+        return {'$or': list(self.get_specs(spec))}
+
+    def get_expression(self, name):
+        """Reads the field from whichever form each document is in."""
+        encoded = super(DualReadEncoding, self).get_expression(name)
+
+        if name in self.derived:
+            marker = '$' + self.encode_key(self.marker)
+            return {'$cond': [{'$ifNull': [marker, False]}, encoded,
+                '$' + name]}
+
+        return {'$ifNull': [encoded, '$' + name]}
+
+    def encode_fields(self, fields):
+        """Returns a projection covering both forms."""
+        encoded = super(DualReadEncoding, self).encode_fields(fields)
+
+        if isinstance(fields, dict):
+            return dict(fields, **encoded)
+        elif fields is not None:
+            return list(fields) + [field for field in encoded
+                if field not in fields]
+
+        return encoded
+
+
+class EncodedCursor(InstrumentedCursor):
+    """An InstrumentedCursor that decodes documents and encodes sort keys."""
+    def __init__(self, cursor, encoding, query = None):
+        super(EncodedCursor, self).__init__(cursor, query)
+        self._encoding = encoding
+
+    def next(self):
+        return self._encoding.decode(super(EncodedCursor, self).next())
+
+    __next__ = next
+
+    def __getitem__(self, index):
+        result = super(EncodedCursor, self).__getitem__(index)
+        return (self._encoding.decode(result) if isinstance(result, dict)
+            else result)
+
+    def sort(self, key_or_list, direction = None):
+        if direction is None:
+            self._cursor.sort(self._encoding.encode_sort(key_or_list))
+        else:
+            self._cursor.sort(self._encoding.encode_key(key_or_list),
+                direction)
+
+        return self
+
+    def distinct(self, key):
+        return super(EncodedCursor, self).distinct(
+            self._encoding.encode_key(key))
+
+
+class DualCursor(object):
+    '''
+    Reads the cursors over the encoded and the long documents one after the
+    other or, once sorted, merged in order. Only sort(), limit(), count(),
+    distinct() and iteration are supported. A sorted read holds every
+    document in memory, which is fine for the find().sort().limit(1) kind of
+    query, but the transition should not last long.
+    '''
+    def __init__(self, cursors):
+        self._cursors = cursors
+        self._sort = None
+        self._limit = 0
+        self._documents = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._documents is None:
+            self._documents = self._read()
+
+        return next(self._documents)
+
+    __next__ = next
+
+    def _read(self):
+        if not self._sort:
+            documents = itertools.chain(*self._cursors)
+        else:
+            documents = [document for cursor in self._cursors
+                for document in cursor]
+
+            # Python's sort is stable, so sorting by each key from the last
+            # to the first sorts by all of them.
+            for field, direction in reversed(self._sort):
+                documents.sort(key = lambda document: document.get(field),
+                    reverse = direction < 0)
+
+        return itertools.islice(documents, self._limit or None)
+
+    def sort(self, key_or_list, direction = None):
+        self._sort = ([(key_or_list, direction or 1)]
+            if isinstance(key_or_list, basestring) else list(key_or_list))
+
+        for cursor in self._cursors:
+            cursor.sort(self._sort)
+
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+
+        for cursor in self._cursors:
+            cursor.limit(limit)
+
+        return self
+
+    def count(self, *args, **kwargs):
+        return sum(cursor.count(*args, **kwargs) for cursor in self._cursors)
+
+    def distinct(self, key):
+        values = []
+
+        for cursor in self._cursors:
+            values += [value for value in cursor.distinct(key)
+                if value not in values]
+
+        return values
+
+    def close(self):
+        for cursor in self._cursors:
+            cursor.close()
@@ -0,0 +1,194 @@
+'''
+Instrumentation for the collection operations made through the Model API.
+
+Every operation is recorded as a QueryEvent carrying the collection, the
+operation name, the shape of the query (its fields and operators with the
+values stripped out), how long it took, how many documents it returned or
+wrote and, if the DATABASE_MEASURE_BYTES setting is on, how many bytes those
+documents take up as BSON. Events are:
+
+  * passed to every listener registered with add_listener(),
+  * added to the stats of the innermost open db.scope, and
+  * logged to the 'db.slow_queries' logger when they take longer than the
+    DATABASE_SLOW_QUERY_MS setting (100ms by default).
+
+Measuring document sizes means re-encoding every document read or written,
+so it is off unless DATABASE_MEASURE_BYTES is set.
+'''
+import app as platform
+import bson
+import db.scope
+import logging
+import time
+from contextlib import contextmanager
+
+DEFAULT_SLOW_QUERY_MS = 100
+SLOW_QUERY_LOGGER = logging.getLogger('db.slow_queries')
+LISTENERS = []
+
+class QueryEvent(object):
+    def __init__(self, collection, operation, query = None):
+        self.collection = collection
+        self.operation = operation
+        self.query = normalize_query(query)
+        self.duration = 0.0
+        self.documents = 0
+        self.bytes = 0
+
+    def count(self, documents):
+        """Adds returned documents to the event's document and byte counts."""
+        self.documents += len(documents)
+
+        if measure_bytes():
+            self.bytes += sum(document_size(document)
+                for document in documents)
+
+    def __repr__(self):
+        return "<QueryEvent (%s.%s %s, %.1fms, %s documents, %s bytes)>" % (
+            self.collection, self.operation, self.query,
+            self.duration * 1000, self.documents, self.bytes)
+
+
+def add_listener(listener):
+    """Registers a callable to be passed every QueryEvent."""
+    LISTENERS.append(listener)
+
+def remove_listener(listener):
+    LISTENERS.remove(listener)
+
+def get_slow_query_threshold():
+    """Returns the slow query threshold in seconds."""
+    return platform.get_setting('DATABASE_SLOW_QUERY_MS',
+        DEFAULT_SLOW_QUERY_MS) / 1000.0
+
+def measure_bytes():
+    return platform.get_setting('DATABASE_MEASURE_BYTES', False)
+
+def document_size(document):
+    try:
+        return len(bson.BSON.encode(document))
+    except (TypeError, bson.errors.InvalidDocument):
+        return 0
+
+def normalize_query(query):
+    """
+    Reduces a query, projection or pipeline to its shape, so that queries that
+    only differ in their values can be grouped together.
+    """
+    if isinstance(query, dict):
+        return dict((key, normalize_query(value))
+            for key, value in query.items())
+
+    elif isinstance(query, (list, tuple)):
+        shapes = []
+
+        for item in query:
+            shape = normalize_query(item)
+
+            if shape not in shapes:
+                shapes.append(shape)
+
+        return shapes
+
+    elif query is None:
+        return None
+
+    else:
+        return '?'
+
+def record(event):
+    for listener in LISTENERS:
+        listener(event)
+
+    scope = db.scope.current_scope()
+
+    if scope:
+        scope.query_stats.add(event)
+
+    if event.duration >= get_slow_query_threshold():
+        SLOW_QUERY_LOGGER.warning("Slow query: %s" % event)
+
+@contextmanager
+def instrument(collection, operation, query = None):
+    """Times the operation in the with block and records it."""
+    event = QueryEvent(collection.full_name, operation, query)
+    start = time.time()
+
+    try:
+        yield event
+    finally:
+        event.duration = time.time() - start
+        record(event)
+
+
+class InstrumentedCursor(object):
+    '''
+    Wraps a pymongo Cursor, timing each fetch and counting the documents it
+    returns. The find is recorded as one event once the cursor is exhausted,
+    closed or garbage collected. count() and distinct() are recorded as events
+    of their own.
+    '''
+    def __init__(self, cursor, query = None):
+        self._cursor = cursor
+        self._event = QueryEvent(cursor.collection.full_name, 'find', query)
+        self._recorded = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+
+        try:
+            document = self._cursor.next()
+        except StopIteration:
+            self._event.duration += time.time() - start
+            self._finish()
+            raise
+
+        self._event.duration += time.time() - start
+        self._event.count([document])
+        return document
+
+    __next__ = next
+
+    def __getitem__(self, index):
+        return self._cursor[index]
+
+    def count(self, *args, **kwargs):
+        with instrument(self._cursor.collection, 'count',
+        self._event.query) as event:
+            return self._cursor.count(*args, **kwargs)
+
+    def distinct(self, key):
+        with instrument(self._cursor.collection, 'distinct',
+        self._event.query) as event:
+            result = self._cursor.distinct(key)
+            event.documents = len(result)
+            return result
+
+    def close(self):
+        self._cursor.close()
+        self._finish()
+
+    def _finish(self):
+        if not self._recorded:
+            self._recorded = True
+            record(self._event)
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+
+        if not callable(attr):
+            return attr
+
+        # Keep chained calls like find().sort().limit() wrapped.
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return call
+
+    def __del__(self):
+        if self._event.documents:
+            self._finish()
@@ -0,0 +1,246 @@
+'''
+Online, batched migrations of the documents in the Mongo collections.
+
+Each migration is a module in this package named m<version>_<name>.py,
+holding an instance of a Migration subclass called migration. A migration
+picks the documents it rewrites with get_spec(). run() walks through them a
+batch at a time, in _id order, and passes each batch to migrate(). After
+every batch, the last _id is saved as a checkpoint in the migrations
+collection. A migration that is stopped picks up from its checkpoint the
+next time it runs, which can mean the last batch is migrated again, so
+migrate() has to be safe to repeat. Writes are throttled to the
+DATABASE_MIGRATION_MAX_PER_SECOND setting, if it is set, so a migration can
+run while the app does.
+
+While a migration is running, the code reading what it rewrites has to read
+both the old and the new form (db.encoding.DualReadEncoding does that for
+models with a KeyEncoding). is_applied() tells it when to stop.
+
+    python . --migrate [--dry-run]    runs the pending migrations in order
+    python . --migrations             lists them and how far they got
+'''
+import app as platform
+import datetime
+import importlib
+import logging
+import os
+import pkgutil
+import pymongo
+import re
+import threading
+import time
+from db.models import Model, Index
+
+DEFAULT_BATCH_SIZE = 1000
+LOGGER = logging.getLogger(__name__)
+MODULE_NAME = re.compile(r'^m(\d+)_(\w+)$')
+# How long is_applied() trusts a migration not to have finished.
+PENDING_CACHE_SECONDS = 60
+
+class MigrationState(Model):
+    """How far a migration has got."""
+    table = 'migrations'
+    indexes = [Index('name', unique = True)]
+    fields = ('name', 'version', 'status', 'checkpoint', 'migrated',
+        'started_at', 'finished_at')
+
+    def __init__(self, name = None, version = None, status = 'pending',
+    checkpoint = None, migrated = 0, started_at = None, finished_at = None,
+    **kwargs):
+        super(MigrationState, self).__init__(**kwargs)
+        self.name = name
+        self.version = version
+        self.status = status
+        self.checkpoint = checkpoint
+        self.migrated = migrated
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+
+class Migration(object):
+    """
+    Rewrites the documents matching get_spec() in get_collection(), one
+    batch at a time. The version and name come from the module's name unless
+    they are given.
+    """
+    fields = None
+
+    def __init__(self, version = None, name = None):
+        matched = MODULE_NAME.match(type(self).__module__.rpartition('.')[2])
+        self.version = version if version is not None else int(
+            matched.group(1))
+        self.name = name or matched.group(2)
+
+    def get_collection(self):
+        raise NotImplementedError
+
+    def get_spec(self):
+        return {}
+
+    def is_needed(self):
+        """Whether the migration applies to this database at all."""
+        return True
+
+    def migrate(self, batch):
+        """Rewrites a batch of documents. Must be safe to repeat."""
+        raise NotImplementedError
+
+    def finish(self):
+        """Runs once every batch has been migrated."""
+        pass
+
+    def __repr__(self):
+        return "<Migration %04d %s>" % (self.version, self.name)
+
+
+class Throttle(object):
+    """Sleeps as needed to keep writes under max_per_second."""
+    def __init__(self, max_per_second = None):
+        self.max_per_second = max_per_second
+        self.started = time.time()
+        self.done = 0
+
+    def wait(self, done):
+        self.done += done
+
+        if self.max_per_second:
+            ahead = (self.done / float(self.max_per_second)
+                - (time.time() - self.started))
+
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def load():
+    """Returns every migration in this package, in version order."""
+    migrations = []
+    directory = os.path.dirname(__file__)
+
+    for _, module_name, _ in pkgutil.iter_modules([directory]):
+        if MODULE_NAME.match(module_name):
+            migrations.append(importlib.import_module(
+                '%s.%s' % (__name__, module_name)).migration)
+
+    return sorted(migrations, key = lambda migration: migration.version)
+
+def get_state(migration):
+    return MigrationState.find_one({'name': migration.name}, as_obj = True
+        ) or MigrationState(name = migration.name,
+            version = migration.version)
+
+def get_batch(migration, checkpoint = None, batch_size = DEFAULT_BATCH_SIZE):
+    spec = dict(migration.get_spec())
+
+    if checkpoint:
+        spec['_id'] = {'$gt': checkpoint}
+
+    return list(migration.get_collection().find(spec,
+        fields = migration.fields, sort = [('_id', pymongo.ASCENDING)],
+        limit = batch_size))
+
+def run(migration, batch_size = None, max_per_second = None,
+dry_run = False, restart = False):
+    '''
+    Runs a migration from its checkpoint, or from the start if restart is
+    set or it has finished before. Returns the number of documents it
+    migrated (or would migrate).
+    '''
+    batch_size = batch_size or platform.get_setting(
+        'DATABASE_MIGRATION_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    throttle = Throttle(max_per_second or platform.get_setting(
+        'DATABASE_MIGRATION_MAX_PER_SECOND'))
+    state = get_state(migration)
+    # A finished migration is run again from the start.
+    checkpoint = (state.checkpoint if not (restart or dry_run)
+        and state.status == 'running' else None)
+    migrated = 0
+
+    if not dry_run:
+        state.update(status = 'running', checkpoint = checkpoint,
+            migrated = state.migrated if checkpoint else 0,
+            started_at = state.started_at if checkpoint else
+                datetime.datetime.utcnow(), finished_at = None)
+        state.save()
+
+    batch = get_batch(migration, checkpoint, batch_size)
+
+    while batch:
+        if not dry_run:
+            migration.migrate(batch)
+            state.checkpoint = batch[-1]['_id']
+            state.migrated += len(batch)
+            state.save()
+
+        migrated += len(batch)
+        LOGGER.info("%r: %s documents %s so far." % (migration, migrated,
+            'found' if dry_run else 'migrated'))
+        throttle.wait(len(batch))
+        batch = get_batch(migration, batch[-1]['_id'], batch_size)
+
+    if not dry_run:
+        migration.finish()
+        state.update(status = 'done', finished_at = datetime.datetime.utcnow())
+        state.save()
+        forget(migration.name)
+
+    return migrated
+
+def pending(migrations = None):
+    """Returns the migrations that are needed and not done yet."""
+    return [migration for migration in (migrations or load())
+        if migration.is_needed() and get_state(migration).status != 'done']
+
+def migrate(migrations = None, **kwargs):
+    """Runs every pending migration in order. Returns how many ran."""
+    ran = pending(migrations)
+
+    for migration in ran:
+        LOGGER.info("Running %r." % migration)
+        run(migration, **kwargs)
+
+    return len(ran)
+
+_applied = {}
+_lock = threading.Lock()
+
+def is_applied(name):
+    '''
+    Whether the named migration has finished. Finished migrations are
+    remembered for good, and unfinished ones for PENDING_CACHE_SECONDS, so
+    this is cheap enough to call on every read.
+    '''
+    with _lock:
+        cached = _applied.get(name)
+
+    if cached and (cached[0] or time.time() - cached[1]
+    < PENDING_CACHE_SECONDS):
+        return cached[0]
+
+    state = MigrationState.find_one({'name': name}, fields = ['status'])
+    applied = bool(state and state.get('status') == 'done')
+
+    with _lock:
+        _applied[name] = (applied, time.time())
+
+    return applied
+
+def forget(name = None):
+    """Drops what is_applied() remembers about a migration (or all of them)."""
+    with _lock:
+        if name:
+            _applied.pop(name, None)
+        else:
+            _applied.clear()
+
+def describe(migrations = None):
+    """Returns a line about each migration and how far it has got."""
+    lines = []
+
+    for migration in (migrations or load()):
+        state = get_state(migration)
+        status = (state.status if migration.is_needed()
+            or state.status == 'done' else 'not needed')
+        lines.append("%04d %-20s %-10s %s documents migrated" % (
+            migration.version, migration.name, status, state.migrated or 0))
+
+    return lines
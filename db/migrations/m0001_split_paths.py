@@ -0,0 +1,37 @@
+'''
+Moves the TimeSeriesPath documents out of the timeseries collection, where
+they used to be kept along with the datapoints, into timeseries_paths. Each
+path is copied unless timeseries_paths already has the same path, and then
+deleted.
+
+Until it has finished, paths that are not in timeseries_paths are also
+looked for in timeseries (unless TIMESERIES_LEGACY_PATHS says otherwise).
+Afterwards, drop the parent_path_1_name_1 and user_id_1_parent_path_1_name_1
+indexes from timeseries, which only the datapoints use now.
+'''
+from async_tasks.models import TimeSeriesPath
+from db.migrations import Migration
+from db.models import bulk_write
+
+KEY_FIELDS = ['user_id', 'parent_path', 'name', 'client_id']
+
+def add_copy(bulk, path):
+    key = {field: path[field] if field in path else {'$exists': False}
+        for field in KEY_FIELDS}
+    bulk.find(key).upsert().update_one({'$setOnInsert': path})
+
+
+class SplitPaths(Migration):
+    def get_collection(self):
+        return TimeSeriesPath.get_legacy_collection()
+
+    def get_spec(self):
+        return TimeSeriesPath.get_legacy_spec({})
+
+    def migrate(self, batch):
+        bulk_write(TimeSeriesPath.get_collection(), batch, add_copy)
+        bulk_write(self.get_collection(), [path['_id'] for path in batch],
+            lambda bulk, _id: bulk.find({'_id': _id}).remove_one())
+
+
+migration = SplitPaths()
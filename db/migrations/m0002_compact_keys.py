@@ -0,0 +1,74 @@
+'''
+Rewrites the TimeSeriesData documents stored in the long form in the compact
+encoding, once TIMESERIES_COMPACT_KEYS is on.
+
+Until it has finished, TimeSeriesData reads both forms, and counts written
+meanwhile go to new encoded documents, so a datapoint can have one of each.
+Those are merged: the long document's count is added to the encoded one,
+which is marked with the long document's _id so that it is only added once,
+and the long document is deleted. Long documents without an encoded twin
+are replaced in place, keeping their _id. A twin created between the two
+steps of a batch stays a second document, which the queries add up the
+same.
+'''
+from async_tasks.models import TimeSeriesData, use_compact_keys
+from db.migrations import Migration
+from db.models import bulk_write
+
+KEY_FIELDS = ['user_id', 'parent_path', 'name', 'timestamp', 'client_id']
+# The field marking an encoded document with the long one added to it.
+MERGED = 'm'
+
+def get_key(document):
+    return tuple(document.get(field) for field in KEY_FIELDS)
+
+
+class CompactKeys(Migration):
+    def get_collection(self):
+        return TimeSeriesData.get_collection()
+
+    def get_spec(self):
+        # Encoded documents keep their timestamp under 't'.
+        return {'timestamp': {'$exists': True}}
+
+    def is_needed(self):
+        return use_compact_keys()
+
+    def get_twins(self, batch):
+        """Returns the _ids of the encoded twins of a batch, by key."""
+        encoding = TimeSeriesData.key_encoding
+        keys = [dict(zip(KEY_FIELDS, get_key(document)))
+            for document in batch]
+        return {get_key(encoding.decode(twin)): twin['_id']
+            for twin in self.get_collection().find({'$or': [
+                encoding.encode_spec(key) for key in keys]},
+                fields = [encoding.encode_key(field) for field in KEY_FIELDS])}
+
+    def migrate(self, batch):
+        twins = self.get_twins(batch)
+
+        def add_conversion(bulk, document):
+            twin = twins.get(get_key(document))
+
+            if twin is None:
+                bulk.find({'_id': document['_id'], 'timestamp': {
+                    '$exists': True}}).replace_one(
+                        TimeSeriesData.key_encoding.encode(document))
+            # Custom datastream values are set rather than added to, so the
+            # twin's is the one to keep.
+            elif 'client_id' not in document:
+                bulk.find({'_id': twin, MERGED: {'$ne': document['_id']}}
+                    ).update_one({'$inc': {'v': document.get('value') or 0},
+                        '$set': {MERGED: document['_id']}})
+
+        bulk_write(self.get_collection(), batch, add_conversion)
+        bulk_write(self.get_collection(), [document['_id']
+            for document in batch if get_key(document) in twins],
+            lambda bulk, _id: bulk.find({'_id': _id}).remove_one())
+
+    def finish(self):
+        self.get_collection().update({MERGED: {'$exists': True}},
+            {'$unset': {MERGED: 1}}, multi = True)
+
+
+migration = CompactKeys()
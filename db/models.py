@@ -1,14 +1,97 @@
 import app as platform
+import db.asynchronous
+import db.scope
+import logging
+import pymongo
 
-from db import get_connection
+from db import get_collection
+from db.encoding import DualCursor, DualReadEncoding, EncodedCursor
+from db.instrumentation import instrument, InstrumentedCursor
+from db.records import make_record_class
 from bson.objectid import ObjectId
 from functools import wraps
+from itertools import islice
+from pymongo.errors import BulkWriteError
 
 if 'DATABASES' in platform.app.config:
     DEFAULT_DATABASE = platform.app.config['DATABASES']['default']
 else:
     DEFAULT_DATABASE = 'platform'
 
+DEFAULT_BATCH_SIZE = 1000
+LOGGER = logging.getLogger(__name__)
+
+def chunks(iterable, size):
+    """Splits an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def get_batch_size(batch_size = None):
+    if batch_size:
+        return batch_size
+    
+    return platform.get_setting('DATABASE_BULK_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+class BulkWriteReport(object):
+    """
+    Collects the results of a chunked bulk write, one entry per batch, in the
+    format returned by pymongo's BulkOperationBuilder.execute().
+    """
+    def __init__(self):
+        self.batches = []
+        
+    def add(self, result):
+        self.batches.append(result)
+        
+    def count(self, field):
+        """Sums a counter (e.g. 'nInserted' or 'nUpserted') across batches."""
+        return sum(batch.get(field, 0) for batch in self.batches)
+        
+    @property
+    def errors(self):
+        return [error for batch in self.batches
+            for error in batch.get('writeErrors', [])]
+    
+    def __repr__(self):
+        return ("<BulkWriteReport (%s batches, %s inserted, %s upserted, "
+            "%s matched, %s errors)>" % (len(self.batches),
+            self.count('nInserted'), self.count('nUpserted'),
+            self.count('nMatched'), len(self.errors)))
+
+
+def bulk_write(collection, items, add_operation, batch_size = None):
+    """
+    Writes items to a collection using one unordered bulk operation per batch.
+    add_operation(bulk, item) is called to add each item's write to the bulk
+    operation. Write errors are logged and reported rather than raised, so one
+    bad document does not stop the remaining batches from being written.
+    """
+    report = BulkWriteReport()
+    db.scope.invalidate(collection.full_name)
+    
+    for batch in chunks(items, get_batch_size(batch_size)):
+        bulk = collection.initialize_unordered_bulk_op()
+        
+        for item in batch:
+            add_operation(bulk, item)
+            
+        try:
+            with instrument(collection, 'bulk_write') as event:
+                event.documents = len(batch)
+                report.add(bulk.execute())
+        except BulkWriteError as err:
+            LOGGER.error("Bulk write to %s failed for %s of %s documents: %s"
+                % (collection.full_name, len(err.details['writeErrors']),
+                len(batch), err.details['writeErrors'][:1]))
+            report.add(err.details)
+            
+    return report
+
 def mongodb_init(f):
     @wraps(f)
     def init(self, *args, **kwargs):
@@ -21,31 +104,226 @@ def mongodb_init(f):
         
     return init
 
+class Index(object):
+    """
+    Declares an index on a model's collection. Keys are field names, or
+    (field name, direction) tuples for anything other than ascending order.
+    Options are passed through to pymongo's create_index (e.g. unique = True
+    or expireAfterSeconds = 3600 for a TTL index).
+    """
+    def __init__(self, *keys, **options):
+        self.keys = [key if isinstance(key, tuple)
+            else (key, pymongo.ASCENDING) for key in keys]
+        self.options = options
+        
+    def ensure(self, collection, encoding = None):
+        """
+        Builds the index in the background. Building an index that already
+        exists is a no-op, so this is safe to run repeatedly.
+        """
+        options = dict(self.options)
+        options.setdefault('background', True)
+        keys = self.keys if not encoding else [
+            (encoding.encode_key(field), direction)
+            for field, direction in self.keys]
+        return collection.create_index(keys, **options)
+        
+    def __repr__(self):
+        return "<Index (%s, %s)>" % (self.keys, self.options)
+
+
+def get_model_classes(base = None):
+    """Returns every subclass of base (Model by default), recursively."""
+    subclasses = []
+    
+    for subclass in (base if base else Model).__subclasses__():
+        subclasses.append(subclass)
+        subclasses.extend(get_model_classes(subclass))
+        
+    return subclasses
+
+def ensure_indexes(model_classes = None):
+    """
+    Builds the indexes declared by every model class that has been imported.
+    Returns the names of the indexes, grouped by collection.
+    """
+    built = {}
+    
+    for model_class in (model_classes if model_classes is not None
+    else get_model_classes()):
+        if not hasattr(model_class, 'table'):
+            continue
+            
+        collection = model_class.get_collection()
+        names = built.setdefault(collection.full_name, [])
+        
+        for index in model_class.indexes:
+            name = index.ensure(collection, model_class.get_encoding())
+            
+            if name not in names:
+                names.append(name)
+                
+    return built
+
+
 class Model(dict):
+    database_key = 'default'
+    default_database = DEFAULT_DATABASE
+    indexes = []
+    fields = ()
+    record_methods = ()
+    
     def __init__(self, *args, **kwargs):
         super(Model, self).__init__(self, *args, **kwargs)
         self.convert_ids()
     
     @classmethod
-    def get_collection(cls, database = DEFAULT_DATABASE):
-        conn = get_connection(database)
-        return conn[cls.table]
+    def get_database_name(cls):
+        databases = platform.app.config.get('DATABASES', {})
+        return databases.get(cls.database_key, cls.default_database)
+    
+    @classmethod
+    def get_collection(cls, database = None):
+        return get_collection(
+            database if database else cls.get_database_name(), cls.table)
+        
+    @classmethod
+    def get_encoding(cls):
+        """
+        Returns the db.encoding.KeyEncoding the model's documents are stored
+        in, or None if they are stored as they are.
+        """
+        return None
+        
+    @classmethod
+    def encode_document(cls, document):
+        """Returns a document the way it is stored."""
+        encoding = cls.get_encoding()
+        return encoding.encode(document) if encoding else document
+        
+    @classmethod
+    def encode_spec(cls, spec):
+        encoding = cls.get_encoding()
+        return encoding.encode_spec(spec) if encoding else spec
+        
+    @classmethod
+    def encode_update(cls, update):
+        encoding = cls.get_encoding()
+        return encoding.encode_update(update) if encoding else update
         
     @classmethod
     def find(cls, *args, **kwargs):
-        return cls.get_collection().find(*args, **kwargs)
+        query = args[0] if args else kwargs.get('spec')
+        encoding = cls.get_encoding()
+        
+        if not encoding:
+            return InstrumentedCursor(cls.get_collection().find(*args,
+                **kwargs), query = query)
+            
+        kwargs.update(zip(['spec', 'fields'], args))
+        args = args[2:]
+        
+        if isinstance(encoding, DualReadEncoding):
+            # The sort and limit go to the DualCursor, to apply to the two
+            # cursors together.
+            sort = kwargs.pop('sort', None)
+            limit = kwargs.pop('limit', 0)
+            encoded, original = encoding.get_specs(query)
+            cursor = DualCursor([cls.find_encoded(encoding,
+                dict(kwargs, spec = encoded), args, query),
+                InstrumentedCursor(cls.get_collection().find(*args,
+                    **dict(kwargs, spec = original)), query = query)])
+            return (cursor.sort(sort) if sort else cursor).limit(limit)
+            
+        return cls.find_encoded(encoding, dict(kwargs,
+            spec = encoding.encode_spec(query)), args, query)
         
     @classmethod
-    def find_one(cls, attrs, as_obj = False):
-        if as_obj:
-            result = cls.get_collection().find_one(attrs)
+    def find_encoded(cls, encoding, kwargs, args = (), query = None):
+        """Runs a find whose spec is already encoded."""
+        kwargs['fields'] = encoding.encode_fields(kwargs.get('fields'))
             
-            if result:
-                return cls(**result)
-            else:
-                return result
+        if kwargs.get('sort'):
+            kwargs['sort'] = encoding.encode_sort(kwargs['sort'])
+            
+        return EncodedCursor(cls.get_collection().find(*args, **kwargs),
+            encoding, query = query)
+        
+    @classmethod
+    def aggregate(cls, pipeline):
+        """Runs an aggregation pipeline and returns the resulting documents."""
+        collection = cls.get_collection()
+        encoding = cls.get_encoding()
+        
+        if encoding:
+            pipeline = encoding.encode_pipeline(pipeline)
+            
+        with instrument(collection, 'aggregate', pipeline) as event:
+            result = collection.aggregate(pipeline).get('result')
+            event.count(result)
+            
+        return result
+        
+    @classmethod
+    def find_one(cls, attrs, as_obj = False, fields = None):
+        """
+        Returns the first document matching attrs. Pass a list of field names
+        as fields to fetch only those fields (plus _id), or as_obj to get the
+        document back as an instance of the model.
+        """
+        collection = cls.get_collection()
+        scope = db.scope.current_scope()
+        encoding = cls.get_encoding()
+        found = False
+        
+        if isinstance(encoding, DualReadEncoding) and isinstance(attrs, dict):
+            attrs = {'$or': list(encoding.get_specs(attrs))}
+            fields = encoding.encode_fields(fields)
+        elif encoding:
+            attrs = (encoding.encode_spec(attrs) if isinstance(attrs, dict)
+                else attrs)
+            fields = encoding.encode_fields(fields)
+            
+        if scope:
+            key = scope.identity_map.get_key(attrs, fields)
+            found, result = scope.identity_map.lookup(collection.full_name,
+                key)
+            
+        if not found:
+            with instrument(collection, 'find_one', attrs) as event:
+                result = collection.find_one(attrs, fields = fields)
+                event.count([result] if result else [])
+            
+            if scope:
+                scope.identity_map.store(collection.full_name, key, result)
+                
+        if encoding:
+            result = encoding.decode(result)
+        
+        if as_obj and result:
+            return cls(**result)
         else:
-            return cls.get_collection().find_one(attrs)
+            return result
+            
+    @classmethod
+    def record_class(cls):
+        """Returns the compact Record class for this model's fields."""
+        if '_record_class' not in cls.__dict__:
+            cls._record_class = make_record_class(cls)
+            
+        return cls._record_class
+        
+    @classmethod
+    def find_records(cls, spec = None, **kwargs):
+        """
+        Like find(), but only fetches the model's declared fields and yields
+        them as Records rather than dictionaries or models.
+        """
+        record_class = cls.record_class()
+        kwargs.setdefault('fields', list(record_class.fields))
+        
+        for document in cls.find(spec, **kwargs):
+            yield record_class(document)
             
     @classmethod
     def find_or_create(cls, **kwargs):
@@ -56,17 +334,143 @@ class Model(dict):
         else:
             return cls(**kwargs)
     
+    @classmethod
+    def bulk_insert(cls, models, batch_size = None):
+        """Inserts many models, assigning _ids to those that lack one."""
+        def add_insert(bulk, model):
+            model.prepare_bulk_write()
+            bulk.insert(cls.encode_document(model))
+            
+        return bulk_write(cls.get_collection(), models, add_insert,
+            batch_size = batch_size)
+        
+    @classmethod
+    def bulk_save(cls, models, batch_size = None):
+        """
+        Saves many models: the ones that already have an _id replace the
+        stored document with that _id, and the rest are inserted.
+        """
+        def add_save(bulk, model):
+            has_id = bool(model.get('_id'))
+            model.prepare_bulk_write()
+            
+            if has_id:
+                bulk.find({'_id': model['_id']}).upsert().replace_one(
+                    cls.encode_document(model))
+            else:
+                bulk.insert(cls.encode_document(model))
+                
+        return bulk_write(cls.get_collection(), models, add_save,
+            batch_size = batch_size)
+        
+    @classmethod
+    def bulk_upsert(cls, models, key_fields, batch_size = None):
+        """
+        Upserts many models, matching existing documents on key_fields and
+        setting every other field the models carry.
+        """
+        encoding = cls.get_encoding()
+        
+        def add_upsert(bulk, model):
+            if hasattr(model, 'convert_ids'):
+                model.convert_ids()
+                
+            key = {field: model.get(field) for field in key_fields}
+            
+            # A copy still in the long form would otherwise be read too.
+            if isinstance(encoding, DualReadEncoding):
+                bulk.find(encoding.get_specs(key)[1]).remove()
+                
+            fields = {field: value for field, value in model.items()
+                if field != '_id' and field not in key_fields}
+            bulk.find(cls.encode_spec(key)).upsert().update_one(
+                cls.encode_update({'$set': fields} if fields
+                    else {'$setOnInsert': key}))
+                
+        return bulk_write(cls.get_collection(), models, add_upsert,
+            batch_size = batch_size)
+        
+    # Non-blocking variants. Each runs the method above on the executor in
+    # db.asynchronous and returns a Future for its result.
+    
+    @classmethod
+    def afind_one(cls, attrs, as_obj = False, fields = None):
+        return db.asynchronous.submit(cls.find_one, attrs, as_obj = as_obj,
+            fields = fields)
+        
+    @classmethod
+    def afind(cls, *args, **kwargs):
+        """
+        Returns an AsyncCursor over find(*args, **kwargs), which starts
+        fetching straight away and keeps the next batch coming in the
+        background while the current one is iterated over.
+        """
+        batch_size = kwargs.pop('async_batch_size', None)
+        return db.asynchronous.AsyncCursor(
+            lambda: cls.find(*args, **kwargs), batch_size)
+        
+    @classmethod
+    def aaggregate(cls, pipeline):
+        return db.asynchronous.submit(cls.aggregate, pipeline)
+        
+    @classmethod
+    def abulk_insert(cls, models, batch_size = None):
+        return db.asynchronous.submit(cls.bulk_insert, models,
+            batch_size = batch_size)
+        
+    @classmethod
+    def abulk_save(cls, models, batch_size = None):
+        return db.asynchronous.submit(cls.bulk_save, models,
+            batch_size = batch_size)
+        
+    @classmethod
+    def abulk_upsert(cls, models, key_fields, batch_size = None):
+        return db.asynchronous.submit(cls.bulk_upsert, models, key_fields,
+            batch_size = batch_size)
+        
+    def ainsert(self):
+        return db.asynchronous.submit(self.insert)
+        
+    def asave(self):
+        return db.asynchronous.submit(self.save)
+        
+    def prepare_bulk_write(self):
+        if hasattr(self, 'convert_ids'):
+            self.convert_ids()
+            
+        if not self.get('_id'):
+            self._id = ObjectId()
+    
     def insert(self):
         if hasattr(self, 'convert_ids'):
             self.convert_ids()
-        self._id = self.get_collection().insert(self)
+        collection = self.get_collection()
+        db.scope.invalidate(collection.full_name)
+        
+        with instrument(collection, 'insert') as event:
+            self._id = collection.insert(self.encode_document(self))
+            event.count([self])
+            
         return self._id
         
     def save(self):
         if hasattr(self, 'convert_ids'):
             self.convert_ids()
-        self._id = self.get_collection().save(self)
+        collection = self.get_collection()
+        db.scope.invalidate(collection.full_name)
+        
+        with instrument(collection, 'save', {'_id': self.get('_id')}) as event:
+            self._id = collection.save(self.encode_document(self))
+            event.count([self])
+            
         return self._id
+        
+    def remove(self):
+        collection = self.get_collection()
+        db.scope.invalidate(collection.full_name)
+        
+        with instrument(collection, 'remove', {'_id': self._id}):
+            return collection.remove({'_id': self._id})
 
     def convert_ids(self):
         if hasattr(self, 'do_not_convert'):
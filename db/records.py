@@ -0,0 +1,86 @@
+"""
+Compact records for read-only query results.
+
+Building a Model for every document we read is expensive: Model is a dict
+subclass that converts every *_id field to an ObjectId when it is constructed
+and resolves attribute access through __getattr__. Records hold the same
+fields in __slots__ and are built by an __init__ compiled once per model class.
+Documents coming out of MongoDB already hold ObjectIds, so records skip the
+conversion entirely. It happens when a record is turned back into a model to
+be written.
+"""
+
+RECORD_INIT_TEMPLATE = '''def __init__(self, document):
+    get = document.get
+%s
+'''
+
+class Record(object):
+    __slots__ = ()
+    fields = ()
+    model_class = None
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default = None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __contains__(self, field):
+        return getattr(self, field, None) is not None
+
+    def keys(self):
+        return [field for field in self.fields
+            if getattr(self, field) is not None]
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.keys())
+
+    def to_model(self):
+        """Returns a full Model instance, e.g. in order to save changes."""
+        return self.model_class(**self.to_dict())
+
+    def __eq__(self, other):
+        return (isinstance(other, Record) and self.fields == other.fields
+            and all(getattr(self, field) == getattr(other, field)
+                for field in self.fields))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.to_dict())
+
+
+def make_record_class(model_class):
+    """
+    Builds a Record subclass with one slot for _id and one for each field
+    listed in model_class.fields. Any functions named in
+    model_class.record_methods are copied over to the record class, so they
+    must only read fields through item access (self[field]).
+    """
+    fields = ('_id',) + tuple(
+        field for field in model_class.fields if field != '_id')
+    namespace = {}
+    exec(compile(RECORD_INIT_TEMPLATE % '\n'.join(
+        '    self.%s = get(%r)' % (field, field) for field in fields),
+        '<%s record>' % model_class.__name__, 'exec'), namespace)
+
+    attrs = {
+        '__slots__': fields,
+        '__init__': namespace['__init__'],
+        'fields': fields,
+        'model_class': model_class
+    }
+
+    for method_name in getattr(model_class, 'record_methods', ()):
+        for klass in model_class.__mro__:
+            if method_name in klass.__dict__:
+                attrs[method_name] = klass.__dict__[method_name]
+                break
+
+    return type(model_class.__name__ + 'Record', (Record,), attrs)
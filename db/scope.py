@@ -0,0 +1,216 @@
+'''
+Per-request and per-task scopes for the db layer.
+
+A scope is opened for every Flask request (see init_app) and by the task
+runners around each unit of work. While a scope is open, Model.find_one()
+memoizes its results in the scope's identity map, so each document is fetched
+at most once per scope no matter how many times it is looked up. Writes made
+through the Model API drop the cached results for the collection written to.
+
+Each scope also sums up the collection operations recorded by
+db.instrumentation while it is open.
+'''
+import copy
+import logging
+import threading
+from bson import json_util
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+_local = threading.local()
+
+class IdentityMap(object):
+    """
+    Memoizes find_one() results by collection, query and projection. The
+    worker threads of db.asynchronous share their caller's map, hence the
+    lock.
+    """
+    def __init__(self):
+        self.documents = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, query, fields = None):
+        return json_util.dumps([query, fields], sort_keys = True)
+
+    def lookup(self, collection_name, key):
+        """
+        Returns a (found, document) tuple. Documents are copied on the way in
+        and out so that callers can modify what they get back.
+        """
+        with self.lock:
+            documents = self.documents.get(collection_name, {})
+
+            if key in documents:
+                self.hits += 1
+                document = documents[key]
+            else:
+                self.misses += 1
+                return False, None
+
+        return True, copy.deepcopy(document)
+
+    def store(self, collection_name, key, document):
+        document = copy.deepcopy(document)
+
+        with self.lock:
+            self.documents.setdefault(collection_name, {})[key] = document
+
+    def invalidate(self, collection_name = None):
+        with self.lock:
+            if collection_name:
+                self.documents.pop(collection_name, None)
+            else:
+                self.documents = {}
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                'documents': sum(len(documents)
+                    for documents in self.documents.values())}
+
+
+class QueryStats(object):
+    """Totals up the operations recorded during a scope, from any thread."""
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def add(self, event):
+        key = (event.collection, event.operation)
+
+        with self.lock:
+            if key not in self.operations:
+                self.operations[key] = {'count': 0, 'duration': 0.0,
+                    'documents': 0, 'bytes': 0}
+
+            totals = self.operations[key]
+            totals['count'] += 1
+            totals['duration'] += event.duration
+            totals['documents'] += event.documents or 0
+            totals['bytes'] += event.bytes or 0
+
+    def get_operations(self):
+        """Returns a copy of the totals by (collection, operation)."""
+        with self.lock:
+            return dict((key, dict(totals))
+                for key, totals in self.operations.items())
+
+    def total(self, field, operations = None):
+        if operations is None:
+            operations = self.get_operations()
+
+        return sum(totals[field] for totals in operations.values())
+
+    def summary(self):
+        operations = self.get_operations()
+        return {'operations': self.total('count', operations),
+            'duration_ms': round(self.total('duration', operations) * 1000,
+                3),
+            'documents': self.total('documents', operations),
+            'bytes': self.total('bytes', operations),
+            'by_collection': dict(('%s.%s' % key, totals)
+                for key, totals in operations.items())}
+
+
+class Scope(object):
+    def __init__(self, name = None):
+        self.name = name
+        self.identity_map = IdentityMap()
+        self.query_stats = QueryStats()
+
+    def stats(self):
+        summary = self.query_stats.summary()
+        del summary['by_collection']
+        return {'identity_map': self.identity_map.stats(), 'queries': summary}
+
+    def __repr__(self):
+        return "<Scope (%s, %s)>" % (self.name, self.stats())
+
+
+def current_scope():
+    """Returns the innermost open scope on this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+def push_scope(name = None):
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    _local.stack.append(Scope(name))
+    return _local.stack[-1]
+
+def pop_scope():
+    stack = getattr(_local, 'stack', None)
+
+    if stack:
+        closed = stack.pop()
+        LOGGER.debug("Closed db scope %s: %s" % (closed.name, closed.stats()))
+        return closed
+
+@contextmanager
+def scope(name = None):
+    """Opens a scope for the duration of a with block, e.g. one task run."""
+    opened = push_scope(name)
+
+    try:
+        yield opened
+    finally:
+        pop_scope()
+
+@contextmanager
+def use_scope(opened):
+    '''
+    Makes an already open scope the current one on this thread for the
+    duration of a with block. db.asynchronous uses it so that work handed to
+    its worker threads shares the identity map and stats of the scope that
+    handed it over.
+    '''
+    if opened is None:
+        yield None
+        return
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    _local.stack.append(opened)
+
+    try:
+        yield opened
+    finally:
+        _local.stack.pop()
+
+def invalidate(collection_name = None):
+    """Drops cached documents for a collection from every open scope."""
+    for opened in getattr(_local, 'stack', []):
+        opened.identity_map.invalidate(collection_name)
+
+def init_app(app):
+    """
+    Opens a scope for every request the app handles. In debug mode, each
+    response carries a summary of the database work done for it in an
+    X-DB-Stats header.
+    """
+    from flask import request
+
+    @app.before_request
+    def open_request_scope():
+        push_scope(request.path)
+
+    @app.after_request
+    def add_stats_header(response):
+        opened = current_scope()
+
+        if app.debug and opened:
+            stats = opened.stats()
+            response.headers['X-DB-Stats'] = (
+                '%(operations)s operations, %(duration_ms)sms, '
+                + '%(documents)s documents, %(bytes)s bytes'
+                ) % stats['queries']
+
+        return response
+
+    @app.teardown_request
+    def close_request_scope(exception = None):
+        pop_scope()
@@ -0,0 +1,27 @@
+'''
+The base TestCase of the tests that run against the memory backend.
+'''
+import app as platform
+import db
+import db.migrations
+import unittest
+from db.backends import create_backend
+
+class MemoryBackendTestCase(unittest.TestCase):
+    '''
+    Runs each test against an empty memory backend, and puts the previous
+    backend back afterwards. The settings a test sets in the app's config
+    are listed in settings, to be taken out again; what the migrations
+    remember is forgotten along with the database.
+    '''
+    settings = ()
+
+    def setUp(self):
+        self.previous_backend = db.set_backend(create_backend('memory'))
+
+    def tearDown(self):
+        db.set_backend(self.previous_backend)
+        db.migrations.forget()
+
+        for key in self.settings:
+            platform.app.config.pop(key, None)
@@ -1,5 +1,21 @@
 import unittest
 import bson.objectid
+import bson.tz_util
+import pymongo
+import datetime
+import time
+import db
+import db.backends
+import db.backends.memory
+import db.backends.mongo
+import db.asynchronous
+import db.encoding
+import db.instrumentation
+import db.migrations
+import db.models
+import db.scope
+import settings
+from db.testing import MemoryBackendTestCase
 from oauth_provider import models
 
 SIMPLE_TEST_OBJECT_ID = u'50d280f9fb5d1b1541ef2c24'
@@ -35,3 +51,490 @@ class TestUserModel(unittest.TestCase):
     def with_simple_user(self):
         return models.User(
             _id=SIMPLE_TEST_OBJECT_ID, name='Someone')
+
+
+class TestMongoBackend(unittest.TestCase):
+
+    def test_forget_handles_after_fork(self):
+        self.should_have_no_cached_clients(
+        self.when_used_from_another_process(
+        self.with_cached_client()))
+
+    def test_client_options_from_config(self):
+        self.assertEqual(
+            db.backends.mongo.MongoBackend(config = {'DATABASE_POOL_SIZE': 3,
+                'DATABASE_SOCKET_TIMEOUT_MS': 500}).get_client_options(),
+            {'max_pool_size': 3, 'socketTimeoutMS': 500})
+
+    def test_settings_are_read_without_the_app(self):
+        settings.DATABASE_HOST = 'db.example.com'
+
+        try:
+            self.assertEqual(db.backends.mongo.MongoBackend().get_address(),
+                ('db.example.com', 27017))
+        finally:
+            del settings.DATABASE_HOST
+
+    def should_have_no_cached_clients(self, registry):
+        self.assertEqual(registry._clients, {})
+        self.assertEqual(registry._collections, {})
+
+    def when_used_from_another_process(self, registry):
+        registry._pid = registry._pid + 1
+        registry._check_pid()
+        return registry
+
+    def with_cached_client(self):
+        registry = db.backends.mongo.MongoBackend(config = {})
+        registry._clients[registry.get_address()] = object()
+        registry._collections[registry.get_address() + ('a', 'b')] = object()
+        return registry
+
+
+class TestBulkWrites(unittest.TestCase):
+
+    def test_chunks(self):
+        self.assertEqual(list(db.models.chunks(range(7), 3)),
+            [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_chunks_of_nothing(self):
+        self.assertEqual(list(db.models.chunks([], 3)), [])
+
+    def test_report_totals(self):
+        self.should_have_counted(3, 2, 1,
+        self.when_batches_are_reported([
+            {'nInserted': 2, 'nUpserted': 1, 'writeErrors': []},
+            {'nInserted': 1, 'nUpserted': 1,
+             'writeErrors': [{'index': 0, 'code': 11000}]}]))
+
+    def should_have_counted(self, inserted, upserted, errors, report):
+        self.assertEqual(report.count('nInserted'), inserted)
+        self.assertEqual(report.count('nUpserted'), upserted)
+        self.assertEqual(len(report.errors), errors)
+
+    def when_batches_are_reported(self, batches):
+        report = db.models.BulkWriteReport()
+        for batch in batches:
+            report.add(batch)
+        return report
+
+
+class TestIndexes(unittest.TestCase):
+
+    def test_default_to_ascending_keys(self):
+        self.assertEqual(
+            db.models.Index('user_id', ('start', pymongo.DESCENDING)).keys,
+            [('user_id', pymongo.ASCENDING), ('start', pymongo.DESCENDING)])
+
+    def test_find_nested_model_classes(self):
+        self.assertIn(models.User, db.models.get_model_classes())
+
+    def test_every_model_declares_indexes(self):
+        for model_class in [models.Client, models.AccessToken,
+        models.RequestToken, models.Nonce]:
+            self.assertTrue(model_class.indexes)
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_record_fields(self):
+        self.should_read_like_the_document(
+        self.when_hydrated(
+        self.with_uid_document()))
+
+    def test_record_back_to_model(self):
+        self.assertEqual(
+            self.when_hydrated(self.with_uid_document()).to_model(),
+            models.UID(**self.with_uid_document()))
+
+    def test_record_class_is_cached(self):
+        self.assertIs(models.UID.record_class(), models.UID.record_class())
+
+    def test_record_has_no_dict(self):
+        self.assertFalse(hasattr(
+            self.when_hydrated(self.with_uid_document()), '__dict__'))
+
+    def should_read_like_the_document(self, record):
+        self.assertEqual(record._id, bson.objectid.ObjectId(
+            SIMPLE_TEST_OBJECT_ID))
+        self.assertEqual(record['uid'], 'ryepdx')
+        self.assertEqual(record.user_id, bson.objectid.ObjectId(
+            SIMPLE_TEST_OBJECT_ID))
+        self.assertRaises(KeyError, lambda: record['nonexistent'])
+
+    def test_missing_fields(self):
+        record = models.UID.record_class()({'uid': 'ryepdx'})
+        self.assertEqual(record.get('datastream', 'missing'), 'missing')
+        self.assertNotIn('datastream', record)
+        self.assertEqual(record.keys(), ['uid'])
+
+    def when_hydrated(self, document):
+        return models.UID.record_class()(document)
+
+    def with_uid_document(self):
+        return {'_id': bson.objectid.ObjectId(SIMPLE_TEST_OBJECT_ID),
+            'uid': 'ryepdx', 'datastream': 'twitter',
+            'user_id': bson.objectid.ObjectId(SIMPLE_TEST_OBJECT_ID)}
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def test_second_lookup_is_a_hit(self):
+        self.should_have_stats({'hits': 1, 'misses': 1, 'documents': 1},
+        self.when_looked_up_twice(
+        self.with_identity_map()))
+
+    def test_writes_invalidate(self):
+        identity_map = self.when_looked_up_twice(self.with_identity_map())
+        identity_map.invalidate('platform.clients')
+        self.assertEqual(identity_map.lookup('platform.clients',
+            identity_map.get_key({'client_key': 'abc'})), (False, None))
+
+    def test_returned_documents_are_copies(self):
+        identity_map = self.with_identity_map()
+        key = identity_map.get_key({'client_key': 'abc'})
+        identity_map.store('platform.clients', key, {'callbacks': []})
+        identity_map.lookup('platform.clients', key)[1]['callbacks'].append(1)
+        self.assertEqual(identity_map.lookup('platform.clients', key)[1],
+            {'callbacks': []})
+
+    def test_scopes_nest(self):
+        with db.scope.scope('outer') as outer:
+            with db.scope.scope('inner') as inner:
+                self.assertIs(db.scope.current_scope(), inner)
+            self.assertIs(db.scope.current_scope(), outer)
+        self.assertIsNone(db.scope.current_scope())
+
+    def should_have_stats(self, stats, identity_map):
+        self.assertEqual(identity_map.stats(), stats)
+
+    def when_looked_up_twice(self, identity_map):
+        key = identity_map.get_key({'client_key': 'abc'}, ['secret'])
+
+        for i in range(0, 2):
+            found, document = identity_map.lookup('platform.clients', key)
+
+            if not found:
+                identity_map.store('platform.clients', key, {'secret': 'xyz'})
+
+        return identity_map
+
+    def with_identity_map(self):
+        return db.scope.IdentityMap()
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_query_shape(self):
+        self.assertEqual(db.instrumentation.normalize_query(
+            {'$and': [{'user_id': bson.objectid.ObjectId()},
+                      {'$or': [{'parent_path': 'a/'}, {'parent_path': 'b/'}]},
+                      {'timestamp': {'$gte': 1}}]}),
+            {'$and': [{'user_id': '?'}, {'$or': [{'parent_path': '?'}]},
+                      {'timestamp': {'$gte': '?'}}]})
+
+    def test_scope_totals(self):
+        self.should_have_summary(2, 5,
+        self.when_events_are_recorded([
+            ('platform.clients', 'find_one', 1),
+            ('platform.clients', 'find_one', 4)]))
+
+    def should_have_summary(self, operations, documents, stats):
+        summary = stats.summary()
+        self.assertEqual(summary['operations'], operations)
+        self.assertEqual(summary['documents'], documents)
+        self.assertEqual(
+            summary['by_collection']['platform.clients.find_one']['count'],
+            operations)
+
+    def when_events_are_recorded(self, events):
+        with db.scope.scope('test') as opened:
+            for collection, operation, documents in events:
+                event = db.instrumentation.QueryEvent(collection, operation)
+                event.documents = documents
+                db.instrumentation.record(event)
+        return opened.query_stats
+
+
+class TestMemoryBackend(unittest.TestCase):
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, db.backends.create_backend, 'redis')
+
+    def test_find_with_operators(self):
+        self.should_find_names(['b', 'c'],
+        self.when_finding({'$or': [{'value': {'$gte': 2}},
+            {'tags': 'x'}]}, sort = [('name', pymongo.ASCENDING)],
+        collection = self.with_documents()))
+
+    def test_missing_fields_match_null(self):
+        self.should_find_names(['a'],
+        self.when_finding({'tags': None},
+        collection = self.with_documents()))
+
+    def test_projection(self):
+        collection = self.with_documents()
+        self.assertEqual(
+            sorted(collection.find_one({'name': 'a'},
+                fields = ['value']).keys()),
+            ['_id', 'value'])
+
+    def test_bulk_upsert_increments(self):
+        collection = self.with_documents()
+        bulk = collection.initialize_unordered_bulk_op()
+        bulk.find({'name': 'a'}).upsert().update_one(
+            {'$inc': {'value': 5}, '$setOnInsert': {'tags': []}})
+        bulk.find({'name': 'd'}).upsert().update_one(
+            {'$inc': {'value': 5}, '$setOnInsert': {'tags': []}})
+        result = bulk.execute()
+
+        self.assertEqual((result['nMatched'], result['nUpserted']), (1, 1))
+        self.assertEqual(collection.find_one({'name': 'a'})['value'], 6)
+        self.assertEqual(collection.find_one({'name': 'd'})['tags'], [])
+
+    def test_empty_bulk(self):
+        self.assertRaises(pymongo.errors.InvalidOperation,
+            self.with_documents().initialize_unordered_bulk_op().execute)
+
+    def test_duplicate_ids(self):
+        collection = self.with_documents()
+        document = collection.find_one({'name': 'a'})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+            collection.insert, document)
+
+    def test_stored_datetimes_are_naive_utc(self):
+        collection = self.with_documents()
+        collection.insert({'when': datetime.datetime(2013, 1, 1, 12, 0, 0,
+            123456, tzinfo = bson.tz_util.utc)})
+        self.assertEqual(collection.find_one({'when': {'$exists': True}})[
+            'when'], datetime.datetime(2013, 1, 1, 12, 0, 0, 123000))
+
+    def test_group_and_project(self):
+        self.assertEqual(db.backends.memory.aggregate(
+            list(self.with_documents().find()), [
+            {'$match': {'name': {'$ne': 'c'}}},
+            {'$group': {'_id': {'kind': '$kind'}, 'total': {'$sum': '$value'},
+                'most': {'$max': '$value'}}},
+            {'$project': {'_id': 0, 'kind': '$_id.kind', 'total': 1,
+                'share': {'$cond': [{'$eq': ['$most', 0]}, 0,
+                    {'$divide': ['$total', '$most']}]}}},
+            {'$sort': {'kind': 1}}]),
+            [{'kind': 'even', 'share': 1.0, 'total': 2},
+             {'kind': 'odd', 'share': 1.0, 'total': 1}])
+
+    def should_find_names(self, names, documents):
+        self.assertEqual([document['name'] for document in documents], names)
+
+    def when_finding(self, spec, sort = None, collection = None):
+        return list(collection.find(spec, sort = sort))
+
+    def with_documents(self):
+        collection = db.backends.create_backend('memory').get_collection(
+            'platform', 'things')
+        collection.insert([
+            {'name': 'a', 'value': 1, 'kind': 'odd'},
+            {'name': 'b', 'value': 2, 'kind': 'even', 'tags': ['y']},
+            {'name': 'c', 'value': 3, 'kind': 'odd', 'tags': ['x', 'y']}])
+        return collection
+
+
+class TestAsyncModel(MemoryBackendTestCase):
+
+    def setUp(self):
+        super(TestAsyncModel, self).setUp()
+        models.Client.bulk_insert([models.Client(client_key = name,
+            name = name, description = '', secret = name)
+            for name in ['a', 'b', 'c']])
+
+    def test_afind_one(self):
+        self.assertEqual(
+            models.Client.afind_one({'name': 'b'}).result()['secret'], 'b')
+
+    def test_afind_one_passes_options_by_name(self):
+        class NarrowedClient(models.Client):
+            @classmethod
+            def find_one(cls, attrs, **kwargs):
+                return super(NarrowedClient, cls).find_one(attrs, **kwargs)
+
+        self.assertEqual(NarrowedClient.afind_one({'name': 'b'},
+            fields = ['secret']).result()['secret'], 'b')
+
+    def test_afind_iterates_across_batches(self):
+        self.assertEqual(sorted(client['name'] for client in
+            models.Client.afind(async_batch_size = 2)), ['a', 'b', 'c'])
+
+    def test_abulk_insert(self):
+        self.assertEqual(models.Client.abulk_insert([models.Client(
+            client_key = 'd', name = 'd', description = '')]).result().count(
+            'nInserted'), 1)
+        self.assertEqual(models.Client.find().count(), 4)
+
+    def test_work_runs_in_the_callers_scope(self):
+        with db.scope.scope('test') as opened:
+            models.Client.find_one({'name': 'a'})
+            models.Client.afind_one({'name': 'a'}).result()
+
+        self.assertEqual(opened.identity_map.hits, 1)
+
+    def test_concurrent_work_shares_the_scope(self):
+        with db.scope.scope('test') as opened:
+            db.asynchronous.gather(models.Client.afind_one({'name': name})
+                for name in ['a', 'b', 'c'] * 50)
+
+        stats = opened.stats()
+        self.assertEqual(stats['identity_map']['hits']
+            + stats['identity_map']['misses'], 150)
+        self.assertEqual(stats['queries']['operations'],
+            stats['identity_map']['misses'])
+
+    def test_spawned_work_can_wait_on_the_pool(self):
+        workers = db.asynchronous.get_executor()._max_workers
+        self.assertEqual(db.asynchronous.gather(db.asynchronous.spawn(
+            lambda: db.asynchronous.submit(lambda: 1).result())
+            for _ in range(workers * 2)), [1] * workers * 2)
+        self.assertRaises(ZeroDivisionError,
+            db.asynchronous.spawn(lambda: 1 / 0).result)
+
+    def test_gather_raises_failures(self):
+        self.assertRaises(ZeroDivisionError, db.asynchronous.gather,
+            [db.asynchronous.submit(lambda: 1),
+             db.asynchronous.submit(lambda: 1 / 0)])
+
+
+class EncodedThing(db.models.Model):
+    table = 'encoded_things'
+    encoding = db.encoding.KeyEncoding({'name': 'n', 'value': 'v'},
+        derived = ['double'], derived_from = ['value'],
+        derive = lambda document: document.update(
+            double = document['value'] * 2) if 'value' in document else None,
+        expressions = {'double': {'$multiply': ['$v', 2]}})
+
+    @classmethod
+    def get_encoding(cls):
+        return cls.encoding
+
+
+class DualReadThing(EncodedThing):
+    dual_read_encoding = db.encoding.DualReadEncoding(EncodedThing.encoding,
+        'name')
+
+    @classmethod
+    def get_encoding(cls):
+        return cls.dual_read_encoding
+
+
+class TestKeyEncoding(MemoryBackendTestCase):
+
+    def setUp(self):
+        super(TestKeyEncoding, self).setUp()
+        EncodedThing.bulk_insert([EncodedThing(name = name, value = value,
+            double = value * 2) for name, value in [('a', 1), ('b', 2)]])
+
+    def test_specs_are_encoded(self):
+        self.assertEqual(EncodedThing.encoding.encode_spec({'$or': [
+            {'name': 'a'}, {'value': {'$gt': 1}}], 'other.name': 1}),
+            {'$or': [{'n': 'a'}, {'v': {'$gt': 1}}], 'other.name': 1})
+        self.assertEqual(EncodedThing.encoding.encode_fields(['double']),
+            ['v'])
+
+    def test_stored_documents_are_short(self):
+        self.assertEqual(sorted(EncodedThing.get_collection().find_one(
+            {'n': 'a'}).keys()), ['_id', 'n', 'v'])
+
+    def test_documents_are_decoded(self):
+        self.assertEqual([(thing['name'], thing['double'])
+            for thing in EncodedThing.find({'value': {'$gte': 1}},
+                fields = ['name', 'double']).sort('name', -1)],
+            [('b', 4), ('a', 2)])
+        self.assertEqual(EncodedThing.find_one({'name': 'b'})['double'], 4)
+        self.assertEqual(EncodedThing.find().distinct('name'), ['a', 'b'])
+
+    def test_upserts_drop_empty_operators(self):
+        self.assertEqual(EncodedThing.encoding.encode_update(
+            {'$inc': {'value': 1}, '$setOnInsert': {'double': 2}}),
+            {'$inc': {'v': 1}})
+
+    def test_aggregations_run_over_decoded_documents(self):
+        self.assertEqual(EncodedThing.aggregate([
+            {'$match': {'name': {'$in': ['a', 'b']}}},
+            {'$group': {'_id': None, 'double': {'$sum': '$double'}}}]),
+            [{'_id': None, 'double': 6}])
+        self.assertEqual(EncodedThing.encoding.encode_pipeline([
+            {'$match': {'name': 'a'}}, {'$sort': {'double': 1}},
+            {'$group': {'_id': '$name'}}]), [{'$match': {'n': 'a'}},
+            {'$project': {'double': {'$multiply': ['$v', 2]}, 'name': '$n'}},
+            {'$sort': {'double': 1}}, {'$group': {'_id': '$name'}}])
+        self.assertEqual([(thing['name'], thing['double']) for thing in
+            EncodedThing.aggregate([{'$sort': {'double': -1}}])],
+            [('b', 4), ('a', 2)])
+
+    def test_dual_read_finds_both_forms(self):
+        EncodedThing.get_collection().insert({'name': 'c', 'value': 0,
+            'double': 0})
+
+        self.assertEqual([thing['name'] for thing in DualReadThing.find(
+            {'value': {'$lt': 2}}).sort('value', 1)], ['c', 'a'])
+        self.assertEqual([thing['name'] for thing in DualReadThing.find(
+            ).sort('name', -1).limit(2)], ['c', 'b'])
+        self.assertEqual(DualReadThing.find_one({'name': 'c'})['double'], 0)
+        self.assertEqual(DualReadThing.find().count(), 3)
+        self.assertEqual(DualReadThing.aggregate([
+            {'$match': {'value': {'$lt': 2}}},
+            {'$group': {'_id': '$name', 'double': {'$sum': '$double'}}},
+            {'$sort': {'_id': 1}}]),
+            [{'_id': 'a', 'double': 2}, {'_id': 'c', 'double': 0}])
+
+
+class ThingMigration(db.migrations.Migration):
+    def __init__(self, fail_at = None):
+        super(ThingMigration, self).__init__(1, 'things')
+        self.fail_at = fail_at
+        self.migrated = []
+
+    def get_collection(self):
+        return db.get_collection('test', 'things')
+
+    def get_spec(self):
+        return {'done': {'$exists': False}}
+
+    def migrate(self, batch):
+        if self.fail_at in [document['n'] for document in batch]:
+            raise ValueError(self.fail_at)
+
+        self.migrated += [document['n'] for document in batch]
+
+
+class TestMigrations(MemoryBackendTestCase):
+
+    def setUp(self):
+        super(TestMigrations, self).setUp()
+        ThingMigration().get_collection().insert([{'n': n}
+            for n in range(5)])
+
+    def test_runs_resume_from_the_checkpoint(self):
+        migration = ThingMigration(fail_at = 3)
+        self.assertRaises(ValueError, db.migrations.run, migration,
+            batch_size = 2)
+        self.assertEqual(db.migrations.get_state(migration).status,
+            'running')
+        self.assertFalse(db.migrations.is_applied('things'))
+
+        migration.fail_at = None
+        self.assertEqual(db.migrations.run(migration, batch_size = 2), 3)
+        self.assertEqual(migration.migrated, range(5))
+        self.assertEqual(db.migrations.get_state(migration).migrated, 5)
+        self.assertEqual(db.migrations.pending([migration]), [])
+        self.assertTrue(db.migrations.is_applied('things'))
+
+    def test_dry_runs_only_count(self):
+        migration = ThingMigration()
+        self.assertEqual(db.migrations.run(migration, dry_run = True), 5)
+        self.assertEqual(migration.migrated, [])
+        self.assertEqual(db.migrations.pending([migration]), [migration])
+
+    def test_writes_are_throttled(self):
+        throttle = db.migrations.Throttle(max_per_second = 1000)
+        started = time.time()
+        throttle.wait(50)
+        self.assertTrue(time.time() - started >= 0.045)
+
@@ -1,8 +1,16 @@
+import datetime
 import pymongo
-from db.models import Model, mongodb_init
+from db.models import Model, Index, mongodb_init
+
+# How long to remember nonces for. Requests with older timestamps are rejected
+# by the provider anyway, so there is no need to keep their nonces around.
+NONCE_LIFETIME = 24 * 60 * 60
 
 class User(Model):
     table = "users"
+    fields = ('name', 'email', 'openid', 'confirmed', 'external_tokens',
+        'client_ids')
+    indexes = [Index('openid')]
     
     @mongodb_init
     def __init__(self, name="", email="", openid="", confirmed=True,
@@ -33,6 +41,9 @@ class User(Model):
 
 class Client(Model):
     table = "clients"
+    fields = ('client_key', 'name', 'description', 'secret', 'pubkey',
+        'request_tokens', 'access_tokens', 'callbacks', 'user_id')
+    indexes = [Index('client_key', unique = True)]
 
     @mongodb_init
     def __init__(self, client_key, name, description, secret=None, pubkey=None,
@@ -53,12 +64,20 @@ class Client(Model):
 
 class Nonce(Model):
     table = "nonces"
+    fields = ('nonce', 'timestamp', 'client_id', 'request_token_id',
+        'access_token_id', 'created_at')
+    indexes = [
+        Index('nonce', 'timestamp', 'client_id'),
+        Index('created_at', expireAfterSeconds = NONCE_LIFETIME)
+    ]
 
     @mongodb_init
     def __init__(self, nonce, timestamp, client_id = '', request_token_id = '',
-    access_token_id = ''):
+    access_token_id = '', created_at = None):
         self.nonce = nonce
         self.timestamp = timestamp
+        self.created_at = (created_at if created_at
+            else datetime.datetime.utcnow())
         self.client_id = client_id
         self.request_token_id = request_token_id
         self.access_token_id = access_token_id
@@ -70,6 +89,9 @@ class Nonce(Model):
 
 class RequestToken(Model):
     table = "requestTokens"
+    fields = ('token', 'callback', 'secret', 'verifier', 'realm', 'user_id',
+        'client_id')
+    indexes = [Index('token'), Index('client_id', 'user_id', 'realm')]
 
     @mongodb_init
     def __init__(self, token = '', callback = '', secret=None, verifier=None,
@@ -88,6 +110,8 @@ class RequestToken(Model):
 
 class AccessToken(Model):
     table = "accessTokens"
+    fields = ('token', 'secret', 'verifier', 'realm', 'user_id', 'client_id')
+    indexes = [Index('token'), Index('client_id', 'user_id', 'realm')]
 
     @mongodb_init
     def __init__(self, token='', secret=None, verifier=None, realm=None,
@@ -105,6 +129,8 @@ class AccessToken(Model):
 
 class UID(Model):
     table = "UIDs"
+    fields = ('uid', 'datastream', 'user_id')
+    indexes = [Index('user_id'), Index('uid', 'datastream')]
     
     @mongodb_init
     def __init__(self, uid, datastream, user_id):
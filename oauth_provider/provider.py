@@ -108,7 +108,7 @@ class BitTrailsProvider(OAuthProvider):
             
             return render_template(u"client.html", **info)
         else:
-            clients = Client.get_collection().find({'_id': {'$in': 
+            clients = Client.find({'_id': {'$in': 
                 [ObjectId(oid) for oid in g.user.client_ids]}})
             
             return render_template(u"register.html", clients=clients)
@@ -341,10 +341,10 @@ class BitTrailsProvider(OAuthProvider):
             nonce.insert()
 
     def save_verifier(self, request_token, verifier):
-        token = RequestToken.find_one({'token':request_token})
+        token = RequestToken.find_one({'token':request_token}, as_obj = True)
         token['verifier'] = verifier
         token['user_id'] = current_user.get_id()
-        RequestToken.get_collection().save(token)
+        token.save()
 
     def authorized(self, request_token, request = None):
         """Create a verifier for an user authorized client"""
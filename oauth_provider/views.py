@@ -58,8 +58,7 @@ def setup_account():
             flash(u'Error: you have to enter a valid email address')
         else:
             flash(u'Profile successfully created')
-            User.get_collection().insert(
-                User(name, email, session['openid']))
+            User(name, email, session['openid']).insert()
             return redirect(oid.get_next_url())
     return render_template('setup_account.html', next_url=oid.get_next_url())
 
@@ -72,7 +71,7 @@ def edit_account():
     form = dict(name=g.user.name, email=g.user.email)
     if request.method == 'POST':
         if 'delete' in request.form:
-            User.get_collection().remove(g.user)
+            g.user.remove()
             session['openid'] = None
             flash(u'Profile deleted')
             return redirect(url_for('.index'))
@@ -86,7 +85,7 @@ def edit_account():
             flash(u'Profile successfully created')
             g.user.name = form['name']
             g.user.email = form['email']
-            uid = User.get_collection().save(g.user)
+            uid = g.user.save()
             return redirect(url_for('.edit_account'))
     return render_template('edit_account.html', form=form)
 
@@ -113,7 +112,7 @@ def create_or_login(resp):
     with a terrible URL which we certainly don't want.
     """
     session['openid'] = resp.identity_url
-    user = User.get_collection().find_one({'openid':resp.identity_url})
+    user = User.find_one({'openid':resp.identity_url})
     if user is not None:
         flash(u'Successfully signed in')
         g.user = User
@@ -4,6 +4,71 @@ DATABASES = {
     'async': 'platform_async'
 }
 
+# 'mongo', or 'memory' to keep everything in-process (benchmarks, tests).
+DATABASE_BACKEND = 'mongo'
+
+# MongoDB connection pooling. One pooled client is kept per process.
+DATABASE_HOST = 'localhost'
+DATABASE_POOL_SIZE = 10
+DATABASE_CONNECT_TIMEOUT_MS = 20000
+DATABASE_SOCKET_TIMEOUT_MS = None
+# Documents written per unordered bulk operation by Model.bulk_insert,
+# bulk_upsert and the other chunked writes.
+DATABASE_BULK_BATCH_SIZE = 1000
+# Threads running the async Model methods (afind_one, abulk_insert...).
+DATABASE_ASYNC_WORKERS = 10
+
+# Operations slower than this are logged to the 'db.slow_queries' logger.
+DATABASE_SLOW_QUERY_MS = 100
+# Also count the bytes of the documents each operation reads or writes, by
+# re-encoding them as BSON. Costly, so only turn it on while profiling.
+DATABASE_MEASURE_BYTES = False
+
+# Documents db.migrations rewrites at a time (python . --migrate), and how
+# many it rewrites a second at most (None for as fast as it can).
+DATABASE_MIGRATION_BATCH_SIZE = 1000
+DATABASE_MIGRATION_MAX_PER_SECOND = None
+
+# 'hourly' stores a document per datapoint, 'daily' a document per day with
+# the hours in an array. Run async_tasks.datastreams.bucketize when
+# switching an existing database to 'daily'.
+TIMESERIES_STORAGE = 'hourly'
+# Answer queries grouped by day, ISO week, month or year from the rollups.
+# Only turn it on once async_tasks.datastreams.rollup has been run, if there
+# is data from before the rollups existed.
+TIMESERIES_ROLLUPS = False
+# Where async_tasks.snapshots keeps memory-mapped copies of users' time series
+# for queries to read instead of the database (None turns snapshots off), and
+# how many seconds a snapshot can be used for without being exported again.
+TIMESERIES_SNAPSHOT_DIR = None
+TIMESERIES_SNAPSHOT_MAX_AGE = 24 * 60 * 60
+# How many days of hourly data async_tasks.datastreams.compact keeps before
+# folding older hours into the day rollups (None keeps them all).
+TIMESERIES_COMPACTION_DAYS = None
+# How many seconds API processes keep a user's path tree (directory listing)
+# in memory before reading it again.
+TIMESERIES_PATH_CACHE_SECONDS = 60
+# How many UserTimeSeriesQuery results each process caches (0 turns the
+# cache off), and whether they are also shared between processes through
+# the timeseries_query_cache collection.
+TIMESERIES_QUERY_CACHE_SIZE = 1000
+TIMESERIES_QUERY_CACHE_SHARED = False
+# How TimeSeriesQuery totals and averages are worked out: 'mongo' runs them
+# as aggregation pipelines, 'local' reads the rows and works them out in
+# process with async_tasks.local_engine, and 'auto' does that for queries
+# reading at most TIMESERIES_LOCAL_ENGINE_MAX_ROWS rows, at the cost of
+# counting them first.
+TIMESERIES_QUERY_ENGINE = 'mongo'
+TIMESERIES_LOCAL_ENGINE_MAX_ROWS = 50000
+# Also look for paths among the datapoints in the timeseries collection. None
+# does until the split_paths migration has moved them out.
+TIMESERIES_LEGACY_PATHS = None
+# Store TimeSeriesData documents under single-letter keys, without the
+# calendar fields, which makes them less than half the size. Run
+# python . --migrate after turning it on to convert the existing documents;
+# both forms are read until then.
+TIMESERIES_COMPACT_KEYS = False
+
 FITBIT_KEY = ''
 FITBIT_SECRET = ''
 TWITTER_KEY = ''
@@ -25,5 +25,4 @@ sudo apt-get install mongodb-10gen
 cd bittrails_platform
 echo "DEBUG=True" > settings_local.py
 echo "y" | python . --no-server --reset-db
-python -m async_tasks.datastreams.fill_zeroes
 cd ..